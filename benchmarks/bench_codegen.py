@@ -0,0 +1,45 @@
+""" Compares evaluating compiled expressions with the bytecode interpreter against
+	evaluating them as generated Python functions.
+
+	Run with ``python benchmarks/bench_codegen.py``.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import yapp
+
+ENVIRONMENT = {
+	"x" : 2,
+	"y" : 7,
+	"code" : "c42",
+	"flag" : True,
+	"minus" : lambda a, b: a - b,
+}
+
+EXPRESSIONS = [
+	("short", "x * 3 + x"),
+	("call", "minus(5 * 5, 2 * 2) > x"),
+	("nested", "((((x + 1) * 2) - 3) / 4) > ((y ^ 2) % 5)"),
+	("logical", " and ".join(["(x > %d or y eq %d)" % (i, i) for i in range(10)])),
+	("list", "in(code, [%s])" % ", ".join(["'c%d'" % i for i in range(50)])),
+]
+
+def _time(compiled, number):
+	seconds = min(timeit.repeat(lambda: compiled.evaluate(ENVIRONMENT),
+		number=number, repeat=3))
+	return seconds / number * 1e6
+
+def main(argv):
+	number = 20000
+	print("%-10s %12s %12s %8s" % ("", "bytecode us", "codegen us", "speedup"))
+	for name, expr in EXPRESSIONS:
+		interpreted = _time(yapp.compile(expr), number)
+		generated = _time(yapp.compile(expr, codegen=True), number)
+		print("%-10s %12.2f %12.2f %7.1fx" % (name, interpreted, generated,
+			interpreted / generated))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,53 @@
+""" Compares starting a worker by parsing its rules against loading them
+	from a DiskCache pack.
+
+	Run with ``python benchmarks/bench_diskcache.py [rules]``.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import yapp
+from yapp.diskcache import DiskCache
+
+TEMPLATES = [
+	"country eq 'C%(n)d' and amount > %(n)d",
+	"in(category, ['a', 'b', 'c%(n)d']) and not(blocked)",
+	"score * 0.%(n)d + bonus >= 10 or tier eq %(n)d",
+	"minus(limit, spent) > %(n)d and (region eq 'EU' or region eq 'R%(n)d')",
+]
+
+def _time(function):
+	start = time.perf_counter()
+	function()
+	return time.perf_counter() - start
+
+def main(argv):
+	count = int(argv[0]) if argv else 20000
+	exprs = [TEMPLATES[i % len(TEMPLATES)] % {"n" : i} for i in range(count)]
+	directory = tempfile.mkdtemp()
+	try:
+		cache = DiskCache(directory, parser="pratt")
+		results = [
+			("parse, pyparsing", _time(lambda: [yapp.compile(expr) for expr in exprs])),
+			("parse, pratt", _time(lambda: [yapp.compile(expr, parser="pratt")
+				for expr in exprs])),
+			("fill the cache", _time(lambda: [cache.compile(expr) for expr in exprs])),
+			("write the pack", _time(cache.flush)),
+		]
+		warm = DiskCache(directory)
+		results.append(("load from the pack", _time(lambda: [warm.compile(expr)
+			for expr in exprs])))
+		assert warm.misses == 0
+		print("%d rules, pack of %d bytes" % (count, os.path.getsize(cache.path)))
+		for name, seconds in results:
+			print("%-20s %8.2fs %8.1fus/rule" % (name, seconds, seconds / count * 1e6))
+	finally:
+		shutil.rmtree(directory)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,34 @@
+""" Measures how long it takes to compile yapp expressions of growing size.
+
+	Run with ``python benchmarks/bench_grammar.py [--packrat] [--pratt]``.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import yapp
+
+EXPRESSIONS = [
+	("short", "x * 3 + x"),
+	("call", "minus(5 * 5, 2 * 2) > x"),
+	("nested", "((((x + 1) * 2) - 3) / 4) > ((y ^ 2) % 5)"),
+	("logical", " and ".join(["(x%d > %d or y eq 'a%d')" % (i, i, i)
+		for i in range(10)])),
+	("list", "in(code, [%s])" % ", ".join(["'c%d'" % i for i in range(50)])),
+]
+
+def main(argv):
+	if "--packrat" in argv:
+		yapp.enable_packrat()
+	if "--pratt" in argv:
+		yapp.set_default_parser("pratt")
+	number = 50
+	for name, expr in EXPRESSIONS:
+		seconds = min(timeit.repeat(lambda: yapp.compile(expr), number=number,
+			repeat=3))
+		print("%-10s %8.1f us/compile" % (name, seconds / number * 1e6))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
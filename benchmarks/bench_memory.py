@@ -0,0 +1,58 @@
+""" Reports how many bytes each compiled rule keeps resident, to size hosts
+	holding millions of rules.
+
+	Run with ``python benchmarks/bench_memory.py [rules]``. The rules are
+	generated per tenant, so like real ones they share their shape and
+	names but not all of their constants.
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import yapp
+
+TEMPLATES = [
+	"country eq 'C%(n)d' and amount > %(n)d",
+	"in(category, ['a', 'b', 'c%(n)d']) and not(blocked)",
+	"score * 0.%(n)d + bonus >= 10 or tier eq %(n)d",
+	"minus(limit, spent) > %(n)d and (region eq 'EU' or region eq 'R%(n)d')",
+]
+
+def _rules(count):
+	return [TEMPLATES[i % len(TEMPLATES)] % {"n" : i // len(TEMPLATES) % 5000}
+		for i in range(count)]
+
+def _measure(build, count):
+	""" Returns the bytes allocated by build per rule, and what it built
+	"""
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	kept = build()
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return (after - before) / float(count), kept
+
+def main(argv):
+	count = int(argv[0]) if argv else 100000
+	exprs = _rules(count)
+	text = sum(sys.getsizeof(expr) for expr in exprs) / float(count)
+	trees = [yapp.optimize_tree(yapp.parse_tree(expr, "pratt")) for expr in exprs]
+
+	compiled_bytes, compiled = _measure(lambda: [yapp.CompiledExpression(expr, tree)
+		for expr, tree in zip(exprs, trees)], count)
+	tree_bytes, _ = _measure(lambda: [yapp.optimize_tree(yapp.parse_tree(expr, "pratt"))
+		for expr in exprs], count)
+	instructions = sum(len(rule.code) for rule in compiled) / float(count)
+	code_bytes = sum(rule.code.nbytes() for rule in compiled) / float(count)
+
+	print("rules                      %10d" % count)
+	print("instructions per rule      %10.1f" % instructions)
+	print("bytes per rule, code       %10.1f" % code_bytes)
+	print("bytes per rule, compiled   %10.1f (including its values)" % compiled_bytes)
+	print("bytes per rule, tree       %10.1f" % tree_bytes)
+	print("bytes per rule, text       %10.1f (kept by both)" % text)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
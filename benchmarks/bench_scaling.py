@@ -0,0 +1,44 @@
+""" Times parsing, compiling and evaluating flat chains of 10, 1k and 100k
+	terms, to show the time per term stays flat as expressions grow.
+
+	Run with ``python benchmarks/bench_scaling.py``. Pass ``--pyparsing`` to
+	parse with the pyparsing grammar instead of the pratt parser.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import yapp
+
+SIZES = [10, 1000, 100000]
+
+CHAINS = [
+	("or", lambda terms: " or ".join(["x%d eq %d" % (i, i) for i in range(terms)])),
+	("sum", lambda terms: " + ".join(["x"] * terms)),
+]
+
+def _time(function):
+	start = time.perf_counter()
+	result = function()
+	return time.perf_counter() - start, result
+
+def main(argv):
+	parser = "pyparsing" if "--pyparsing" in argv else "pratt"
+	environment = {"x" : 1}
+	yapp.parse_tree("x", parser) # imports the parser
+	print("%-6s %8s %12s %12s %12s" % ("chain", "terms", "parse us/t",
+		"compile us/t", "eval us/t"))
+	for name, build in CHAINS:
+		for terms in SIZES:
+			expr = build(terms)
+			parse, tree = _time(lambda: yapp.parse_tree(expr, parser))
+			compiling, compiled = _time(lambda: yapp.compile(expr,
+				fail_silently=False, parser=parser))
+			evaluating, _ = _time(lambda: compiled.evaluate(environment))
+			print("%-6s %8d %12.2f %12.2f %12.2f" % (name, terms,
+				parse / terms * 1e6, compiling / terms * 1e6, evaluating / terms * 1e6))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,173 @@
+""" Times compile, parse, is_valid, get_variables and evaluate as
+	expressions grow in size, nesting depth, list literal size and the
+	number of environment functions they call, and writes the results as
+	JSON so runs can be compared over time. Needs neither Django nor the
+	network.
+
+	Run with ``python benchmarks/bench_suite.py``. Options:
+
+	--output FILE   write the results to FILE as JSON
+	--compare FILE  show how each result compares with an earlier run
+	--parser NAME   parse with NAME instead of yapp's default parser
+	--quick         time each case once and briefly, for a smoke test
+
+	compile parses without the expression caches, while parse, is_valid and
+	get_variables find the expression in them, as they would in a long
+	running process. Each compile result also has the time spent in each
+	phase of one compile, from yapp's instrumentation, and each evaluate
+	result the number of environment function calls. grammar is the time
+	taken to build the pyparsing grammar, which is 0 with the pratt parser.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import yapp
+
+def _sized(terms):
+	return " + ".join(["x"] * terms), {"x" : 1}
+
+def _nested(depth):
+	return "(" * depth + "x" + " + 1)" * depth, {"x" : 1}
+
+def _listed(items):
+	return "in(x, [%s])" % ", ".join(str(item) for item in range(items)), {"x" : 1}
+
+def _functions(count):
+	environment = {"x" : 1}
+	for index in range(count):
+		environment["f%d" % index] = abs
+	return " + ".join("f%d(x)" % index for index in range(count)), environment
+
+DIMENSIONS = [
+	("size", [10, 100, 1000], _sized),
+	# pyparsing runs out of stack not far past 64 levels of brackets
+	("depth", [4, 16, 64], _nested),
+	("list", [10, 100, 1000], _listed),
+	("functions", [1, 10, 100], _functions),
+]
+
+OPERATIONS = [
+	("compile", lambda expr, environment: yapp.compile(expr, fail_silently=False)),
+	("parse", lambda expr, environment: yapp.parse(expr, environment)),
+	("is_valid", lambda expr, environment: yapp.is_valid(expr, environment)),
+	("get_variables", lambda expr, environment: yapp.get_variables(expr, environment)),
+]
+
+def _time(function, repeat, minimum):
+	""" Returns the best seconds per call of function, and how many calls
+		each timing made
+	"""
+	function() # so the caches are warm
+	number = 1
+	while True:
+		start = time.perf_counter()
+		for i in range(number):
+			function()
+		elapsed = time.perf_counter() - start
+		if elapsed >= minimum:
+			break
+		number *= 2
+	best = elapsed
+	for i in range(repeat - 1):
+		start = time.perf_counter()
+		for i in range(number):
+			function()
+		best = min(best, time.perf_counter() - start)
+	return best / number, number
+
+def _instrumented(expr, environment):
+	""" Returns the seconds one compile spent in each phase, and the calls
+		one evaluation made to environment functions
+	"""
+	events = []
+	with yapp.instrumented(events.append):
+		compiled = yapp.compile(expr, fail_silently=False)
+		compiled.evaluate(environment)
+	phases = {}
+	calls = 0
+	for event in events:
+		if event.phase == "evaluate":
+			calls = sum(event.calls.values())
+		else:
+			phases[event.phase] = event.seconds
+	return phases, calls
+
+def run(repeat=3, minimum=0.1):
+	results = []
+	for dimension, values, build in DIMENSIONS:
+		for value in values:
+			expr, environment = build(value)
+			phases, calls = _instrumented(expr, environment)
+			for operation, function in OPERATIONS:
+				seconds, number = _time(lambda: function(expr, environment), repeat,
+					minimum)
+				result = {"dimension" : dimension, "value" : value,
+					"operation" : operation, "seconds" : seconds, "number" : number}
+				if operation == "compile":
+					result["phases"] = phases
+				results.append(result)
+			compiled = yapp.compile(expr, fail_silently=False)
+			seconds, number = _time(lambda: compiled.evaluate(environment), repeat,
+				minimum)
+			results.append({"dimension" : dimension, "value" : value,
+				"operation" : "evaluate", "seconds" : seconds, "number" : number,
+				"calls" : calls})
+	return results
+
+def _key(result):
+	return (result["dimension"], result["value"], result["operation"])
+
+def main(argv):
+	options = argparse.ArgumentParser(description="Benchmarks yapp.")
+	options.add_argument("--output")
+	options.add_argument("--compare")
+	options.add_argument("--parser", choices=sorted(yapp.PARSERS))
+	options.add_argument("--quick", action="store_true")
+	options = options.parse_args(argv)
+	if options.parser:
+		yapp.set_default_parser(options.parser)
+	# imports the parser, building the pyparsing grammar if it's used
+	events = []
+	with yapp.instrumented(events.append):
+		yapp.parse_tree("x")
+	grammar = sum(event.seconds for event in events if event.phase == "grammar")
+	previous = {}
+	if options.compare:
+		with open(options.compare) as f:
+			previous = dict((_key(result), result) for result in json.load(f)["results"])
+	if options.quick:
+		results = run(repeat=1, minimum=0.001)
+	else:
+		results = run()
+	print("%-10s %6s %-14s %12s %8s" % ("dimension", "value", "operation", "us/call",
+		"change"))
+	for result in results:
+		change = ""
+		earlier = previous.get(_key(result))
+		if earlier is not None:
+			change = "%+.0f%%" % ((result["seconds"] / earlier["seconds"] - 1) * 100)
+		print("%-10s %6d %-14s %12.2f %8s" % (result["dimension"], result["value"],
+			result["operation"], result["seconds"] * 1e6, change))
+	if options.output:
+		report = {
+			"yapp" : yapp.__version__,
+			"python" : platform.python_version(),
+			"implementation" : platform.python_implementation(),
+			"machine" : platform.machine(),
+			"parser" : options.parser or yapp._default_parser,
+			"date" : datetime.datetime.now().isoformat(),
+			"grammar" : grammar,
+			"results" : results,
+		}
+		with open(options.output, "w") as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
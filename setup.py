@@ -8,8 +8,12 @@ setup(name='yapp',
       author_email='jeanmark.wright@gmail.com',
       license='MIT',
       packages=['yapp'],
+      python_requires='>=3.7',
       install_requires = [
-	    'Django>=1.5.5,<=2.0.0',
+	    'Django>=3.2,<5.0',
             'pyparsing>=2.0.1',
       ],
+      extras_require = {
+            'numpy': ['numpy'],
+      },
       zip_safe=False)
@@ -1,244 +1,363 @@
-import re
-import inspect
-import types
-import traceback
-
-from pyparsing import (
-	Word, Literal, alphas, alphanums, nums, Optional,
-	delimitedList, Group,
-	Combine,
-	StringEnd,
-	ZeroOrMore,
-	Forward,
-	sglQuotedString,
-	opAssoc,
-	Keyword
-)
-import pyparsing
+""" Yet Another Python Parser: evaluates simple expressions against an
+	environment of variables and functions.
+
+	Compiled expressions, RuleSets, RuleIndexes and the parsers hold no
+	mutable state while evaluating, so they can be used from any number of
+	threads at once; only adding rules to a RuleSet or RuleIndex must not
+	overlap with evaluating them. Each evaluation keeps its own stack, memo
+	and LazyEnvironment. Looking an expression up in the shared expression
+	cache takes no lock; compiling one that isn't there does, briefly. The
+	exceptions are things that are shared on purpose: pure functions lock
+	around their results, and enable_packrat makes pyparsing lock around
+	its cache.
+
+	Infix operators always have their builtin meaning. An environment that
+	defines eq, and or or replaces the function called as eq(a, b),
+	and(a, b) or or(a, b), but not a eq b, a and b or a or b. Operands and
+	arguments are evaluated from left to right, so the leftmost error is
+	the one raised and functions are called in the order they're written.
+	^ raises OverflowError rather than work out an int of more than
+	MAX_POWER_BITS bits, which would take too long to be of use.
+"""
+import importlib
 
 from yapp.exceptions import *
-
-# Terminal symbols =============================================================
-# Variable names and including property access
-ident = Word(alphas, alphanums + '_')
-func_name = Word(alphas, alphanums + '_')
-
-# Numbers
-point = Literal(".")
-number = Word(nums)
-sign = Literal("+") | Literal("-")
-integer = Combine(Optional(sign) + number)
-decimal = Combine(integer + point + Optional(number))
-
-# Operators
-plus = Literal("+")
-minus = Literal("-")
-mult = Literal("*")
-divide = Literal("/")
-exponent = Literal("^")
-mod = Literal("%")
-inop = Literal("in")
-eqop = Literal("==") | Literal("eq")
-plusminus = plus | minus
-multdivide = mult | divide | mod
-gte = Literal(">=")
-lte = Literal("<=")
-gt = Literal(">")
-lt = Literal("<")
-relational = gte | lte | gt | lt
-
-# Logical stuff
-TRUE = Literal("True")
-FALSE = Literal("False")
-BOOLEAN = TRUE | FALSE
-logicop = Literal("or") | Literal("and")
-
-# Groups
-lbrace = Literal("(").suppress()
-rbrace = Literal(")").suppress()
-lbracket = Literal("[")
-rbracket = Literal("]")
-
-stack = []
-
-def get_grammar(save_token_function=lambda: None,
-		save_int_function=lambda: None,
-		save_decimal_function=lambda: None,
-		save_string_function=lambda: None,
-		save_ident_function=lambda: None,
-		save_list_function=lambda: None,
-		save_boolean_function=lambda: None
-	):
-	expr = Forward()
-	atom = Forward()
-	arg = expr
-	args = delimitedList(arg)
-
-	func_call = (func_name + lbrace + Optional(args) + rbrace).setParseAction(save_token_function)
-
-	bracketed_list = (lbracket + Optional(delimitedList(atom)) + rbracket).setParseAction(save_list_function)
-
-	terminals = ( BOOLEAN.setParseAction(save_boolean_function) | decimal.setParseAction(save_decimal_function) | 
-		integer.setParseAction(save_int_function) | 
-		ident.setParseAction(save_ident_function) | 
-		sglQuotedString.setParseAction(save_string_function) )
-
-	atom <<= ( func_call | terminals  | (lbrace + expr + rbrace) | bracketed_list )
-
-	eq_factor = Forward()
-
-	eq_factor <<= atom + ZeroOrMore( (eqop + eq_factor).setParseAction(save_token_function) )
-
-	factor = eq_factor + ZeroOrMore( (exponent + eq_factor).setParseAction(save_token_function) )
-
-	term = factor + ZeroOrMore( (multdivide + factor).setParseAction(save_token_function) )
-
-	rel_term = term + ZeroOrMore( (relational + term).setParseAction(save_token_function) )
-
-	plusminus_term = rel_term + ZeroOrMore( (plusminus + rel_term).setParseAction(save_token_function) ) 
-
-	expr <<= plusminus_term + ZeroOrMore( (logicop + plusminus_term).setParseAction(save_token_function) )
-
-	# Define the grammar now ...
-	grammar = expr + StringEnd()
+from yapp.codegen import generate_function, generate_source, CodegenError
+from yapp.vectorize import evaluate_tree_columns
+from yapp.cache import ExpressionCache, CacheStats
+from yapp.nodes import Node, Constant, Name, List, Call, BinOp, walk, to_source
+from yapp.optimizer import optimize as optimize_tree, specialize as specialize_tree, \
+	LiteralSet
+from yapp.evaluator import op_map, function_map, evaluate_node, lookup, MISSING, \
+	MAX_POWER_BITS
+from yapp.bytecode import Code, assemble, decompile, run, disassemble
+from yapp.analysis import Analysis, analyze_code
+from yapp.environment import LazyEnvironment, as_environment
+from yapp.aio import AsyncPlan, evaluate_tree_async
+from yapp.functions import arity, pure, PureFunction
+from yapp import instrumentation
+from yapp.instrumentation import Event, instrument, instrumented
+
+__version__ = "0.1"
+
+def get_grammar():
+	""" Returns the pyparsing grammar shared by every parse. Parsing with it 
+		returns a single node describing the expression.
+	"""
+	from yapp.grammar import grammar
 	return grammar
 
-op_map = {
-	"+" : lambda a,b: a + b,
-	"-" : lambda a,b: a - b,
-	"*" : lambda a,b: a * b,
-	"/" : lambda a,b: a / b,
-	"%" : lambda a,b: a % b,
-	"^" : lambda a,b: a ** b,
-	">" : lambda a,b : a > b,
-	"<" : lambda a,b : a < b,
-	">=" : lambda a,b : a >= b,
-	"<=" : lambda a,b : a <= b,
-}
-
-
-function_map = {
-	"not" : lambda x: not x,
-	"eq" : lambda x,y : x == y,
-	"in" : lambda x,y : x in y,
-	"and" : lambda a,b : a and b,
-	"or" : lambda a,b : a or b
+def enable_packrat(cache_size_limit=128):
+	""" Turns on pyparsing's packrat memoization, which applies to every 
+		pyparsing grammar in the process. yapp's grammar rarely backtracks, 
+		so this makes it slower: benchmarks/bench_grammar.py --packrat takes 
+		about twice as long per compile.
+	"""
+	from pyparsing import ParserElement
+	ParserElement.enablePackrat(cache_size_limit)
+
+# The pyparsing terminals are only loaded when they are asked for
+_grammar_names = ("ident", "func_name", "integer", "decimal", "BOOLEAN")
+
+def __getattr__(name):
+	if name in _grammar_names:
+		from yapp import grammar
+		return getattr(grammar, name)
+	raise AttributeError("module 'yapp' has no attribute %r" % name)
+
+class CompiledExpression(object):
+	""" An expression that has been parsed once and can be evaluated against
+		any number of environments. Only its instructions are kept; the tree
+		is rebuilt from them when it's asked for, and kept from then on once
+		it has been evaluated asynchronously or over columns, which need it.
+	"""
+	__slots__ = ("_expr", "_code", "_function", "_analysis", "_tree", "_plan")
+
+	def __init__(self, expr, tree, function=None, code=None):
+		self._expr = expr
+		self._function = function
+		self._code = code
+		if code is None and tree is not None:
+			self._code = assemble(tree)
+		self._analysis = None
+		self._tree = None
+		self._plan = None
+
+	@property
+	def expr(self):
+		return self._expr
+
+	@property
+	def tree(self):
+		""" The root node of the parsed expression, None if it failed to parse
+		"""
+		if self._code is None:
+			return None
+		if self._tree is not None:
+			return self._tree
+		return decompile(self._code)
+
+	def _kept_tree(self):
+		if self._tree is None:
+			self._tree = decompile(self._code)
+		return self._tree
+
+	@property
+	def code(self):
+		""" The instructions the expression is evaluated with
+		"""
+		return self._code
+
+	def names(self):
+		""" Yields the variable and function names used in source order
+		"""
+		if self._code is not None:
+			for name in self._code.names():
+				yield name
+
+	def analyze(self):
+		""" Returns the Analysis of the expression, worked out the first time
+			it's asked for
+		"""
+		if self._analysis is None:
+			self._analysis = analyze_code(self._code)
+		return self._analysis
+
+	def evaluate(self, environment={}, fail_silently=True):
+		""" Evaluates the expression against the environment, which can also
+			be a mapping or callable looking names up on demand
+		"""
+		if self._code is None:
+			return None
+		if type(environment) is not dict:
+			environment = as_environment(environment)
+		if instrumentation.hook is not None:
+			return instrumentation.evaluate(self._run, self._expr, environment,
+				fail_silently)
+		if self._function is not None:
+			return self._function(environment, fail_silently)
+		return run(self._code, environment, fail_silently)
+
+	def _run(self, environment, fail_silently):
+		if self._function is not None:
+			return self._function(environment, fail_silently)
+		return run(self._code, environment, fail_silently)
+
+	def disassemble(self):
+		""" Returns the instructions the expression is evaluated with
+		"""
+		if self._code is None:
+			return None
+		return disassemble(self._code)
+
+	async def evaluate_async(self, environment={}, fail_silently=True):
+		""" Evaluates the expression, awaiting coroutine functions in the
+			environment and running independent calls concurrently
+		"""
+		if self._code is None:
+			return None
+		if not self.analyze().functions:
+			# there is nothing to await
+			if type(environment) is not dict:
+				environment = as_environment(environment)
+			return run(self._code, environment, fail_silently)
+		if self._plan is None:
+			self._plan = AsyncPlan(self._kept_tree())
+		return await self._plan.evaluate(environment, fail_silently)
+
+	def dump(self):
+		""" Returns the expression as it will be evaluated, after optimizing
+		"""
+		if self._code is None:
+			return None
+		return to_source(self.tree)
+
+	def evaluate_many(self, environments, fail_silently=True, collect_errors=False):
+		""" Lazily evaluates the expression against each environment in turn.
+			With collect_errors, an environment that fails to evaluate yields
+			an EvaluationError in place of its result instead of raising.
+		"""
+		evaluate = self.evaluate
+		for index, environment in enumerate(environments):
+			if not collect_errors:
+				yield evaluate(environment, fail_silently)
+				continue
+			try:
+				yield evaluate(environment, fail_silently)
+			except ROW_ERRORS as e:
+				yield EvaluationError("Environment %s failed to evaluate: %s" % 
+					(index, e), index, e)
+
+	def evaluate_columns(self, columns, environment={}, fail_silently=True):
+		""" Evaluates the expression over columns of NumPy arrays, returning 
+			an array with one result per row. Division by zero raises
+			ZeroDivisionError as it does evaluating each row.
+		"""
+		if self._code is None:
+			return None
+		return evaluate_tree_columns(self._kept_tree(), columns, environment, fail_silently)
+
+	def __reduce__(self):
+		# generated functions can't be pickled, so they are rebuilt on load
+		return (_build_compiled, (self._expr, self.tree, self._function is not None))
+
+	def __repr__(self):
+		return "CompiledExpression(%r)" % self._expr
+
+# The modules providing parse_tree for each parser
+PARSERS = {
+	"pyparsing" : "yapp.grammar",
+	"pratt" : "yapp.pratt",
 }
+_default_parser = "pyparsing"
 
-VARIABLE_REGEX = '^[a-zA-Z][a-zA-Z0-9_]*$'
-
-def reduce_stack(stack, environment={}, fail_silently=True):
-	""" Reduces what's currently on the stack to a value
+def set_default_parser(parser):
+	""" Chooses the parser compile uses when it isn't given one. The pratt
+		parser is much faster and doesn't import pyparsing.
+	"""
+	global _default_parser
+	if parser not in PARSERS:
+		raise ValueError("Unknown parser %r" % (parser,))
+	_default_parser = parser
+
+def parse_tree(expr, parser=None):
+	""" Parses expr into a tree using parser, raising ParseError if it isn't 
+		valid
+	"""
+	module = importlib.import_module(PARSERS[parser or _default_parser])
+	return instrumentation.timed("parse", expr, module.parse_tree, expr)
+
+def compile(expr, fail_silently=True, codegen=False, optimize=True, parser=None):
+	""" Parses the expr once and returns a CompiledExpression that can be
+		evaluated repeatedly. Unless optimize is False the parsed tree is
+		simplified first. With codegen the expression is also compiled to a
+		Python function, falling back to walking the tree if that fails.
+	"""
+	try:
+		tree = parse_tree(expr, parser)
+	except ParseError:
+		if not fail_silently:
+			raise
+		tree = None
+	if optimize and tree is not None:
+		tree = instrumentation.timed("optimize", expr, optimize_tree, tree)
+	return _build_compiled(expr, tree, codegen)
+
+def _build_compiled(expr, tree, codegen):
+	function = None
+	code = None
+	if codegen and tree is not None:
+		try:
+			function = instrumentation.timed("codegen", expr, generate_function, tree)
+		except CodegenError:
+			pass
+	if tree is not None:
+		code = instrumentation.timed("assemble", expr, assemble, tree)
+	return CompiledExpression(expr, tree, function, code)
+
+def specialize(expr, environment, codegen=False):
+	""" Returns a CompiledExpression of expr, a string or compiled
+		expression, for environments that include environment. The values
+		environment gives are bound ahead of time and everything that becomes
+		constant is folded, so evaluating it only works out what's left.
+		Functions that weren't folded away still have to be in the
+		environments it's evaluated against.
+	"""
+	if not isinstance(expr, CompiledExpression):
+		expr = expression_cache.get(expr, fail_silently=False)
+	tree = specialize_tree(expr.tree, environment)
+	return _build_compiled(to_source(tree), tree, codegen)
+
+def specialize_rules(rules, environment, codegen=False):
+	""" Specializes each of rules, a dict mapping names to expressions, for
+		environment. Rules that become False are left out, since they can
+		never hold.
 	"""
-	op = stack.pop()
-	if str(op).startswith("'") and str(op).endswith("'"):
-		return op[1:-1] # remove the quotes
-	elif str(op).startswith("["):
-		l = []
-		op = op[1:-1]
-		list_len = len(op)
-		for i in range(list_len):
-			l.append(reduce_stack(stack, environment, fail_silently))
-		l.reverse()
-		return l
-	elif op in op_map.keys():
-		op2 = reduce_stack(stack, environment, fail_silently)
-		op1 = reduce_stack(stack, environment, fail_silently)
-		return op_map[op](op1, op2)
-	elif re.search(VARIABLE_REGEX, str(op)):
-		if op in environment:
-			val = environment.get(op)
-			if inspect.ismethod(val) or inspect.isfunction(val):
-				argspec = inspect.getargspec(val)
-				args = []
-				num_args = len(argspec.args)
-				for i in range(num_args):
-					args.append(reduce_stack(stack, environment, fail_silently))
-				args.reverse()
-				return val(*args)
-			return val
-		else:
-			if not fail_silently:
-				raise VariableMissingException("Variable %s is not in the environment" % op, op)
-	return op
+	specialized = {}
+	for name, expr in rules.items():
+		compiled = specialize(expr, environment, codegen)
+		tree = compiled.tree
+		if isinstance(tree, Constant) and tree.value is False:
+			continue
+		specialized[name] = compiled
+	return specialized
+
+# Compiled expressions shared by parse and the functions evaluating them
+expression_cache = ExpressionCache(compile, maxsize=1024)
+
+def _compile_as_written(expr, fail_silently=True):
+	return compile(expr, fail_silently, optimize=False)
+
+# The same expressions compiled without optimizing, for analyze, is_valid
+# and get_variables, so they report names in branches the optimizer drops
+# such as the typo in 'False and typo(x)'
+analysis_cache = ExpressionCache(_compile_as_written, maxsize=1024)
 
 def parse(expr, environment={}, fail_silently=True):
-	full_environment = function_map.copy()
-	full_environment.update(environment)
-	stack = []
-	def append_tokens(s, l, tokens):
-		stack.append(tokens[0])
+	compiled = expression_cache.get(expr, fail_silently)
+	return compiled.evaluate(environment, fail_silently)
 
-	def convert_int(s, l, tokens):
-		stack.append(int(tokens[0]))
-
-	def convert_decimal(s, l, tokens):
-		stack.append(float(tokens[0]))
-
-	def convert_string(s, l, tokens):
-		stack.append(tokens[0])
-
-	def append_list(s, l, tokens):
-		stack.append(tokens)
-
-	def save_ident(s, l, tokens):
-		stack.append(tokens[0])
-
-	def save_boolean(s, l, tokens):
-		stack.append(eval(tokens[0]))
+async def evaluate_async(expr, environment={}, fail_silently=True):
+	""" Evaluates expr with asyncio, so environment functions can be
+		coroutine functions. Calls that don't depend on each other run
+		concurrently.
+	"""
+	compiled = expression_cache.get(expr, fail_silently)
+	return await compiled.evaluate_async(environment, fail_silently)
 
-	grammar = get_grammar(
-		append_tokens, 
-		convert_int,
-		convert_decimal,
-		convert_string,
-		save_ident,
-		append_list,
-		save_boolean)
+def evaluate_many(expr, environments, fail_silently=True, collect_errors=False):
+	""" Parses expr once and lazily yields its value for each environment in
+		environments, which can be any iterable including a generator.
+	"""
+	compiled = expression_cache.get(expr, fail_silently)
+	return compiled.evaluate_many(environments, fail_silently, collect_errors)
 
-	try:
-		result = grammar.parseString(expr)
-	except pyparsing.ParseException as e:
-		if not fail_silently:
-			msg = "There was an error in your expr %s at line %s, col %s" % \
-				(expr, e.lineno, e.col)
-			raise ParseError(msg, expr, e.line, e.col, e.lineno)
-	value = reduce_stack(stack, environment=full_environment, 
-		fail_silently=fail_silently)
-	return value
+def evaluate_columns(expr, columns, environment={}, fail_silently=True):
+	""" Evaluates expr over columns, a dict mapping variable names to equally
+		long NumPy arrays, and returns an array with one result per row.
+	"""
+	compiled = expression_cache.get(expr, fail_silently)
+	return compiled.evaluate_columns(columns, environment, fail_silently)
+
+def analyze(expr):
+	""" Returns an Analysis of the variables, functions and constants expr
+		uses as written, and whether it's valid. It comes from a cache of
+		compiled expressions, so analyzing the same expression again costs
+		next to nothing.
+	"""
+	compiled, error = analysis_cache.entry(expr)
+	if error is not None:
+		return compiled.analyze()._replace(error=error)
+	return compiled.analyze()
+
+def required_variables(exprs):
+	""" Returns the variables any of exprs use, each once, so they can be
+		fetched together before evaluating them
+	"""
+	names = []
+	seen = set()
+	for expr in exprs:
+		for name in analyze(expr).variables:
+			if name not in seen:
+				seen.add(name)
+				names.append(name)
+	return names
 
 def is_valid(expr, environment={}):
 	""" Returns True if the expr is syntatically correct and all the variables 
 		exist.
 	"""
-	grammar = get_grammar()
-	full_environment = function_map.copy()
-	full_environment.update(environment)
-	try:
-		result = grammar.parseString(expr)
-		for token in result:
-			if re.search(VARIABLE_REGEX, token):
-				if token not in full_environment:
-					return False
-	except pyparsing.ParseException as e:
-		return False
-	return True
+	analysis = analyze(expr)
+	return analysis.valid and not analysis.missing(environment)
 
 def get_variables(expr, environment={}, exclude_functions=True):
-	""" Returns a list of the variables in the expr 
+	""" Returns a list of the variables in the expr, in the order they are
+		used. With exclude_functions, names the environment or the builtin 
+		functions provide a callable for are left out.
 	"""
 	varlist = []
-	grammar = get_grammar()
-	full_environment = function_map.copy()
-	full_environment.update(environment)
-	try:
-		result = grammar.parseString(expr)
-		for token in result:
-			if re.search(VARIABLE_REGEX, token):
-				var = full_environment.get(token)
-				if (inspect.isfunction(var) or inspect.ismethod(var))  and exclude_functions:
-					continue
-				varlist.append(token)
-	except pyparsing.ParseException as e:
-		pass
+	for name in analysis_cache.get(expr).names():
+		if exclude_functions and callable(lookup(name, environment)):
+			continue
+		varlist.append(name)
 	return varlist
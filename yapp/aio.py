@@ -0,0 +1,195 @@
+""" Evaluates parsed expressions with asyncio, so environment functions can
+	be coroutine functions and independent calls wait on each other's I/O
+	concurrently.
+
+	Operands that don't depend on each other, such as the two sides of +
+	or the arguments of a call, are evaluated together. and and or still
+	only evaluate their right operand when it's needed, so it waits for
+	the left one. Errors are raised in the order evaluating the expression
+	one step at a time would have raised them: operators are applied left
+	to right as their operands arrive, and the first operand or operator
+	to fail cancels the operands still being evaluated. Calls in those may
+	already have started, where evaluating in order wouldn't have reached
+	them.
+	Subtrees without calls can't wait on anything and are evaluated
+	straight away. An AsyncPlan works out which those are, and assembles
+	their instructions, once for every evaluation of a tree.
+"""
+import asyncio
+import inspect
+
+from yapp.bytecode import assemble, run
+from yapp.evaluator import op_map, function_map, lookup_function, resolve, call, \
+	MISSING, SHORT_CIRCUIT
+from yapp.environment import as_environment
+from yapp.nodes import Call, BinOp, transform
+
+class _Failed(object):
+	""" Stands in for the value of an operand that raised
+	"""
+	__slots__ = ("error",)
+
+	def __init__(self, error):
+		self.error = error
+
+def _decides(op, value):
+	return (op == "and" and not value) or (op == "or" and value)
+
+def _apply(op, left, right):
+	if op in op_map:
+		return op_map[op](left, right)
+	return function_map[op](left, right)
+
+def _cancel(tasks):
+	""" Cancels the tasks that haven't finished, and takes the errors of the
+		ones that failed without being awaited so asyncio doesn't log them
+	"""
+	for task in tasks:
+		if task is None:
+			continue
+		elif not task.done():
+			task.cancel()
+		elif not task.cancelled():
+			task.exception()
+
+class AsyncPlan(object):
+	""" What evaluating tree asynchronously needs to know about it, worked
+		out once however many times it's evaluated
+	"""
+	def __init__(self, tree):
+		self.tree = tree
+		# the nodes with a call somewhere below them, by id
+		self.calls = set()
+		def find_calls(node, children):
+			if isinstance(node, Call) or any(children):
+				self.calls.add(id(node))
+				return True
+			return False
+		transform(tree, find_calls)
+		self._codes = {} # instructions of the subtrees without calls, by id
+
+	def run(self, node, environment, fail_silently):
+		""" Evaluates node, which has no calls, straight away
+		"""
+		code = self._codes.get(id(node))
+		if code is None:
+			code = self._codes[id(node)] = assemble(node)
+		return run(code, environment, fail_silently)
+
+	async def evaluate(self, environment={}, fail_silently=True):
+		""" Reduces the tree to a value, awaiting environment functions that
+			return awaitables
+		"""
+		environment = as_environment(environment)
+		if id(self.tree) not in self.calls:
+			return self.run(self.tree, environment, fail_silently)
+		return await _Evaluation(self, environment, fail_silently).evaluate(self.tree)
+
+class _Evaluation(object):
+	def __init__(self, plan, environment, fail_silently):
+		self.plan = plan
+		self.calls = plan.calls
+		self.environment = environment
+		self.fail_silently = fail_silently
+
+	async def evaluate(self, node):
+		if id(node) not in self.calls:
+			return self.plan.run(node, self.environment, self.fail_silently)
+		elif isinstance(node, BinOp):
+			return await self.chain(node)
+		elif isinstance(node, Call):
+			return await self.call(node)
+		return await self.all(node.children())
+
+	async def all(self, nodes):
+		""" Returns the values of nodes, evaluating the ones with calls
+			concurrently
+		"""
+		values = [None] * len(nodes)
+		waiting = []
+		indexes = []
+		for index, node in enumerate(nodes):
+			if id(node) in self.calls:
+				waiting.append(self.evaluate(node))
+				indexes.append(index)
+				continue
+			try:
+				values[index] = self.plan.run(node, self.environment, self.fail_silently)
+			except Exception as e:
+				values[index] = _Failed(e)
+		if waiting:
+			results = await asyncio.gather(*waiting, return_exceptions=True)
+			for index, result in zip(indexes, results):
+				values[index] = _Failed(result) if isinstance(result, Exception) else result
+		for value in values:
+			if isinstance(value, _Failed):
+				raise value.error
+		return values
+
+	async def chain(self, node):
+		""" Evaluates a chain of operators down the left of node in a loop,
+			evaluating the right operands of each run of operators that
+			aren't and or or together, and applying the operators in order
+			as they arrive
+		"""
+		spine = []
+		while isinstance(node, BinOp) and id(node) in self.calls:
+			spine.append(node)
+			node = node.left
+		spine.reverse()
+		leftmost = node
+		value = MISSING
+		position = 0
+		while position < len(spine):
+			op = spine[position].op
+			if op in SHORT_CIRCUIT:
+				if value is MISSING:
+					value = await self.evaluate(leftmost)
+				if not _decides(op, value):
+					value = await self.evaluate(spine[position].right)
+				position += 1
+				continue
+			end = position
+			while end < len(spine) and spine[end].op not in SHORT_CIRCUIT:
+				end += 1
+			ops = [binop.op for binop in spine[position:end]]
+			operands = [binop.right for binop in spine[position:end]]
+			if value is MISSING:
+				ops.insert(0, None)
+				operands.insert(0, leftmost)
+			tasks = [asyncio.ensure_future(self.evaluate(operand))
+				if id(operand) in self.calls else None for operand in operands]
+			try:
+				for op, operand, task in zip(ops, operands, tasks):
+					if task is None:
+						right = self.plan.run(operand, self.environment, self.fail_silently)
+					else:
+						right = await task
+					value = right if op is None else _apply(op, value, right)
+			finally:
+				_cancel(tasks)
+			position = end
+		return value
+
+	async def call(self, node):
+		func = lookup_function(node.name, self.environment)
+		if func is MISSING:
+			return resolve(node.name, self.environment, self.fail_silently)
+		elif not callable(func):
+			return func
+		elif node.name in SHORT_CIRCUIT and func is function_map[node.name] and \
+				len(node.args) == 2:
+			value = await self.evaluate(node.args[0])
+			if _decides(node.name, value):
+				return value
+			return await self.evaluate(node.args[1])
+		value = call(func, await self.all(node.args))
+		if inspect.isawaitable(value):
+			value = await value
+		return value
+
+async def evaluate_tree_async(tree, environment={}, fail_silently=True):
+	""" Reduces a parsed expression to a value, awaiting environment
+		functions that return awaitables
+	"""
+	return await AsyncPlan(tree).evaluate(environment, fail_silently)
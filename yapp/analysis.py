@@ -0,0 +1,92 @@
+""" What an expression uses, read off its compiled instructions without
+	evaluating anything.
+"""
+from collections import namedtuple
+
+from yapp.bytecode import NAME, FUNC, CONST
+from yapp.evaluator import lookup, lookup_function, MISSING
+from yapp.functions import accepts
+from yapp.nodes import LiteralSet
+
+_Analysis = namedtuple("Analysis", "valid error variables functions constants")
+
+class Analysis(_Analysis):
+	""" The names and values an expression uses, in the order they first
+		appear. yapp.analyze reports them as written; the analysis of a
+		CompiledExpression is of what's left after optimizing:
+
+		- valid: whether it parsed, with the ParseError in error if not
+		- variables: the names used as values
+		- functions: (name, number of arguments) for each call
+		- constants: the literal values, with the items of literal lists
+		  passed to in() listed individually
+	"""
+	__slots__ = ()
+
+	def missing(self, environment={}):
+		""" Returns the variables and functions that neither environment nor
+			the builtin functions provide
+		"""
+		missing = [name for name in self.variables if lookup(name, environment) is MISSING]
+		for name, arity in self.functions:
+			if name not in self.variables and name not in missing and \
+					lookup_function(name, environment) is MISSING:
+				missing.append(name)
+		return tuple(missing)
+
+	def arity_errors(self, environment={}):
+		""" Returns the (name, number of arguments) of the calls the
+			function environment or the builtins provide can't take
+		"""
+		errors = []
+		for name, count in self.functions:
+			func = lookup_function(name, environment)
+			if callable(func) and not accepts(func, count):
+				errors.append((name, count))
+		return tuple(errors)
+
+def _add(found, seen, value):
+	# 1, 1.0 and True are equal but are different constants
+	key = (type(value), value)
+	if key not in seen:
+		seen.add(key)
+		found.append(value)
+
+def _unique():
+	""" Returns a list and a function adding values to it only once
+	"""
+	found = []
+	seen = set()
+	return found, lambda value: _add(found, seen, value)
+
+def analyze_code(code):
+	""" Returns the Analysis of an expression that compiled to code, which is
+		None if it didn't parse
+	"""
+	if code is None:
+		return Analysis(False, None, (), (), ())
+	values = code.values
+	opcodes = code.opcodes
+	operands = code.operands
+	variables, add_variable = _unique()
+	functions, add_function = _unique()
+	constants, add_constant = _unique()
+	for index, opcode in enumerate(opcodes):
+		if opcode == NAME:
+			add_variable(values[operands[2 * index]])
+		elif opcode == FUNC:
+			# the call it jumps past is the one taking its arguments
+			call = operands[2 * index + 1] - 1
+			function = (values[operands[2 * index]], operands[2 * call])
+			add_function(function)
+		elif opcode == CONST:
+			value = values[operands[2 * index]]
+			if isinstance(value, LiteralSet):
+				for item in value.items:
+					add_constant(item)
+			elif isinstance(value, frozenset):
+				for item in sorted(value, key=repr):
+					add_constant(item)
+			else:
+				add_constant(value)
+	return Analysis(True, None, tuple(variables), tuple(functions), tuple(constants))
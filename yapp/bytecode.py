@@ -0,0 +1,323 @@
+""" Flattens parsed expressions into instructions for a stack machine and
+	runs them in a loop, so neither step recurses however deeply the tree is
+	nested.
+
+	Instructions are stored compactly in a Code object: one byte for each
+	opcode and two ints for its operands, an argument and the index jumped
+	to by the instructions that jump. The constants, names and operators an
+	expression uses are kept once in a tuple on its Code and referred to by
+	their index in it. Strings are interned, so rules that use the same
+	names share them, and everything else goes away with the last Code
+	using it.
+"""
+import sys
+from array import array
+
+from yapp.evaluator import op_map, function_map, resolve, variable, MISSING, \
+	SHORT_CIRCUIT, CALLED_BY_NAME
+from yapp.nodes import Constant, Name, List, Call, BinOp, LiteralSet, value_key
+
+# Opcodes, with what their argument refers to
+CONST = 0 # push value arg
+NAME = 1 # push the value of the variable named by value arg
+BINOP = 2 # pop two values, push operator value arg applied to them
+LIST = 3 # pop arg values, push them as a list
+FUNC = 4 # push function value arg, or push its value and jump if it can't be called
+CALL = 5 # pop arg values and a function, push the result of calling it
+JUMP_IF_FALSE_OR_POP = 6 # for and: keep the top and jump if it's false
+JUMP_IF_TRUE_OR_POP = 7 # for or: keep the top and jump if it's true
+JUMP_IF_DECIDED = 8 # for and()/or() named by value arg: return the first argument and jump if it decides
+MEMO_GET = 9 # push the value memoized in slot arg and jump, if there is one
+MEMO_PUT = 10 # memoize the top in slot arg
+
+OPCODE_NAMES = ("CONST", "NAME", "BINOP", "LIST", "FUNC", "CALL",
+	"JUMP_IF_FALSE_OR_POP", "JUMP_IF_TRUE_OR_POP", "JUMP_IF_DECIDED",
+	"MEMO_GET", "MEMO_PUT")
+
+# Opcodes whose argument is an index into the values of the Code
+_INDEXED = (CONST, NAME, BINOP, FUNC, JUMP_IF_DECIDED)
+
+class Code(object):
+	""" The instructions for one expression
+	"""
+	__slots__ = ("opcodes", "operands", "values")
+
+	def __init__(self, opcodes, operands, values):
+		self.opcodes = opcodes # array('B'), one per instruction
+		self.operands = operands # array('i'), an argument and a target per instruction
+		self.values = values # tuple of the values the arguments refer to
+
+	def __len__(self):
+		return len(self.opcodes)
+
+	def instructions(self):
+		""" Yields (opcode, arg, target) for each instruction, with the
+			values arguments refer to looked up
+		"""
+		values = self.values
+		operands = self.operands
+		for index, opcode in enumerate(self.opcodes):
+			arg = operands[2 * index]
+			if opcode in _INDEXED:
+				arg = values[arg]
+			yield opcode, arg, operands[2 * index + 1]
+
+	def names(self):
+		""" Yields the variable and function names used in source order
+		"""
+		for opcode, arg, target in self.instructions():
+			if opcode in (NAME, FUNC):
+				yield arg
+
+	def nbytes(self):
+		""" The memory taken by the instructions and the tuple of their
+			values, not counting the values themselves
+		"""
+		return sys.getsizeof(self) + sys.getsizeof(self.opcodes) + \
+			sys.getsizeof(self.operands) + sys.getsizeof(self.values)
+
+	def __reduce__(self):
+		return (Code, (self.opcodes, self.operands, self.values))
+
+# Assembler work items
+_VISIT = 0
+_EMIT = 1
+_JUMP = 2
+_PATCH = 3
+
+def assemble(tree, slots=None):
+	""" Returns the Code evaluating tree. When slots is given, a dict, each
+		node that isn't a constant or a name is memoized in the slot it's
+		given in slots under its id.
+	"""
+	values = []
+	indexes = {}
+	def index(value):
+		key = value_key(value)
+		found = indexes.get(key)
+		if found is None:
+			if isinstance(value, str):
+				value = sys.intern(value)
+			found = indexes[key] = len(values)
+			values.append(value)
+		return found
+	# built as lists, so the arrays are allocated at their exact size
+	opcodes = []
+	operands = []
+	pending = [(_VISIT, tree)]
+	while pending:
+		action, item = pending.pop()
+		if action == _EMIT:
+			opcode, arg = item
+			opcodes.append(opcode)
+			operands.extend((arg, 0))
+			continue
+		elif action == _JUMP:
+			opcode, arg, label = item
+			label.append(len(opcodes))
+			opcodes.append(opcode)
+			operands.extend((arg, 0))
+			continue
+		elif action == _PATCH:
+			for position in item:
+				operands[2 * position + 1] = len(opcodes)
+			continue
+
+		node = item
+		if isinstance(node, Constant):
+			opcodes.append(CONST)
+			operands.extend((index(node.value), 0))
+			continue
+		elif isinstance(node, Name):
+			opcodes.append(NAME)
+			operands.extend((index(node.name), 0))
+			continue
+
+		# pending is a stack, so everything below is pushed in reverse
+		if slots is not None:
+			slot = slots.setdefault(id(node), len(slots))
+			label = []
+			pending.append((_PATCH, label))
+			pending.append((_EMIT, (MEMO_PUT, slot)))
+		if isinstance(node, List):
+			pending.append((_EMIT, (LIST, len(node.items))))
+			pending.extend((_VISIT, child) for child in reversed(node.items))
+		elif isinstance(node, BinOp) and node.op in SHORT_CIRCUIT:
+			end = []
+			opcode = JUMP_IF_FALSE_OR_POP if node.op == "and" else JUMP_IF_TRUE_OR_POP
+			pending.append((_PATCH, end))
+			pending.append((_VISIT, node.right))
+			pending.append((_JUMP, (opcode, 0, end)))
+			pending.append((_VISIT, node.left))
+		elif isinstance(node, BinOp):
+			pending.append((_EMIT, (BINOP, index(node.op))))
+			pending.append((_VISIT, node.right))
+			pending.append((_VISIT, node.left))
+		elif isinstance(node, Call):
+			end = []
+			pending.append((_PATCH, end))
+			pending.append((_EMIT, (CALL, len(node.args))))
+			args = list(node.args)
+			if node.name in SHORT_CIRCUIT and len(args) == 2:
+				pending.append((_VISIT, args[1]))
+				pending.append((_JUMP, (JUMP_IF_DECIDED, index(node.name), end)))
+				args = args[:1]
+			pending.extend((_VISIT, arg) for arg in reversed(args))
+			pending.append((_JUMP, (FUNC, index(node.name), end)))
+		else:
+			raise TypeError("Unknown node %r" % (node,))
+		if slots is not None:
+			pending.append((_JUMP, (MEMO_GET, slot, label)))
+	return Code(array("B", opcodes), array("i", operands), tuple(values))
+
+def run(code, environment={}, fail_silently=True, memo=None):
+	""" Runs the instructions and returns the value they leave on the stack.
+		memo is a dict of memoized values by slot, needed if the code was
+		assembled with slots.
+	"""
+	values = code.values
+	opcodes = code.opcodes
+	operands = code.operands
+	# how environments with their own way of finding functions look them up
+	function = None if type(environment) is dict else getattr(environment, "function", None)
+	stack = []
+	push = stack.append
+	pop = stack.pop
+	pc = 0
+	end = len(opcodes)
+	while pc < end:
+		opcode = opcodes[pc]
+		arg = operands[2 * pc]
+		pc += 1
+		if opcode == NAME:
+			name = values[arg]
+			if name in environment:
+				value = environment[name]
+				if type(value) in CALLED_BY_NAME:
+					value = variable(value)
+				push(value)
+			else:
+				push(resolve(name, environment, fail_silently))
+		elif opcode == CONST:
+			push(values[arg])
+		elif opcode == BINOP:
+			op2 = pop()
+			op1 = pop()
+			op = values[arg]
+			if op in op_map:
+				push(op_map[op](op1, op2))
+			else:
+				push(function_map[op](op1, op2))
+		elif opcode == JUMP_IF_FALSE_OR_POP:
+			if not stack[-1]:
+				pc = operands[2 * pc - 1]
+			else:
+				pop()
+		elif opcode == JUMP_IF_TRUE_OR_POP:
+			if stack[-1]:
+				pc = operands[2 * pc - 1]
+			else:
+				pop()
+		elif opcode == FUNC:
+			name = values[arg]
+			if function is not None:
+				func = function(name)
+			elif name in environment:
+				func = environment[name]
+			else:
+				func = function_map.get(name, MISSING)
+			if func is MISSING:
+				push(resolve(name, environment, fail_silently))
+				pc = operands[2 * pc - 1]
+			elif not callable(func):
+				push(func)
+				pc = operands[2 * pc - 1]
+			else:
+				push(func)
+		elif opcode == CALL:
+			if arg:
+				args = stack[-arg:]
+				del stack[-arg:]
+			else:
+				args = ()
+			func = pop()
+			if arg == 2 and type(args[1]) is LiteralSet and func is not function_map["in"]:
+				# a function replacing in() is given the list as written
+				args[1] = list(args[1].items)
+			push(func(*args))
+		elif opcode == LIST:
+			if arg:
+				items = stack[-arg:]
+				del stack[-arg:]
+			else:
+				items = []
+			push(items)
+		elif opcode == JUMP_IF_DECIDED:
+			name = values[arg]
+			value = stack[-1]
+			if stack[-2] is function_map[name] and \
+					((name == "and" and not value) or (name == "or" and value)):
+				del stack[-2:]
+				push(value)
+				pc = operands[2 * pc - 1]
+		elif opcode == MEMO_GET:
+			if arg in memo:
+				push(memo[arg])
+				pc = operands[2 * pc - 1]
+		elif opcode == MEMO_PUT:
+			memo[arg] = stack[-1]
+	return stack[-1]
+
+class _Function(object):
+	""" A function whose arguments are being rebuilt by decompile
+	"""
+	__slots__ = ("name",)
+
+	def __init__(self, name):
+		self.name = name
+
+def decompile(code):
+	""" Rebuilds the tree code was assembled from
+	"""
+	stack = []
+	joins = [] # (target, op) of the jumps for and and or still open
+	for index, (opcode, arg, target) in enumerate(code.instructions()):
+		while joins and joins[-1][0] == index:
+			right = stack.pop()
+			stack.append(BinOp(joins.pop()[1], stack.pop(), right))
+		if opcode == CONST:
+			stack.append(Constant(arg))
+		elif opcode == NAME:
+			stack.append(Name(arg))
+		elif opcode == BINOP:
+			right = stack.pop()
+			stack.append(BinOp(arg, stack.pop(), right))
+		elif opcode == LIST:
+			items = stack[len(stack) - arg:]
+			del stack[len(stack) - arg:]
+			stack.append(List(items))
+		elif opcode == FUNC:
+			stack.append(_Function(arg))
+		elif opcode == CALL:
+			args = stack[len(stack) - arg:]
+			del stack[len(stack) - arg:]
+			stack.append(Call(stack.pop().name, args))
+		elif opcode == JUMP_IF_FALSE_OR_POP:
+			joins.append((target, "and"))
+		elif opcode == JUMP_IF_TRUE_OR_POP:
+			joins.append((target, "or"))
+	while joins:
+		right = stack.pop()
+		stack.append(BinOp(joins.pop()[1], stack.pop(), right))
+	return stack[-1]
+
+def disassemble(code):
+	""" Returns the instructions as readable text, one per line
+	"""
+	lines = []
+	for index, (opcode, arg, target) in enumerate(code.instructions()):
+		line = "%4d %-20s %r" % (index, OPCODE_NAMES[opcode], arg)
+		if opcode not in (CONST, NAME, BINOP, LIST, CALL, MEMO_PUT):
+			line += " -> %d" % target
+		lines.append(line)
+	return "\n".join(lines)
@@ -0,0 +1,115 @@
+""" A bounded cache of compiled expressions keyed on the expression string.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from yapp.exceptions import ParseError
+
+CacheStats = namedtuple("CacheStats", "hits misses evictions size maxsize")
+
+class ExpressionCache(object):
+	""" Keeps the most recently used compiled expressions, evicting the least
+		recently used one once maxsize is reached. A maxsize of 0 disables
+		caching.
+
+		It can be shared between threads. Only misses lock, to add the newly
+		compiled expression; two threads missing on the same expression may
+		both compile it.
+	"""
+	def __init__(self, compile_function, maxsize=1024):
+		if maxsize < 0:
+			raise ValueError("maxsize must be 0 or more")
+		self._compile = compile_function
+		self._maxsize = maxsize
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	@property
+	def maxsize(self):
+		return self._maxsize
+
+	@property
+	def size(self):
+		return len(self._entries)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, expr):
+		return expr in self._entries
+
+	def get(self, expr, fail_silently=True):
+		""" Returns the compiled expr, compiling it on a miss. Syntax errors
+			are cached too and raised again when fail_silently is False.
+		"""
+		compiled, error = self.entry(expr)
+		if error is not None and not fail_silently:
+			raise error
+		return compiled
+
+	def entry(self, expr):
+		""" Returns (compiled expr, the ParseError it raised or None),
+			compiling it on a miss
+		"""
+		# A hit takes no lock: a single dict operation is atomic, and an
+		# entry evicted in between just isn't moved. The counters may miss
+		# the odd update when threads race.
+		entry = self._entries.get(expr)
+		if entry is not None:
+			try:
+				self._entries.move_to_end(expr)
+			except KeyError:
+				pass
+			self.hits += 1
+		else:
+			self.misses += 1
+			entry = self._compile_entry(expr)
+			self._store(expr, entry)
+		return entry
+
+	def _compile_entry(self, expr):
+		# yapp imports this module
+		from yapp import CompiledExpression
+		try:
+			return (self._compile(expr, fail_silently=False), None)
+		except ParseError as e:
+			# an expression that failed to parse has nothing else to keep
+			return (CompiledExpression(expr, None), e)
+
+	def _store(self, expr, entry):
+		with self._lock:
+			if self._maxsize == 0:
+				return
+			self._entries[expr] = entry
+			self._entries.move_to_end(expr)
+			self._evict()
+
+	def _evict(self):
+		while len(self._entries) > self._maxsize:
+			self._entries.popitem(last=False)
+			self.evictions += 1
+
+	def resize(self, maxsize):
+		""" Changes the maximum size, evicting entries if needed
+		"""
+		if maxsize < 0:
+			raise ValueError("maxsize must be 0 or more")
+		with self._lock:
+			self._maxsize = maxsize
+			self._evict()
+
+	def clear(self):
+		""" Drops every entry and resets the counters
+		"""
+		with self._lock:
+			self._entries.clear()
+			self.hits = 0
+			self.misses = 0
+			self.evictions = 0
+
+	def stats(self):
+		return CacheStats(self.hits, self.misses, self.evictions,
+			len(self._entries), self._maxsize)
@@ -0,0 +1,143 @@
+""" Translates parsed expressions into Python source and compiles them into
+	native functions.
+
+	The generated function takes ``(environment, fail_silently=True)`` and
+	behaves like evaluate_node, except that operators are Python's own
+	operators rather than lookups in op_map. ^ calls the same power as
+	op_map, so it has the same limit.
+"""
+import math
+
+from yapp.evaluator import function_map, lookup_function, resolve, variable, call, \
+	power, MISSING, SHORT_CIRCUIT
+from yapp.nodes import Constant, Name, List, Call, BinOp
+
+# Python operator and its precedence for each yapp operator apart from ^,
+# which is a call
+_operators = {
+	"or" : ("or", 1),
+	"and" : ("and", 2),
+	"eq" : ("==", 4),
+	">" : (">", 4),
+	"<" : ("<", 4),
+	">=" : (">=", 4),
+	"<=" : ("<=", 4),
+	"+" : ("+", 6),
+	"-" : ("-", 6),
+	"*" : ("*", 7),
+	"/" : ("/", 7),
+	"%" : ("%", 7),
+}
+_COMPARISON = 4
+_ATOM = 10
+
+class CodegenError(Exception):
+	""" Raised when an expression can't be turned into a Python function,
+		e.g. when it is nested too deeply for the Python compiler.
+	"""
+
+def _function(name, environment, fail_silently):
+	""" Returns a callable for a call to name. Values that can't be called
+		and missing functions are returned as is, like evaluate_node does.
+	"""
+	func = lookup_function(name, environment)
+	if func is MISSING:
+		value = resolve(name, environment, fail_silently)
+		return lambda *args: value
+	if not callable(func):
+		return lambda *args: func
+	if name == "in" and func is not function_map["in"]:
+		return lambda *args: call(func, args)
+	return func
+
+def _logical(op, environment, fail_silently, left, right):
+	""" Calls and()/or(), only evaluating right when the outcome depends on it
+		unless the environment replaces the function
+	"""
+	func = lookup_function(op, environment)
+	if func is not function_map[op]:
+		return _function(op, environment, fail_silently)(left, right())
+	if op == "and":
+		return right() if left else left
+	return left if left else right()
+
+def _wrap(source, precedence, minimum):
+	if precedence < minimum:
+		return "(%s)" % source
+	return source
+
+# Constants that can be written out as literals, anything else is passed in
+_LITERALS = (bool, int, float, str)
+
+def _emit(node, constants):
+	""" Returns the source for node and its Python precedence. Constants that
+		can't be written as literals are added to constants.
+	"""
+	if isinstance(node, Constant):
+		if type(node.value) not in _LITERALS or \
+				(isinstance(node.value, float) and not math.isfinite(node.value)):
+			name = "_k%d" % len(constants)
+			constants[name] = node.value
+			return name, _ATOM
+		source = repr(node.value)
+		if isinstance(node.value, (int, float)) and node.value < 0:
+			return "(%s)" % source, _ATOM
+		return source, _ATOM
+	elif isinstance(node, Name):
+		return ("(_variable(env[%r]) if %r in env else _resolve(%r, env, fail_silently))" %
+			(node.name, node.name, node.name)), _ATOM
+	elif isinstance(node, List):
+		return "[%s]" % ", ".join(_emit(item, constants)[0] for item in node.items), _ATOM
+	elif isinstance(node, Call) and node.name in SHORT_CIRCUIT and len(node.args) == 2:
+		left, right = [_emit(arg, constants)[0] for arg in node.args]
+		return ("_logical(%r, env, fail_silently, %s, lambda: %s)" %
+			(node.name, left, right)), _ATOM
+	elif isinstance(node, Call):
+		args = ", ".join(_emit(arg, constants)[0] for arg in node.args)
+		return "_function(%r, env, fail_silently)(%s)" % (node.name, args), _ATOM
+	elif isinstance(node, BinOp):
+		left, left_precedence = _emit(node.left, constants)
+		right, right_precedence = _emit(node.right, constants)
+		if node.op == "^":
+			return "_power(%s, %s)" % (left, right), _ATOM
+		op, precedence = _operators[node.op]
+		# yapp operators are all left associative and Python's comparisons
+		# chain, so parenthesize accordingly
+		left_minimum = precedence
+		right_minimum = precedence + 1
+		if precedence == _COMPARISON:
+			left_minimum = precedence + 1
+		return "%s %s %s" % (_wrap(left, left_precedence, left_minimum), op,
+			_wrap(right, right_precedence, right_minimum)), precedence
+	raise TypeError("Unknown node %r" % (node,))
+
+def _generate(tree):
+	constants = {}
+	body, precedence = _emit(tree, constants)
+	source = "def evaluate(env, fail_silently=True):\n\treturn %s\n" % body
+	return source, constants
+
+def generate_source(tree):
+	""" Returns the source of a Python function evaluating tree
+	"""
+	return _generate(tree)[0]
+
+def generate_function(tree):
+	""" Compiles tree into a Python function taking an environment and
+		fail_silently flag.
+	"""
+	namespace = {
+		"_resolve" : resolve,
+		"_variable" : variable,
+		"_function" : _function,
+		"_logical" : _logical,
+		"_power" : power,
+	}
+	try:
+		source, constants = _generate(tree)
+		code = compile(source, "<yapp>", "exec")
+	except (SyntaxError, RecursionError, MemoryError) as e:
+		raise CodegenError("Unable to compile expression to Python: %s" % e)
+	namespace.update(constants)
+	exec(code, namespace)
+	return namespace["evaluate"]
@@ -0,0 +1,251 @@
+""" A directory of compiled expressions saved in a single pack file per
+	yapp version, so workers can load their rules instead of parsing them.
+
+	The pack is memory mapped read only, so forked workers share its pages
+	and a lookup only touches the entry it needs. It is laid out as:
+
+		magic             b"YAPK"
+		pack version      uint16
+		format version    uint16, of yapp.serialize
+		entries           uint32 count
+		index offset      uint64
+		entries           each saved by yapp.serialize.dumps
+		index             per entry, sorted by key: a 16 byte key, then
+		                  its offset (uint64), length (uint32) and CRC-32
+		                  (uint32)
+
+	Keys hash the expression with the options it was compiled with. A pack
+	of another version is ignored, and so is an entry that falls outside
+	the pack or fails its checksum, which is compiled again instead.
+
+	Packs are only ever replaced whole, by writing a new file and renaming
+	it over the old one, so a worker reading the old one isn't disturbed.
+	flush holds a lock on the directory while it reads the current pack,
+	adds its own entries and writes the result, so workers flushing at the
+	same time don't lose each other's entries. Where fcntl isn't available
+	there is no lock, and only one process should flush to a directory.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from yapp import compile, __version__
+from yapp.exceptions import SerializationError
+from yapp.serialize import dumps, loads, FORMAT_VERSION
+
+MAGIC = b"YAPK"
+PACK_VERSION = 2
+
+_header = struct.Struct("<4sHHIQ")
+_entry = struct.Struct("<16sQII")
+
+def _key(expr, optimize):
+	data = ("%d:%s" % (optimize, expr)).encode("utf-8")
+	return hashlib.blake2b(data, digest_size=16).digest()
+
+@contextmanager
+def _locked(directory):
+	""" Holds an exclusive lock on directory, where fcntl is available
+	"""
+	if fcntl is None:
+		yield
+		return
+	descriptor = os.open(directory, os.O_RDONLY)
+	try:
+		fcntl.flock(descriptor, fcntl.LOCK_EX)
+		yield
+	finally:
+		os.close(descriptor)
+
+class DiskCache(object):
+	""" Compiled expressions saved under directory. compile looks
+		expressions up in the pack, compiling and remembering the ones that
+		are missing until flush writes them out. To use it behind the
+		in-memory cache, give its compile to an ExpressionCache.
+	"""
+	def __init__(self, directory, optimize=True, parser=None):
+		self.directory = directory
+		self.optimize = optimize
+		self.parser = parser
+		self.path = os.path.join(directory, "yapp-%s-%d.pack" % (__version__,
+			FORMAT_VERSION))
+		self._pending = {} # key -> compiled expression not in the pack yet
+		self._lock = threading.Lock()
+		self._map = None
+		self._count = 0
+		self._index = 0
+		self.hits = 0
+		self.misses = 0
+		self._open()
+
+	def _open(self):
+		""" Maps the pack, if there is a readable one. A map that was already
+			open is left to be closed once nothing is reading from it.
+		"""
+		self._map, self._count = None, 0
+		try:
+			with open(self.path, "rb") as pack:
+				data = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+		except (IOError, OSError, ValueError):
+			return
+		try:
+			magic, pack_version, version, count, index = _header.unpack_from(data, 0)
+		except struct.error:
+			magic = None
+		if magic != MAGIC or pack_version != PACK_VERSION or \
+				version != FORMAT_VERSION or index + count * _entry.size > len(data):
+			data.close()
+			return
+		self._map, self._count, self._index = data, count, index
+
+	def _close_map(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+			self._count = 0
+
+	def __len__(self):
+		""" The number of expressions in the pack
+		"""
+		return self._count
+
+	def _data(self, offset, length, checksum):
+		""" Returns the saved bytes of an entry, or None if they fall outside
+			the entries or don't match their checksum
+		"""
+		if offset < _header.size or offset + length > self._index:
+			return None
+		data = memoryview(self._map)[offset:offset + length]
+		if zlib.crc32(data) != checksum:
+			return None
+		return data
+
+	def _find(self, key):
+		""" Returns the saved bytes of key in the pack, or None
+		"""
+		low, high = 0, self._count
+		while low < high:
+			middle = (low + high) // 2
+			found, offset, length, checksum = _entry.unpack_from(self._map,
+				self._index + middle * _entry.size)
+			if found == key:
+				return self._data(offset, length, checksum)
+			elif found < key:
+				low = middle + 1
+			else:
+				high = middle
+		return None
+
+	def get(self, expr, codegen=False):
+		""" Returns the saved compiled expr, or None if it isn't in the cache
+		"""
+		key = _key(expr, self.optimize)
+		compiled = self._pending.get(key)
+		if compiled is not None:
+			return compiled
+		if self._map is None:
+			return None
+		data = self._find(key)
+		if data is None:
+			return None
+		try:
+			compiled = loads(data, codegen)
+		except SerializationError:
+			return None
+		# the key is a hash, so make sure it's the same expression
+		if compiled.expr != expr:
+			return None
+		return compiled
+
+	def compile(self, expr, fail_silently=True, codegen=False):
+		""" Returns the compiled expr from the cache, or compiles it and keeps
+			it to be written by flush. Expressions that don't parse aren't
+			cached.
+		"""
+		compiled = self.get(expr, codegen)
+		if compiled is not None:
+			self.hits += 1
+			return compiled
+		self.misses += 1
+		compiled = compile(expr, fail_silently, codegen=codegen,
+			optimize=self.optimize, parser=self.parser)
+		if compiled.code is not None:
+			with self._lock:
+				self._pending[_key(expr, self.optimize)] = compiled
+		return compiled
+
+	def _entries(self):
+		""" Yields (key, saved bytes) for every sound entry in the pack
+		"""
+		for position in range(self._count):
+			key, offset, length, checksum = _entry.unpack_from(self._map,
+				self._index + position * _entry.size)
+			data = self._data(offset, length, checksum)
+			if data is not None:
+				yield key, bytes(data)
+
+	def flush(self):
+		""" Writes a new pack holding everything in the current one, which
+			another process may have written since this one was opened, and
+			what has been compiled since. Expressions that can't be saved
+			are dropped, and compiled again the next time they're needed.
+		"""
+		with self._lock:
+			if not self._pending:
+				return
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			with _locked(self.directory):
+				self._open()
+				entries = dict(self._entries()) if self._map is not None else {}
+				for key, compiled in self._pending.items():
+					try:
+						entries[key] = dumps(compiled)
+					except SerializationError:
+						pass
+				self._write(entries)
+			self._pending.clear()
+			self._open()
+
+	def _write(self, entries):
+		keys = sorted(entries)
+		descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+		try:
+			with os.fdopen(descriptor, "wb") as pack:
+				offset = _header.size
+				index = []
+				pack.write(b"\0" * _header.size)
+				for key in keys:
+					data = entries[key]
+					pack.write(data)
+					index.append(_entry.pack(key, offset, len(data), zlib.crc32(data)))
+					offset += len(data)
+				pack.write(b"".join(index))
+				pack.seek(0)
+				pack.write(_header.pack(MAGIC, PACK_VERSION, FORMAT_VERSION, len(keys),
+					offset))
+				pack.flush()
+				os.fsync(pack.fileno())
+			os.replace(temporary, self.path)
+		except BaseException:
+			os.unlink(temporary)
+			raise
+
+	def close(self):
+		self._close_map()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
@@ -0,0 +1,107 @@
+""" Environments whose values are only looked up when an expression uses
+	them.
+"""
+from collections.abc import Mapping
+
+from yapp.evaluator import function_map, MISSING
+
+class LazyEnvironment(Mapping):
+	""" An environment that asks resolver for each name the first time it's
+		used, and remembers the answer, including that a name doesn't exist.
+
+		resolver is a Mapping, or a callable taking a name and returning its
+		value or raising KeyError. Names in environment are used as they
+		are, without asking the resolver. bulk, if given, is called by
+		prefetch with a list of names and returns a dict of the values it
+		found.
+
+		Calls to builtin functions such as in() and not() use the builtin
+		unless environment replaces it. With resolve_builtins, the resolver
+		is asked about them too, so it can replace them.
+	"""
+	def __init__(self, resolver, environment={}, bulk=None, resolve_builtins=False):
+		if isinstance(resolver, Mapping):
+			resolver = resolver.__getitem__
+		self._resolver = resolver
+		self._environment = environment
+		self._bulk = bulk
+		self.resolve_builtins = resolve_builtins
+		self._values = {}
+		self.resolved = 0 # how many names were asked for
+
+	def _resolve(self, name):
+		value = self._values.get(name, MISSING)
+		if value is MISSING and name not in self._values:
+			self.resolved += 1
+			try:
+				value = self._resolver(name)
+			except KeyError:
+				value = MISSING
+			self._values[name] = value
+		return value
+
+	def __getitem__(self, name):
+		if name in self._environment:
+			return self._environment[name]
+		value = self._resolve(name)
+		if value is MISSING:
+			raise KeyError(name)
+		return value
+
+	def __contains__(self, name):
+		return name in self._environment or self._resolve(name) is not MISSING
+
+	def function(self, name):
+		""" Returns the function called name, or MISSING
+		"""
+		if name in self._environment:
+			return self._environment[name]
+		elif name in function_map and not self.resolve_builtins:
+			return function_map[name]
+		value = self._resolve(name)
+		if value is MISSING:
+			return function_map.get(name, MISSING)
+		return value
+
+	def __iter__(self):
+		""" Iterates over the names given in environment or already resolved,
+			since the resolver can't list its names
+		"""
+		for name in self._environment:
+			yield name
+		for name, value in self._values.items():
+			if value is not MISSING and name not in self._environment:
+				yield name
+
+	def __len__(self):
+		return sum(1 for name in self)
+
+	def prefetch(self, names):
+		""" Resolves the names not known yet with a single call to bulk. Names
+			bulk leaves out are taken not to exist. Without bulk each name is
+			resolved in turn.
+		"""
+		names = [name for name in names
+			if name not in self._environment and name not in self._values]
+		if not names:
+			return
+		if self._bulk is None:
+			for name in names:
+				self._resolve(name)
+			return
+		self.resolved += len(names)
+		found = self._bulk(names)
+		for name in names:
+			self._values[name] = found.get(name, MISSING)
+
+	def __repr__(self):
+		return "LazyEnvironment(%r)" % (self._resolver,)
+
+def as_environment(environment):
+	""" Returns environment ready to be evaluated against. Dicts are used as
+		they are, while other mappings and callables are wrapped in a
+		LazyEnvironment so each name is looked up at most once.
+	"""
+	if isinstance(environment, (dict, LazyEnvironment)):
+		return environment
+	return LazyEnvironment(environment)
@@ -0,0 +1,120 @@
+""" The operators and functions expressions can use, and evaluation of
+	parsed expressions.
+"""
+import math
+from types import FunctionType, MethodType
+
+from yapp.exceptions import VariableMissingException
+from yapp.functions import accepts
+from yapp.nodes import LiteralSet
+
+# The most bits ^ makes an int of. Working out 9 ^ 999999999 would keep a
+# process busy for a very long time, so anything bigger raises
+# OverflowError, as a float that's too big already does.
+MAX_POWER_BITS = 1 << 20 # about 315000 digits
+
+def power_bits(base, exponent):
+	""" Estimates the bits in base ^ exponent for an int base and exponent,
+		0 for anything else or if it can't grow
+	"""
+	if isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and \
+			abs(base) > 1:
+		return exponent * math.log2(abs(base))
+	return 0
+
+def power(base, exponent):
+	""" base ^ exponent, raising OverflowError if it's too big an int
+	"""
+	if power_bits(base, exponent) > MAX_POWER_BITS:
+		raise OverflowError("^ would give an int of more than %d bits" % MAX_POWER_BITS)
+	return base ** exponent
+
+op_map = {
+	"+" : lambda a,b: a + b,
+	"-" : lambda a,b: a - b,
+	"*" : lambda a,b: a * b,
+	"/" : lambda a,b: a / b,
+	"%" : lambda a,b: a % b,
+	"^" : power,
+	">" : lambda a,b : a > b,
+	"<" : lambda a,b : a < b,
+	">=" : lambda a,b : a >= b,
+	"<=" : lambda a,b : a <= b,
+}
+
+
+function_map = {
+	"not" : lambda x: not x,
+	"eq" : lambda x,y : x == y,
+	"in" : lambda x,y : x in y,
+	"and" : lambda a,b : a and b,
+	"or" : lambda a,b : a or b
+}
+
+# Operators whose right operand is only evaluated when it's needed
+SHORT_CIRCUIT = ("and", "or")
+
+MISSING = object()
+
+def lookup(name, environment):
+	""" Looks name up in the environment, falling back to the function_map
+	"""
+	if name in environment:
+		return environment[name]
+	return function_map.get(name, MISSING)
+
+# The values a variable calls to get its value, as yapp always has
+CALLED_BY_NAME = (FunctionType, MethodType)
+
+def variable(value):
+	""" Returns the value of a variable the environment gives value for.
+		Python functions and methods that can be called without arguments
+		are called, so a bare name can stand for a value worked out when
+		it's used. Other callables, and functions that need arguments, are
+		the value themselves.
+	"""
+	if type(value) in CALLED_BY_NAME and accepts(value, 0):
+		return value()
+	return value
+
+def lookup_function(name, environment):
+	""" Looks up name where it's called as a function. Environments with a
+		function method, such as LazyEnvironment, look those names up
+		themselves.
+	"""
+	function = getattr(environment, "function", None)
+	if function is not None:
+		return function(name)
+	return lookup(name, environment)
+
+def resolve(name, environment, fail_silently):
+	value = lookup(name, environment)
+	if value is MISSING:
+		if not fail_silently:
+			raise VariableMissingException("Variable %s is not in the environment" % name, name)
+		return name
+	return value
+
+def call(func, args):
+	""" Calls func with args. A function replacing in() is given the literal
+		list the optimizer turned into a LiteralSet back as a list.
+	"""
+	if len(args) == 2 and type(args[1]) is LiteralSet and func is not function_map["in"]:
+		args = [args[0], list(args[1].items)]
+	return func(*args)
+
+# Where evaluate_node keeps the memo slots it gave each node
+_SLOTS = object()
+
+def evaluate_node(node, environment={}, fail_silently=True, memo=None):
+	""" Reduces a parsed expression to a value. When a memo dict is given,
+		each node object is only evaluated once for all the calls sharing it.
+
+		The tree is assembled into instructions for yapp.bytecode first, so
+		evaluating it again is quicker through a CompiledExpression.
+	"""
+	from yapp.bytecode import assemble, run
+	if memo is None:
+		return run(assemble(node), environment, fail_silently)
+	slots = memo.setdefault(_SLOTS, {})
+	return run(assemble(node, slots), environment, fail_silently, memo)
@@ -5,6 +5,9 @@ class VariableMissingException(Exception):
 		super(VariableMissingException, self).__init__(message)
 		self.name = name
 
+	def __reduce__(self):
+		return (type(self), (self.args[0], self.name))
+
 class ParseError(Exception):
 	""" Thrown when there is a syntax error
 	"""
@@ -14,3 +17,27 @@ class ParseError(Exception):
 		self.lineno = lineno
 		self.col = col
 		self.expr = expr
+
+	def __reduce__(self):
+		return (type(self), (self.args[0], self.expr, self.line, self.col, 
+			self.lineno))
+
+class EvaluationError(Exception):
+	""" Stands in for the result of an environment that failed to evaluate
+		when errors are being collected
+	"""
+	def __init__(self, message, index, error):
+		super(EvaluationError, self).__init__(message)
+		self.index = index
+		self.error = error
+
+	def __reduce__(self):
+		return (type(self), (self.args[0], self.index, self.error))
+
+class SerializationError(Exception):
+	""" Thrown when a compiled expression can't be saved or loaded
+	"""
+	pass
+
+# Errors collected per environment instead of aborting a batch
+ROW_ERRORS = (VariableMissingException, ArithmeticError, TypeError, ValueError)
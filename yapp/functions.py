@@ -0,0 +1,167 @@
+""" Working out how environment functions can be called, and memoizing the
+	ones declared pure.
+"""
+import asyncio
+import functools
+import inspect
+import threading
+import weakref
+from collections import OrderedDict
+
+from yapp.cache import CacheStats
+
+# Arities by function. Functions that can't be weakly referenced, such as
+# builtins, are kept in a plain dict, which is emptied if it gets too big.
+_arities = weakref.WeakKeyDictionary()
+_strong_arities = {}
+_STRONG_LIMIT = 1024
+_UNKNOWN = (0, None)
+
+def _introspect(func):
+	try:
+		signature = inspect.signature(func)
+	except (TypeError, ValueError):
+		return _UNKNOWN # some builtins don't say
+	minimum, maximum = 0, 0
+	for parameter in signature.parameters.values():
+		if parameter.kind == parameter.VAR_POSITIONAL:
+			maximum = None
+		elif parameter.kind in (parameter.POSITIONAL_ONLY,
+				parameter.POSITIONAL_OR_KEYWORD):
+			if maximum is not None:
+				maximum += 1
+			if parameter.default is parameter.empty:
+				minimum += 1
+		elif parameter.kind == parameter.KEYWORD_ONLY and \
+				parameter.default is parameter.empty:
+			return None # can't be called with positional arguments alone
+	return minimum, maximum
+
+def arity(func):
+	""" Returns (minimum, maximum) positional arguments func accepts, with a
+		maximum of None if there is no limit, or None if func can't be called
+		with positional arguments alone. Each function is only inspected once.
+	"""
+	# bound methods are made afresh each time, so cache what they wrap
+	bound = inspect.ismethod(func)
+	target = func.__func__ if bound else func
+	try:
+		cache, found = _arities, _arities.get(target, False)
+	except TypeError:
+		try:
+			cache, found = _strong_arities, _strong_arities.get(target, False)
+		except TypeError:
+			cache, found = None, False # unhashable, so it can't be cached
+	if found is False:
+		found = _introspect(target)
+		if cache is _strong_arities and len(cache) >= _STRONG_LIMIT:
+			cache.clear()
+		if cache is not None:
+			cache[target] = found
+	if bound and found is not None and found != _UNKNOWN:
+		minimum, maximum = found
+		found = (max(minimum - 1, 0), None if maximum is None else maximum - 1)
+	return found
+
+def accepts(func, count):
+	""" Returns False if func certainly can't be called with count
+		positional arguments
+	"""
+	found = arity(func)
+	if found is None:
+		return False
+	minimum, maximum = found
+	return minimum <= count and (maximum is None or count <= maximum)
+
+_MISS = object()
+
+class PureFunction(object):
+	""" Wraps a function without side effects so calls repeated with the
+		same arguments return the remembered result, keeping at most maxsize
+		of them. Calls with arguments that can't be hashed go straight
+		through. For coroutine functions the running call is remembered, so
+	concurrent calls with the same arguments share it, unless it fails.
+	"""
+	def __init__(self, func, maxsize=1024):
+		if maxsize < 1:
+			raise ValueError("maxsize must be at least 1")
+		self.func = func
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._results = OrderedDict()
+		self._lock = threading.Lock()
+		self._is_coroutine = inspect.iscoroutinefunction(func)
+		functools.update_wrapper(self, func)
+
+	def _get(self, key):
+		with self._lock:
+			result = self._results.get(key, _MISS)
+			if result is _MISS:
+				self.misses += 1
+			else:
+				self._results.move_to_end(key)
+				self.hits += 1
+			return result
+
+	def _remember(self, key, result):
+		with self._lock:
+			self._results[key] = result
+			while len(self._results) > self.maxsize:
+				self._results.popitem(last=False)
+				self.evictions += 1
+
+	def __call__(self, *args):
+		# 1, 1.0 and True are equal but might not give the same result
+		key = (args, tuple(type(arg) for arg in args))
+		try:
+			result = self._get(key)
+		except TypeError:
+			return self.func(*args)
+		if self._is_coroutine:
+			return self._call_async(args, key, result)
+		if result is _MISS:
+			result = self.func(*args)
+			self._remember(key, result)
+		return result
+
+	async def _call_async(self, args, key, result):
+		# the future is remembered, so calls made while it's running share it
+		if result is _MISS:
+			result = asyncio.ensure_future(self.func(*args))
+			self._remember(key, result)
+		try:
+			return await result
+		except BaseException:
+			self._forget(key, result)
+			raise
+
+	def _forget(self, key, result):
+		with self._lock:
+			if self._results.get(key) is result:
+				del self._results[key]
+
+	def cache_clear(self):
+		""" Forgets every result, for when what the function reads changes
+		"""
+		with self._lock:
+			self._results.clear()
+			self.hits = 0
+			self.misses = 0
+			self.evictions = 0
+
+	def stats(self):
+		return CacheStats(self.hits, self.misses, self.evictions,
+			len(self._results), self.maxsize)
+
+	def __repr__(self):
+		return "pure(%r)" % (self.func,)
+
+def pure(func=None, maxsize=1024):
+	""" Declares func free of side effects, so yapp can remember its results.
+		Use as ``@pure``, ``@pure(maxsize=100)`` or ``pure(func)``.
+	"""
+	if func is None:
+		return lambda func: PureFunction(func, maxsize)
+	return PureFunction(func, maxsize)
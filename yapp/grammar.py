@@ -0,0 +1,166 @@
+""" The pyparsing grammar for yapp expressions.
+
+	The grammar is built once, when this module is first imported, and
+	parsing with it returns a single node describing the expression.
+"""
+from pyparsing import (
+	Word, Literal, alphas, alphanums, nums, Optional,
+	delimitedList,
+	Combine,
+	StringEnd,
+	ZeroOrMore,
+	Forward,
+	sglQuotedString
+)
+import pyparsing
+
+from yapp import instrumentation
+from yapp.exceptions import ParseError
+from yapp.nodes import Constant, Name, List, Call, BinOp
+
+# Terminal symbols =============================================================
+# Variable names and including property access
+ident = Word(alphas, alphanums + '_')
+func_name = Word(alphas, alphanums + '_')
+
+# Numbers
+point = Literal(".")
+number = Word(nums)
+sign = Literal("+") | Literal("-")
+integer = Combine(Optional(sign) + number)
+decimal = Combine(integer + point + Optional(number))
+
+# Operators
+plus = Literal("+")
+minus = Literal("-")
+mult = Literal("*")
+divide = Literal("/")
+exponent = Literal("^")
+mod = Literal("%")
+inop = Literal("in")
+eqop = Literal("==") | Literal("eq")
+plusminus = plus | minus
+multdivide = mult | divide | mod
+gte = Literal(">=")
+lte = Literal("<=")
+gt = Literal(">")
+lt = Literal("<")
+relational = gte | lte | gt | lt
+
+# Logical stuff
+TRUE = Literal("True")
+FALSE = Literal("False")
+BOOLEAN = TRUE | FALSE
+logicop = Literal("or") | Literal("and")
+
+# Groups
+lbrace = Literal("(").suppress()
+rbrace = Literal(")").suppress()
+lbracket = Literal("[")
+rbracket = Literal("]")
+
+# Parse actions ================================================================
+# These build nodes rather than touching any shared state, so a single grammar
+# can be shared by every caller.
+def _make_int(s, l, tokens):
+	return [Constant(int(tokens[0]))]
+
+def _make_decimal(s, l, tokens):
+	return [Constant(float(tokens[0]))]
+
+def _make_string(s, l, tokens):
+	return [Constant(tokens[0][1:-1])] # remove the quotes
+
+def _make_boolean(s, l, tokens):
+	return [Constant(tokens[0] == "True")]
+
+def _make_name(s, l, tokens):
+	return [Name(tokens[0])]
+
+def _make_list(s, l, tokens):
+	return [List(tokens)]
+
+def _make_call(s, l, tokens):
+	return [Call(tokens[0], tokens[1:])]
+
+# Binary operators from the most to the least tightly binding, and whether they
+# group from the right
+_PRECEDENCE = [
+	(("eq",), True),
+	(("^",), False),
+	(("*", "/", "%"), False),
+	((">=", "<=", ">", "<"), False),
+	(("+", "-"), False),
+	(("or", "and"), False),
+]
+
+def _fold_binary(s, l, tokens):
+	if len(tokens) == 1:
+		return
+	tokens = ["eq" if token == "==" else token for token in tokens]
+	for ops, from_right in _PRECEDENCE:
+		if from_right:
+			tokens.reverse()
+		folded = [tokens[0]]
+		for i in range(1, len(tokens), 2):
+			op, operand = tokens[i], tokens[i + 1]
+			if op not in ops:
+				folded += [op, operand]
+			elif from_right:
+				folded[-1] = BinOp(op, operand, folded[-1])
+			else:
+				folded[-1] = BinOp(op, folded[-1], operand)
+		tokens = folded
+		if from_right:
+			tokens.reverse()
+	return tokens
+
+def _build_grammar():
+	expr = Forward()
+	atom = Forward()
+	arg = expr
+	args = delimitedList(arg)
+
+	func_call = (func_name + lbrace + Optional(args) + rbrace).setParseAction(_make_call)
+
+	bracketed_list = (lbracket.suppress() + Optional(delimitedList(atom)) + 
+		rbracket.suppress()).setParseAction(_make_list)
+
+	# copies keep the module level terminals free of parse actions
+	terminals = ( BOOLEAN.copy().setParseAction(_make_boolean) | 
+		decimal.copy().setParseAction(_make_decimal) | 
+		integer.copy().setParseAction(_make_int) | 
+		ident.copy().setParseAction(_make_name) | 
+		sglQuotedString.copy().setParseAction(_make_string) )
+
+	atom <<= ( func_call | terminals  | (lbrace + expr + rbrace) | bracketed_list )
+
+	# Every operator is matched at one level and folded by precedence once the
+	# whole run is known, which keeps deeply nested expressions from running
+	# out of stack: a parse action on each level would stop pyparsing from
+	# merging them and cost six levels of recursion per bracket.
+	binop = eqop | exponent | multdivide | relational | plusminus | logicop
+
+	expr <<= (atom + ZeroOrMore(binop + atom)).setParseAction(_fold_binary)
+
+	# Define the grammar now ...
+	return expr + StringEnd()
+
+def _build_streamlined():
+	grammar = _build_grammar()
+	# pyparsing streamlines a grammar the first time it's used, which mustn't
+	# happen in several threads at once
+	grammar.streamline()
+	return grammar
+
+grammar = instrumentation.timed("grammar", None, _build_streamlined)
+
+def parse_tree(expr):
+	""" Parses expr into a tree, raising ParseError if it isn't valid
+	"""
+	try:
+		return grammar.parseString(expr)[0]
+	except pyparsing.ParseException as e:
+		msg = "There was an error in your expr %s at line %s, col %s" % \
+			(expr, e.lineno, e.col)
+		raise ParseError(msg, expr, e.line, e.col, e.lineno)
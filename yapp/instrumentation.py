@@ -0,0 +1,124 @@
+""" Opt-in timings of the phases expressions go through, and counts of the
+	environment functions they call, for feeding into metrics.
+
+	Nothing is measured until a hook is set with instrument. The hook is
+	then called with an Event for each phase, from whichever thread ran it:
+
+	- grammar: building the pyparsing grammar, once per process
+	- parse: parsing an expression with either parser
+	- optimize, codegen, assemble: the rest of compiling it
+	- evaluate: evaluating a compiled expression, with the number of calls
+	  to each environment function in calls
+
+	Expressions found in the expression cache skip the compiling phases.
+"""
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from collections.abc import Mapping
+
+from yapp.evaluator import function_map, lookup_function
+
+_Event = namedtuple("Event", "phase expr seconds calls")
+
+class Event(_Event):
+	""" One phase of handling expr, which is None for the grammar. calls
+		maps environment function names to how many times they were called,
+		and is only filled in for evaluate.
+	"""
+	__slots__ = ()
+
+# The function given every Event, None when nothing is measured
+hook = None
+
+_lock = threading.Lock()
+
+def instrument(function):
+	""" Calls function with an Event for each phase from now on. None turns
+		instrumentation off again.
+	"""
+	global hook
+	with _lock:
+		hook = function
+
+@contextmanager
+def instrumented(function):
+	""" Instruments with function until the block ends, putting back the
+		hook that was there before
+	"""
+	global hook
+	with _lock:
+		previous, hook = hook, function
+	try:
+		yield
+	finally:
+		with _lock:
+			hook = previous
+
+def timed(phase, expr, function, *args):
+	""" Returns function(*args), reporting how long it took if there is a
+		hook, whether or not it raised
+	"""
+	current = hook
+	if current is None:
+		return function(*args)
+	start = time.perf_counter()
+	try:
+		return function(*args)
+	finally:
+		current(Event(phase, expr, time.perf_counter() - start, {}))
+
+class CountingEnvironment(Mapping):
+	""" Wraps environment so that calls to the functions it gives are
+		counted in calls, by name. Only functions looked up to be called
+		are counted, so values used as variables are passed on as they are.
+	"""
+	def __init__(self, environment):
+		self._environment = environment
+		self._counters = {}
+		self.calls = {}
+
+	def _counter(self, name, func):
+		calls = self.calls
+		def counted(*args):
+			calls[name] = calls.get(name, 0) + 1
+			return func(*args)
+		return counted
+
+	def __getitem__(self, name):
+		return self._environment[name]
+
+	def function(self, name):
+		value = lookup_function(name, self._environment)
+		if not callable(value) or value is function_map.get(name):
+			return value
+		found = self._counters.get(name)
+		if found is None or found[0] is not value:
+			found = (value, self._counter(name, value))
+			self._counters[name] = found
+		return found[1]
+
+	def __contains__(self, name):
+		return name in self._environment
+
+	def __iter__(self):
+		return iter(self._environment)
+
+	def __len__(self):
+		return len(self._environment)
+
+def evaluate(function, expr, environment, fail_silently):
+	""" Returns function(environment, fail_silently), reporting how long it
+		took and the environment functions it called
+	"""
+	current = hook
+	if current is None:
+		return function(environment, fail_silently)
+	counting = CountingEnvironment(environment)
+	start = time.perf_counter()
+	try:
+		return function(counting, fail_silently)
+	finally:
+		current(Event("evaluate", expr, time.perf_counter() - start, counting.calls))
@@ -0,0 +1,274 @@
+""" The nodes produced by the yapp grammar.
+
+	Nodes are immutable and compare by structure, so identical subexpressions
+	are equal (and hash the same) wherever they appear.
+"""
+from decimal import Decimal
+
+class LiteralSet(frozenset):
+	""" The items of a literal list passed to in(), so membership is a hash
+		lookup. items keeps the list as it was written, for an in() that the
+		environment replaces. Values that can't be hashed can't equal any of
+		the items, so they are simply not in it.
+	"""
+	__slots__ = ("items",)
+
+	def __new__(cls, items):
+		items = tuple(items)
+		self = frozenset.__new__(cls, items)
+		self.items = items
+		return self
+
+	def __contains__(self, value):
+		try:
+			return frozenset.__contains__(self, value)
+		except TypeError:
+			return False
+
+	def __reduce__(self):
+		return (LiteralSet, (self.items,))
+
+	def __repr__(self):
+		return "LiteralSet(%r)" % (list(self.items),)
+
+def value_key(value):
+	""" Returns a key for value that keeps 1, 1.0 and True apart, including
+		as the items of a set
+	"""
+	if isinstance(value, LiteralSet):
+		return (LiteralSet, tuple((type(item), item) for item in value.items))
+	elif isinstance(value, frozenset):
+		return (type(value), frozenset((type(item), item) for item in value))
+	return (type(value), value)
+
+class Node(object):
+	""" Base class for all nodes in a parsed expression
+	"""
+	__slots__ = ()
+
+	def children(self):
+		return ()
+
+	def _key(self):
+		raise NotImplementedError
+
+	def __eq__(self, other):
+		return type(self) is type(other) and self._key() == other._key()
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash((type(self).__name__, self._key()))
+
+	def __setattr__(self, name, value):
+		raise AttributeError("%s is immutable" % type(self).__name__)
+
+	def __delattr__(self, name):
+		raise AttributeError("%s is immutable" % type(self).__name__)
+
+	def __reduce__(self):
+		# the constructors take their slots in order
+		return (type(self), tuple(getattr(self, slot) for slot in self.__slots__))
+
+
+class Constant(Node):
+	""" A literal number, string or boolean
+	"""
+	__slots__ = ('value',)
+
+	def __init__(self, value):
+		object.__setattr__(self, 'value', value)
+
+	def _key(self):
+		return value_key(self.value)
+
+	def __repr__(self):
+		return "Constant(%r)" % (self.value,)
+
+
+class Name(Node):
+	""" A variable looked up in the environment
+	"""
+	__slots__ = ('name',)
+
+	def __init__(self, name):
+		object.__setattr__(self, 'name', name)
+
+	def _key(self):
+		return self.name
+
+	def __repr__(self):
+		return "Name(%r)" % self.name
+
+
+class List(Node):
+	""" A bracketed list literal
+	"""
+	__slots__ = ('items',)
+
+	def __init__(self, items):
+		object.__setattr__(self, 'items', tuple(items))
+
+	def children(self):
+		return self.items
+
+	def _key(self):
+		return self.items
+
+	def __repr__(self):
+		return "List(%r)" % (list(self.items),)
+
+
+class Call(Node):
+	""" A call to a function in the environment
+	"""
+	__slots__ = ('name', 'args')
+
+	def __init__(self, name, args):
+		object.__setattr__(self, 'name', name)
+		object.__setattr__(self, 'args', tuple(args))
+
+	def children(self):
+		return self.args
+
+	def _key(self):
+		return (self.name, self.args)
+
+	def __repr__(self):
+		return "Call(%r, %r)" % (self.name, list(self.args))
+
+
+class BinOp(Node):
+	""" A binary operator. ``==`` is stored as ``eq``.
+	"""
+	__slots__ = ('op', 'left', 'right')
+
+	def __init__(self, op, left, right):
+		object.__setattr__(self, 'op', op)
+		object.__setattr__(self, 'left', left)
+		object.__setattr__(self, 'right', right)
+
+	def children(self):
+		return (self.left, self.right)
+
+	def _key(self):
+		return (self.op, self.left, self.right)
+
+	def __repr__(self):
+		return "BinOp(%r, %r, %r)" % (self.op, self.left, self.right)
+
+
+def walk(node):
+	""" Yields node and all of its descendants in source order
+	"""
+	pending = [node]
+	while pending:
+		node = pending.pop()
+		yield node
+		pending.extend(reversed(node.children()))
+
+
+def rebuild(node, children):
+	""" Returns node with its children replaced
+	"""
+	if isinstance(node, List):
+		return List(children)
+	elif isinstance(node, Call):
+		return Call(node.name, children)
+	elif isinstance(node, BinOp):
+		return BinOp(node.op, children[0], children[1])
+	return node
+
+def transform(node, function):
+	""" Rebuilds the tree bottom up without recursing. function is called with
+		each node and its already transformed children and returns the node
+		to put in its place, or whatever the tree is being folded into.
+	"""
+	results = []
+	pending = [(node, False)]
+	while pending:
+		node, expanded = pending.pop()
+		children = node.children()
+		if expanded or not children:
+			start = len(results) - len(children)
+			transformed = results[start:]
+			del results[start:]
+			results.append(function(node, transformed))
+		else:
+			pending.append((node, True))
+			pending.extend((child, False) for child in reversed(children))
+	return results[0]
+
+
+# How tightly each operator binds, following the grammar
+_precedence = {
+	"and" : 1, "or" : 1,
+	"+" : 2, "-" : 2,
+	">" : 3, "<" : 3, ">=" : 3, "<=" : 3,
+	"*" : 4, "/" : 4, "%" : 4,
+	"^" : 5,
+	"eq" : 6,
+}
+
+def _format_value(value):
+	if isinstance(value, str):
+		return "'%s'" % value
+	elif isinstance(value, LiteralSet):
+		return "[%s]" % ", ".join(_format_value(item) for item in value.items)
+	elif isinstance(value, frozenset):
+		return "[%s]" % ", ".join(sorted(_format_value(item) for item in value))
+	elif isinstance(value, float):
+		source = repr(value)
+		if "e" in source: # the grammar has no exponents
+			source = format(Decimal(source), "f")
+		if "." not in source: # or it would parse as an int
+			source += ".0"
+		return source
+	return repr(value)
+
+def _parenthesize(node, minimum):
+	return isinstance(node, BinOp) and _precedence[node.op] < minimum
+
+def to_source(node):
+	""" Formats node back into a yapp expression
+	"""
+	pieces = []
+	pending = [node]
+	while pending:
+		node = pending.pop()
+		if isinstance(node, str):
+			pieces.append(node)
+		elif isinstance(node, Constant):
+			pieces.append(_format_value(node.value))
+		elif isinstance(node, Name):
+			pieces.append(node.name)
+		elif isinstance(node, (List, Call)):
+			if isinstance(node, List):
+				opening, closing = "[", "]"
+			else:
+				opening, closing = "%s(" % node.name, ")"
+			# pending is a stack, so the pieces go on in reverse
+			pending.append(closing)
+			for index, child in enumerate(reversed(node.children())):
+				if index:
+					pending.append(", ")
+				pending.append(child)
+			pending.append(opening)
+		elif isinstance(node, BinOp):
+			precedence = _precedence[node.op]
+			# everything is left associative apart from eq
+			left_minimum, right_minimum = precedence, precedence + 1
+			if node.op == "eq":
+				left_minimum, right_minimum = precedence + 1, precedence
+			for child, minimum, operator in ((node.right, right_minimum, None),
+					(node.left, left_minimum, " %s " % node.op)):
+				if operator is not None:
+					pending.append(operator)
+				if _parenthesize(child, minimum):
+					pending.extend((")", child, "("))
+				else:
+					pending.append(child)
+		else:
+			raise TypeError("Unknown node %r" % (node,))
+	return "".join(pieces)
@@ -0,0 +1,170 @@
+""" Simplifies parsed expressions before they are evaluated.
+
+	- operators applied to constants are folded into a single constant, as
+	  long as it isn't too big to be worth keeping
+	- literal lists passed to in() become sets, so membership is a hash
+	  lookup. An in() that the environment replaces is still given a list.
+	- and/or with a constant left operand are reduced to whichever operand
+	  decides the result, dropping the branch that can never be taken
+
+	Calls other than in() are left alone since the environment can replace
+	any function. specialize goes further for an environment that is known
+	ahead of time.
+"""
+import math
+
+from yapp.evaluator import op_map, function_map, call, power_bits, SHORT_CIRCUIT, \
+	MISSING
+from yapp.functions import PureFunction
+from yapp.nodes import Constant, Name, List, Call, BinOp, LiteralSet, rebuild, \
+	transform
+
+# The largest constants folding makes. Anything bigger is left to be worked
+# out when it's evaluated, so compiling stays quick whatever the expression.
+# Ints are kept well within the 4300 digits str() will print.
+MAX_INT_BITS = 12000 # about 3600 digits
+MAX_STRING_LENGTH = 10000
+
+def _too_big(value):
+	if isinstance(value, int):
+		return value.bit_length() > MAX_INT_BITS
+	elif isinstance(value, str):
+		return len(value) > MAX_STRING_LENGTH
+	return False
+
+def _costly(op, left, right):
+	""" Whether op could make a constant too big to fold from left and
+		right, judged before working it out
+	"""
+	if _too_big(left) or _too_big(right):
+		return True
+	elif op == "^":
+		return power_bits(left, right) > MAX_INT_BITS
+	elif op == "*" and isinstance(left, str) and isinstance(right, int):
+		return len(left) * right > MAX_STRING_LENGTH
+	elif op == "*" and isinstance(left, int) and isinstance(right, str):
+		return left * len(right) > MAX_STRING_LENGTH
+	elif op == "%" and isinstance(left, str):
+		return True # formatting can pad to any width
+	return False
+
+def _fold(op, left, right):
+	""" Returns the constant op gives for two constants, or None if it
+		raises, in which case it is left to raise when evaluated, gives a
+		value that can't be written in an expression, or would be too big
+		to be worth folding
+	"""
+	if _costly(op, left, right):
+		return None
+	function = op_map.get(op) or function_map[op]
+	try:
+		value = function(left, right)
+	except Exception:
+		return None
+	if not isinstance(value, (bool, int, float, str)) or \
+			(isinstance(value, float) and not math.isfinite(value)) or _too_big(value):
+		return None # such as complex numbers, inf and nan
+	return Constant(value)
+
+def _optimize_node(node, children):
+	if isinstance(node, BinOp):
+		left, right = children
+		if node.op in SHORT_CIRCUIT and isinstance(left, Constant):
+			# True and x, False or x are x; False and x, True or x are the left
+			if (node.op == "and") == bool(left.value):
+				return right
+			return left
+		if isinstance(left, Constant) and isinstance(right, Constant):
+			folded = _fold(node.op, left.value, right.value)
+			if folded is not None:
+				return folded
+	elif isinstance(node, Call):
+		if node.name == "in" and len(children) == 2 and isinstance(children[1], List) and \
+				all(isinstance(item, Constant) for item in children[1].items):
+			try:
+				values = LiteralSet(item.value for item in children[1].items)
+				children = [children[0], Constant(values)]
+			except TypeError:
+				pass # an unhashable constant, leave it as a list
+	if all(new is old for new, old in zip(children, node.children())):
+		return node
+	return rebuild(node, children)
+
+def optimize(node):
+	""" Returns an equivalent, simpler tree
+	"""
+	return transform(node, _optimize_node)
+
+def _node_for(value):
+	""" Returns the node for a value known ahead of time, or None if it
+		can't be written in an expression or is too big to be worth writing
+	"""
+	if isinstance(value, float) and not math.isfinite(value):
+		return None
+	elif _too_big(value):
+		return None
+	elif isinstance(value, str) and any(c in value for c in "'\\\n\r"):
+		return None # quotes, escapes and line breaks don't survive being parsed
+	elif isinstance(value, (bool, int, float, str)):
+		return Constant(value)
+	elif isinstance(value, list):
+		items = [_node_for(item) for item in value]
+		if all(item is not None for item in items):
+			return List(items)
+	return None
+
+def _value_of(node):
+	if isinstance(node, Constant):
+		return node.value
+	elif isinstance(node, List):
+		values = [_value_of(item) for item in node.items]
+		if all(value is not MISSING for value in values):
+			return values
+	return MISSING
+
+def _specialize_call(node, children, environment):
+	""" Returns the constant node gives, or None if it has to be called
+		when it's evaluated
+	"""
+	if node.name in environment:
+		func = environment[node.name]
+		if not callable(func):
+			return _node_for(func)
+		elif not isinstance(func, PureFunction):
+			return None
+	elif node.name in function_map:
+		func = function_map[node.name]
+		if node.name in SHORT_CIRCUIT and len(children) == 2 and \
+				isinstance(children[0], Constant):
+			if (node.name == "and") == bool(children[0].value):
+				return children[1]
+			return children[0]
+	else:
+		return None
+	values = [_value_of(child) for child in children]
+	if any(value is MISSING for value in values):
+		return None
+	try:
+		return _node_for(call(func, values))
+	except Exception:
+		return None # left to raise when evaluated
+
+def specialize(node, environment):
+	""" Returns node simplified for environments that include environment.
+		Its variables are replaced by their values, as long as they can be
+		written in an expression, and everything that becomes constant is
+		folded. So are calls to builtin functions environment doesn't
+		replace and to pure functions in environment, once their arguments
+		are constants. Other functions are still called.
+	"""
+	def bind(node, children):
+		if isinstance(node, Name):
+			if node.name in environment and not callable(environment[node.name]):
+				return _node_for(environment[node.name]) or node
+			return node
+		elif isinstance(node, Call):
+			folded = _specialize_call(node, children, environment)
+			if folded is not None:
+				return folded
+		return _optimize_node(node, children)
+	return transform(node, bind)
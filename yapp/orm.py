@@ -0,0 +1,467 @@
+""" Translates expressions into Django Q objects, so rows can be filtered by
+	the database instead of being loaded and evaluated one at a time.
+
+	Names that are fields of the model become F() references, while other
+	names are looked up in the environment and sent as values. Comparisons,
+	eq, in with a list of values, and, or, not, and arithmetic on numbers
+	are translated. Anything else is left to be checked in Python, and so
+	is every part of a top level and chain that contains it: the rest of
+	the chain is still filtered on by the database.
+
+	Some things are deliberately left to Python because SQL disagrees with
+	it: % (SQL takes the sign of the dividend), comparing values of
+	different types, and arithmetic on strings. / is done in floating point
+	as in Python, rather than as integer division. Where Python would raise,
+	such as comparing a NULL or dividing by zero, the database leaves the
+	row out instead. Comparing strings follows the database's collation,
+	which can differ from Python's ordering, and on some databases eq
+	ignores case.
+"""
+import datetime
+import operator
+from decimal import Decimal
+
+from django.db.models import Q, F, Value, ExpressionWrapper, IntegerField, \
+	FloatField
+from django.db.models.functions import Cast
+
+from yapp import CompiledExpression, expression_cache
+from yapp.environment import as_environment
+from yapp.evaluator import op_map, function_map, lookup, lookup_function, variable, call, \
+	MISSING, SHORT_CIRCUIT
+from yapp.functions import PureFunction
+from yapp.nodes import Constant, Name, Call, BinOp, transform, to_source
+
+# The kinds of value the fields hold, by Field.get_internal_type()
+_field_kinds = {
+	"AutoField" : "int",
+	"BigAutoField" : "int",
+	"SmallAutoField" : "int",
+	"IntegerField" : "int",
+	"BigIntegerField" : "int",
+	"SmallIntegerField" : "int",
+	"PositiveIntegerField" : "int",
+	"PositiveBigIntegerField" : "int",
+	"PositiveSmallIntegerField" : "int",
+	"FloatField" : "float",
+	"DecimalField" : "decimal",
+	"BooleanField" : "bool",
+	"NullBooleanField" : "bool",
+	"CharField" : "text",
+	"TextField" : "text",
+	"SlugField" : "text",
+	"DateField" : "date",
+	"DateTimeField" : "datetime",
+	"TimeField" : "time",
+}
+
+_NUMBERS = ("bool", "int", "float", "decimal")
+
+# The lookup each comparison becomes, and the one for its operands swapped
+_lookups = {">" : "gt", "<" : "lt", ">=" : "gte", "<=" : "lte", "eq" : "exact"}
+_swapped = {">" : "lt", "<" : "gt", ">=" : "lte", "<=" : "gte", "eq" : "exact"}
+
+_connectors = {
+	"+" : operator.add,
+	"-" : operator.sub,
+	"*" : operator.mul,
+	"/" : operator.truediv,
+	"^" : operator.pow,
+}
+
+_output_fields = {"int" : IntegerField, "float" : FloatField}
+
+def _value_kind(value):
+	if isinstance(value, bool):
+		return "bool"
+	elif isinstance(value, int):
+		return "int"
+	elif isinstance(value, float):
+		return "float"
+	elif isinstance(value, Decimal):
+		return "decimal"
+	elif isinstance(value, str):
+		return "text"
+	elif isinstance(value, datetime.datetime):
+		return "datetime"
+	elif isinstance(value, datetime.date):
+		return "date"
+	elif isinstance(value, datetime.time):
+		return "time"
+	return None
+
+def _comparable(kind, other):
+	""" Returns True if Python and SQL agree on comparing the two kinds
+	"""
+	if kind in _NUMBERS and other in _NUMBERS:
+		return True
+	return kind is not None and kind == other
+
+def _arithmetic_kind(op, kind, other):
+	""" Returns the kind op gives for numbers of the two kinds, or None if
+		it isn't translated
+	"""
+	kinds = (kind, other)
+	if kind not in _NUMBERS or other not in _NUMBERS or \
+			("float" in kinds and "decimal" in kinds):
+		return None
+	if "decimal" in kinds:
+		return "decimal"
+	elif op == "/" or "float" in kinds:
+		return "float"
+	return "int"
+
+def _always():
+	return ~Q(pk__in=[])
+
+def _never():
+	return Q(pk__in=[])
+
+class _Value(object):
+	""" A part of the expression that doesn't depend on the row, worked out
+		in Python
+	"""
+	__slots__ = ("value",)
+
+	def __init__(self, value):
+		self.value = value
+
+	@property
+	def kind(self):
+		return _value_kind(self.value)
+
+	def expression(self):
+		return Value(self.value)
+
+	def operand(self):
+		return self.value
+
+class _Expression(object):
+	""" A value computed by the database. field is the field's name when it
+		is just a field.
+	"""
+	__slots__ = ("_expression", "kind", "field")
+
+	def __init__(self, expression, kind, field=None):
+		self._expression = expression
+		self.kind = kind
+		self.field = field
+
+	def expression(self):
+		return self._expression
+
+	operand = expression
+
+class _Condition(object):
+	""" A Q object for a part that can only be used as a condition
+	"""
+	__slots__ = ("q",)
+
+	def __init__(self, q):
+		self.q = q
+
+class _Skipped(object):
+	""" A part that can't be translated, and why
+	"""
+	__slots__ = ("node", "reason")
+
+	def __init__(self, node, reason):
+		self.node = node
+		self.reason = reason
+
+class _Translator(object):
+	def __init__(self, kinds, environment):
+		self.kinds = kinds
+		self.environment = environment
+		self.annotations = {}
+
+	def builtin(self, name):
+		return lookup_function(name, self.environment) is function_map.get(name, MISSING)
+
+	def is_and(self, node):
+		return (isinstance(node, BinOp) and node.op == "and") or \
+			(isinstance(node, Call) and node.name == "and" and \
+				len(node.args) == 2 and self.builtin("and"))
+
+	def alias(self, part):
+		""" Returns the name of an annotation holding part's expression, so
+			it can be compared like a field
+		"""
+		name = "yapp_%d" % len(self.annotations)
+		self.annotations[name] = part.expression()
+		return name
+
+	def condition(self, node, part):
+		""" Returns the Q object for part used as a condition
+		"""
+		if isinstance(part, _Condition):
+			return part.q
+		elif isinstance(part, _Value):
+			return _always() if part.value else _never()
+		elif part.kind == "bool" and part.field is not None:
+			return Q(**{part.field : True})
+		return _Skipped(node, "uses the truth of a %s" % (part.kind or "value"))
+
+	def translate(self, node, children):
+		""" Folds node into a part, given the parts of its children
+		"""
+		if isinstance(node, Constant):
+			return _Value(node.value)
+		elif isinstance(node, Name):
+			return self.name(node)
+		elif isinstance(node, BinOp):
+			return self.operator(node, node.op, children)
+		elif isinstance(node, Call):
+			return self.call(node, children)
+		for child in children:
+			if isinstance(child, _Skipped):
+				return child
+		if all(isinstance(child, _Value) for child in children):
+			return _Value([child.value for child in children])
+		return _Skipped(node, "builds a list from the row")
+
+	def name(self, node):
+		kind = self.kinds.get(node.name, MISSING)
+		if kind is not MISSING:
+			return _Expression(F(node.name), kind, node.name)
+		value = lookup(node.name, self.environment)
+		if value is not MISSING:
+			value = variable(value)
+		if value is MISSING or callable(value):
+			return _Skipped(node, "%s isn't a field or a value in the environment"
+				% node.name)
+		return _Value(value)
+
+	def call(self, node, children):
+		func = lookup_function(node.name, self.environment)
+		if func is function_map.get(node.name) and node.name in SHORT_CIRCUIT \
+				and len(children) == 2:
+			return self.operator(node, node.name, children)
+		for child in children:
+			if isinstance(child, _Skipped):
+				return child
+		if func is MISSING:
+			return _Skipped(node, "%s isn't in the environment" % node.name)
+		elif not callable(func):
+			return _Value(func)
+		elif func is function_map.get(node.name):
+			if node.name == "not" and len(children) == 1:
+				return self.negate(node, children[0])
+			elif len(children) == 2:
+				return self.operator(node, node.name, children)
+		elif isinstance(func, PureFunction) and \
+				all(isinstance(child, _Value) for child in children):
+			# it gives the same result for every row
+			return self.apply(node, func, children)
+		return _Skipped(node, "calls %s()" % node.name)
+
+	def apply(self, node, func, children):
+		try:
+			return _Value(call(func, [child.value for child in children]))
+		except Exception as e:
+			return _Skipped(node, "raises %r" % (e,))
+
+	def negate(self, node, part):
+		if isinstance(part, _Value):
+			return _Value(not part.value)
+		q = self.condition(node, part)
+		if isinstance(q, _Skipped):
+			return q
+		return _Condition(~q)
+
+	def operator(self, node, op, children):
+		left, right = children
+		if op in SHORT_CIRCUIT:
+			return self.logical(node, op, left, right)
+		for child in children:
+			if isinstance(child, _Skipped):
+				return child
+		if isinstance(left, _Value) and isinstance(right, _Value):
+			return self.apply(node, op_map.get(op) or function_map[op], children)
+		elif isinstance(left, _Condition) or isinstance(right, _Condition):
+			return _Skipped(node, "uses a condition as a value")
+		elif op in _lookups:
+			return self.compare(node, op, left, right)
+		elif op == "in":
+			return self.contains(node, left, right)
+		elif op in _connectors:
+			return self.arithmetic(node, op, left, right)
+		return _Skipped(node, "%s isn't translated" % op)
+
+	def logical(self, node, op, left, right):
+		# a value on the left decides or not the way it would in Python
+		if isinstance(left, _Value):
+			decided = not left.value if op == "and" else bool(left.value)
+			return left if decided else right
+		for child in (left, right):
+			if isinstance(child, _Skipped):
+				return child
+		conditions = [self.condition(node, child) for child in (left, right)]
+		for q in conditions:
+			if isinstance(q, _Skipped):
+				return q
+		if op == "and":
+			return _Condition(conditions[0] & conditions[1])
+		return _Condition(conditions[0] | conditions[1])
+
+	def compare(self, node, op, left, right):
+		if not _comparable(left.kind, right.kind):
+			return _Skipped(node, "compares a %s with a %s" % (left.kind or "value",
+				right.kind or "value"))
+		# compare a field if there is one, or else name an expression
+		if getattr(left, "field", None) is not None:
+			field, lookup_name, other = left.field, _lookups[op], right
+		elif getattr(right, "field", None) is not None:
+			field, lookup_name, other = right.field, _swapped[op], left
+		elif isinstance(left, _Expression):
+			field, lookup_name, other = self.alias(left), _lookups[op], right
+		else:
+			field, lookup_name, other = self.alias(right), _swapped[op], left
+		return _Condition(Q(**{"%s__%s" % (field, lookup_name) : other.operand()}))
+
+	def contains(self, node, item, container):
+		if not isinstance(container, _Value) or \
+				not isinstance(container.value, (list, tuple, set, frozenset)):
+			return _Skipped(node, "in only translates with a list of values")
+		for value in container.value:
+			if not _comparable(item.kind, _value_kind(value)):
+				return _Skipped(node, "compares a %s with a %s" % (item.kind or
+					"value", _value_kind(value) or "value"))
+		if not container.value:
+			return _Value(False)
+		field = item.field if item.field is not None else self.alias(item)
+		# sorted so the same expression always gives the same query
+		values = sorted(container.value, key=repr)
+		return _Condition(Q(**{"%s__in" % field : values}))
+
+	def arithmetic(self, node, op, left, right):
+		kind = _arithmetic_kind(op, left.kind, right.kind)
+		if kind is None:
+			return _Skipped(node, "%s isn't translated for a %s and a %s" % (op,
+				left.kind or "value", right.kind or "value"))
+		lhs, rhs = left.expression(), right.expression()
+		if op == "/" and kind == "float":
+			# SQL divides integers without a remainder
+			lhs = Cast(lhs, FloatField())
+		expression = _connectors[op](lhs, rhs)
+		if kind in _output_fields:
+			expression = ExpressionWrapper(expression, output_field=_output_fields[kind]())
+		return _Expression(expression, kind)
+
+class Translation(object):
+	""" An expression split into what the database can filter on and what
+		is left to check in Python:
+
+		- q: the Q object for the parts that were translated
+		- annotations: the expressions q compares by name, for annotate
+		- residual: a CompiledExpression of the rest, None if there isn't any
+		- skipped: (source, reason) for each subexpression that wasn't
+		  translated
+	"""
+	def __init__(self, model, q, annotations, residual, skipped, environment):
+		self.model = model
+		self.q = q
+		self.annotations = annotations
+		self.residual = residual
+		self.skipped = skipped
+		self.environment = environment
+
+	@property
+	def complete(self):
+		""" Whether the database does all of the filtering
+		"""
+		return self.residual is None
+
+	def queryset(self, queryset=None):
+		""" Returns queryset, all of the model's rows by default, filtered by q
+		"""
+		if queryset is None:
+			queryset = self.model._default_manager.all()
+		if self.annotations:
+			queryset = queryset.annotate(**self.annotations)
+		return queryset.filter(self.q)
+
+	def filter(self, queryset=None, fail_silently=True):
+		""" Returns the rows of queryset the expression is true for. That's
+			a QuerySet when the translation is complete, and otherwise an
+			iterator evaluating the residual for each row the database
+			returns.
+		"""
+		queryset = self.queryset(queryset)
+		if self.residual is None:
+			return queryset
+		return self._check(queryset.iterator(), fail_silently)
+
+	def _check(self, rows, fail_silently):
+		fields = set(field.name for field in self.model._meta.concrete_fields)
+		names = list(set(self.residual.names()))
+		evaluate = self.residual.evaluate
+		environment = self.environment
+		for row in rows:
+			values = {}
+			for name in names:
+				if name in fields:
+					values[name] = getattr(row, name)
+				elif name in environment:
+					values[name] = environment[name]
+			if evaluate(values, fail_silently):
+				yield row
+
+	def __repr__(self):
+		return "Translation(%r, residual=%r)" % (self.q, self.residual)
+
+def _field_kinds_of(model):
+	kinds = {}
+	for field in model._meta.concrete_fields:
+		if not field.is_relation:
+			kinds[field.name] = _field_kinds.get(field.get_internal_type())
+	return kinds
+
+def translate(expr, model, environment={}):
+	""" Translates expr, a string or CompiledExpression, into a Translation
+		for filtering model's rows. Names that are model fields refer to the
+		row, taking precedence over the environment.
+	"""
+	if not isinstance(expr, CompiledExpression):
+		expr = expression_cache.get(expr, fail_silently=False)
+	environment = as_environment(environment)
+	translator = _Translator(_field_kinds_of(model), environment)
+	tree = expr.tree
+	q = None
+	residual = []
+	skipped = []
+	pending = [tree]
+	while pending:
+		node = pending.pop()
+		if translator.is_and(node):
+			pending.extend(reversed(node.children()))
+			continue
+		part = transform(node, translator.translate)
+		if isinstance(part, _Value) and not part.value:
+			# the whole chain is false whatever the rest of it is
+			return Translation(model, _never(), {}, None, (), environment)
+		if not isinstance(part, _Skipped):
+			part = translator.condition(node, part)
+		if isinstance(part, _Skipped):
+			residual.append(node)
+			skipped.append((to_source(part.node), part.reason))
+			continue
+		q = part if q is None else q & part
+	if q is None:
+		q = _always()
+	if not residual:
+		return Translation(model, q, translator.annotations, None, (), environment)
+	rest = residual[0]
+	for node in residual[1:]:
+		rest = BinOp("and", rest, node)
+	if rest is not tree:
+		expr = CompiledExpression(to_source(rest), rest)
+	return Translation(model, q, translator.annotations, expr, tuple(skipped),
+		environment)
+
+def filter_queryset(queryset, expr, environment={}, fail_silently=True):
+	""" Returns the rows of queryset expr is true for, filtering as much as
+		it can in the database. See Translation.filter.
+	"""
+	translation = translate(expr, queryset.model, environment)
+	return translation.filter(queryset, fail_silently)
@@ -0,0 +1,119 @@
+""" Evaluates a set of rules against a stream of records across a pool of
+	worker processes.
+
+	The compiled rules are sent to each worker once, when it starts. Records
+	are sent in chunks and every record gets a dict mapping rule names to
+	results. Records, and any shared environment, must be picklable.
+"""
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from yapp import compile, CompiledExpression
+from yapp.exceptions import EvaluationError, ROW_ERRORS
+
+# Set in each worker by _init_worker
+_worker_rules = None
+_worker_environment = None
+
+def _init_worker(rules, environment):
+	global _worker_rules, _worker_environment
+	_worker_rules = rules
+	_worker_environment = environment
+
+def _evaluate_record(index, record, fail_silently, collect_errors):
+	if _worker_environment:
+		environment = dict(_worker_environment)
+		environment.update(record)
+	else:
+		environment = record
+	results = {}
+	for name, compiled in _worker_rules:
+		if not collect_errors:
+			results[name] = compiled.evaluate(environment, fail_silently)
+			continue
+		try:
+			results[name] = compiled.evaluate(environment, fail_silently)
+		except ROW_ERRORS as e:
+			results[name] = EvaluationError("Rule %s failed to evaluate record %s: %s" %
+				(name, index, e), index, e)
+	return results
+
+def _evaluate_chunk(start, records, fail_silently, collect_errors):
+	return start, [_evaluate_record(start + offset, record, fail_silently,
+		collect_errors) for offset, record in enumerate(records)]
+
+class ParallelEvaluator(object):
+	""" Evaluates rules, a dict mapping names to expressions or compiled
+		expressions, against records in a pool of processes.
+	"""
+	def __init__(self, rules, environment={}, max_workers=None, chunksize=1000,
+			fail_silently=True, collect_errors=False, codegen=False):
+		if chunksize < 1:
+			raise ValueError("chunksize must be at least 1")
+		compiled_rules = []
+		for name, expr in rules.items():
+			if not isinstance(expr, CompiledExpression):
+				expr = compile(expr, fail_silently, codegen=codegen)
+			compiled_rules.append((name, expr))
+		self.chunksize = chunksize
+		self.fail_silently = fail_silently
+		self.collect_errors = collect_errors
+		# keep a couple of chunks per worker queued, but no more
+		self._in_flight = 2 * (max_workers or os.cpu_count() or 1)
+		self._executor = ProcessPoolExecutor(max_workers=max_workers,
+			initializer=_init_worker, initargs=(compiled_rules, environment))
+
+	def _submit_chunks(self, records):
+		""" Yields futures for chunks of records, keeping only a few chunks
+			per worker in flight
+		"""
+		records = iter(records)
+		for start in itertools.count(0, self.chunksize):
+			chunk = list(itertools.islice(records, self.chunksize))
+			if not chunk:
+				return
+			yield self._executor.submit(_evaluate_chunk, start, chunk,
+				self.fail_silently, self.collect_errors)
+
+	def map(self, records):
+		""" Yields the results for each record in input order
+		"""
+		pending = deque()
+		for future in self._submit_chunks(records):
+			pending.append(future)
+			if len(pending) >= self._in_flight:
+				for results in pending.popleft().result()[1]:
+					yield results
+		while pending:
+			for results in pending.popleft().result()[1]:
+				yield results
+
+	def map_unordered(self, records):
+		""" Yields (index, results) pairs for each record as soon as its chunk
+			is done
+		"""
+		pending = set()
+		submitted = self._submit_chunks(records)
+		while True:
+			for future in submitted:
+				pending.add(future)
+				if len(pending) >= self._in_flight:
+					break
+			if not pending:
+				return
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				start, chunk = future.result()
+				for offset, results in enumerate(chunk):
+					yield start + offset, results
+
+	def shutdown(self, wait=True):
+		self._executor.shutdown(wait=wait)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.shutdown()
@@ -0,0 +1,232 @@
+""" A hand written parser for yapp expressions that doesn't need pyparsing.
+
+	It reads the same language as the grammar in yapp.grammar and builds the
+	same trees. Operators are parsed by precedence climbing (a Pratt parser)
+	and everything else by recursive descent. Tokens are read on demand since,
+	just like the pyparsing grammar, what a piece of text means depends on
+	where it appears: after an operand ``equal`` reads as ``eq ual``.
+
+	Syntax errors are reported at the same line and column as pyparsing does,
+	which means following its rules for which failure wins: when none of the
+	alternatives for an operand match, the one that got furthest is reported.
+"""
+import re
+
+from yapp.exceptions import ParseError
+from yapp.nodes import Constant, Name, List, Call, BinOp
+
+_whitespace = re.compile(r"[ \t\r\n]*")
+_word = re.compile(r"[A-Za-z][A-Za-z0-9_]*")
+_digits = re.compile(r"[0-9]+")
+# pyparsing's sglQuotedString, which is this followed by the closing quote
+_string = re.compile(r"'(?:[^'\n\r\\]|(?:'')|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*")
+
+# Operators by binding power, following the grammar from loosest to tightest
+_binding = {
+	"or" : 10, "and" : 10,
+	"+" : 20, "-" : 20,
+	">=" : 30, "<=" : 30, ">" : 30, "<" : 30,
+	"*" : 40, "/" : 40, "%" : 40,
+	"^" : 50,
+}
+# eq binds tightest of all and groups to the right
+_equality = ("==", "eq")
+# The order the grammar tries the operators in after an operand
+_operators = ("==", "eq", "^", "*", "/", "%", ">=", "<=", ">", "<", "+", "-",
+	"or", "and")
+
+class _Failure(Exception):
+	""" Parsing failed at loc
+	"""
+	def __init__(self, loc):
+		self.loc = loc
+
+class _Parser(object):
+	def __init__(self, text):
+		self.text = text
+
+	def skip(self, loc):
+		return _whitespace.match(self.text, loc).end()
+
+	def literal(self, loc, literal):
+		""" Returns the loc after literal, or raises
+		"""
+		loc = self.skip(loc)
+		if self.text.startswith(literal, loc):
+			return loc + len(literal)
+		raise _Failure(loc)
+
+	def operator(self, loc):
+		""" Returns the operator at loc and the loc after it, or (None, loc)
+		"""
+		start = self.skip(loc)
+		for op in _operators:
+			if self.text.startswith(op, start):
+				return op, start + len(op)
+		return None, loc
+
+	def expression(self, loc, minimum=0):
+		""" Parses operators binding at least as tightly as minimum
+		"""
+		left, loc = self.equality(loc)
+		while True:
+			op, after = self.operator(loc)
+			# an eq left over means the operand after it didn't parse
+			if op is None or op in _equality or _binding[op] < minimum:
+				return left, loc
+			try:
+				right, after = self.expression(after, _binding[op] + 1)
+			except _Failure:
+				# pyparsing backs off to before the operator, which then
+				# can't be matched by anything else so the expression ends
+				return left, loc
+			left = BinOp(op, left, right)
+			loc = after
+
+	def equality(self, loc):
+		""" Parses a chain of operands joined by eq
+		"""
+		operand, loc = self.atom(loc)
+		operands = [operand]
+		while True:
+			op, after = self.operator(loc)
+			if op not in _equality:
+				break
+			try:
+				operand, loc = self.atom(after)
+			except _Failure:
+				break
+			operands.append(operand)
+		node = operands.pop()
+		while operands:
+			node = BinOp("eq", operands.pop(), node)
+		return node, loc
+
+	def atom(self, loc):
+		""" Parses an operand, trying the alternatives in the grammar's order
+		"""
+		start = self.skip(loc)
+		furthest = None
+		for alternative in (self.call, self.boolean, self.number, self.name,
+				self.string, self.group, self.list):
+			try:
+				return alternative(start)
+			except _Failure as failure:
+				if furthest is None or failure.loc > furthest.loc:
+					furthest = failure
+		raise furthest
+
+	def word(self, loc):
+		match = _word.match(self.text, loc)
+		if match is None:
+			raise _Failure(loc)
+		return match.group(), match.end()
+
+	def call(self, loc):
+		name, loc = self.word(loc)
+		loc = self.literal(loc, "(")
+		args = []
+		try:
+			arg, after = self.expression(loc)
+			args.append(arg)
+			loc = after
+			while True:
+				after = self.literal(loc, ",")
+				arg, after = self.expression(after)
+				args.append(arg)
+				loc = after
+		except _Failure:
+			pass
+		loc = self.literal(loc, ")")
+		return Call(name, args), loc
+
+	def boolean(self, loc):
+		for literal, value in (("True", True), ("False", False)):
+			if self.text.startswith(literal, loc):
+				return Constant(value), loc + len(literal)
+		raise _Failure(loc)
+
+	def number(self, loc):
+		""" Reads a decimal or integer, with no whitespace inside it
+		"""
+		end = loc
+		if self.text.startswith(("+", "-"), end):
+			end += 1
+		match = _digits.match(self.text, end)
+		if match is None:
+			raise _Failure(end)
+		end = match.end()
+		if self.text.startswith(".", end):
+			end += 1
+			match = _digits.match(self.text, end)
+			if match is not None:
+				end = match.end()
+			return Constant(float(self.text[loc:end])), end
+		return Constant(int(self.text[loc:end])), end
+
+	def name(self, loc):
+		name, loc = self.word(loc)
+		return Name(name), loc
+
+	def string(self, loc):
+		match = _string.match(self.text, loc)
+		if match is None:
+			raise _Failure(loc)
+		end = match.end()
+		if not self.text.startswith("'", end):
+			raise _Failure(end)
+		return Constant(self.text[loc + 1:end]), end + 1
+
+	def group(self, loc):
+		loc = self.literal(loc, "(")
+		node, loc = self.expression(loc)
+		loc = self.literal(loc, ")")
+		return node, loc
+
+	def list(self, loc):
+		loc = self.literal(loc, "[")
+		items = []
+		try:
+			item, after = self.atom(loc)
+			items.append(item)
+			loc = after
+			while True:
+				after = self.literal(loc, ",")
+				item, after = self.atom(after)
+				items.append(item)
+				loc = after
+		except _Failure:
+			pass
+		loc = self.literal(loc, "]")
+		return List(items), loc
+
+def _position(text, loc):
+	""" Returns the line, lineno and col of loc the way pyparsing does
+	"""
+	lineno = text.count("\n", 0, loc) + 1
+	if 0 < loc < len(text) and text[loc - 1] == "\n":
+		col = 1
+	else:
+		col = loc - text.rfind("\n", 0, loc)
+	start = text.rfind("\n", 0, loc) + 1
+	end = text.find("\n", loc)
+	line = text[start:] if end < 0 else text[start:end]
+	return line, lineno, col
+
+def parse_tree(expr):
+	""" Parses expr into a tree, raising ParseError if it isn't valid
+	"""
+	# pyparsing expands tabs before parsing
+	text = expr.expandtabs()
+	parser = _Parser(text)
+	try:
+		tree, loc = parser.expression(0)
+		loc = parser.skip(loc)
+		if loc != len(text):
+			raise _Failure(loc)
+	except _Failure as failure:
+		line, lineno, col = _position(text, failure.loc)
+		msg = "There was an error in your expr %s at line %s, col %s" % \
+			(expr, lineno, col)
+		raise ParseError(msg, expr, line, col, lineno)
+	return tree
@@ -0,0 +1,468 @@
+""" Evaluating many rules against the same environment.
+"""
+import threading
+
+from yapp import compile, CompiledExpression, as_environment
+from yapp.analysis import analyze_code
+from yapp.bytecode import assemble, run
+from yapp.evaluator import MISSING, CALLED_BY_NAME
+from yapp.exceptions import EvaluationError, ROW_ERRORS
+from yapp.nodes import Constant, Name, List, Call, BinOp, rebuild, transform
+
+def _share(node, table):
+	""" Rebuilds node so that subexpressions already in table are reused.
+		Equal subexpressions end up as the same object.
+	"""
+	def share(node, children):
+		if isinstance(node, List):
+			key = (List, tuple(id(child) for child in children))
+		elif isinstance(node, Call):
+			key = (Call, node.name, tuple(id(child) for child in children))
+		elif isinstance(node, BinOp):
+			key = (BinOp, node.op, id(children[0]), id(children[1]))
+		else:
+			key = (type(node), node._key())
+		shared = table.get(key)
+		if shared is None:
+			shared = table[key] = rebuild(node, children)
+		return shared
+	return transform(node, share)
+
+class RuleSet(object):
+	""" A set of named rules compiled into one graph, so subexpressions that
+		several rules have in common (including calls to environment
+		functions) are evaluated at most once per environment.
+	"""
+	def __init__(self, rules={}, fail_silently=True):
+		self.fail_silently = fail_silently
+		self._rules = {}
+		self._code = {}
+		self._table = {}
+		self._slots = {} # memo slot of each shared node, by id
+		self._dropped = 0 # rules replaced or removed since the graph was built
+		for name, expr in rules.items():
+			self.add(name, expr)
+
+	def add(self, name, expr):
+		""" Adds or replaces the rule called name. expr can be a string or a
+			CompiledExpression.
+		"""
+		if not isinstance(expr, CompiledExpression):
+			expr = compile(expr, self.fail_silently)
+		if name in self._rules:
+			self._dropped += 1
+		tree = expr.tree
+		code = None
+		if tree is not None:
+			tree = _share(tree, self._table)
+			code = assemble(tree, self._slots)
+		self._rules[name] = tree
+		self._code[name] = code
+		self._collect()
+
+	def remove(self, name):
+		""" Removes the rule called name
+		"""
+		del self._rules[name]
+		del self._code[name]
+		self._dropped += 1
+		self._collect()
+
+	def _collect(self):
+		""" Rebuilds the graph once as many rules have been replaced or
+			removed as there are rules, dropping the subexpressions only they
+			used. Evaluations already running carry on with the old graph.
+		"""
+		if self._dropped <= len(self._rules):
+			return
+		table = {}
+		slots = {}
+		rules = {}
+		codes = {}
+		for name, tree in self._rules.items():
+			code = None
+			if tree is not None:
+				tree = _share(tree, table)
+				code = assemble(tree, slots)
+			rules[name] = tree
+			codes[name] = code
+		self._table, self._slots, self._rules, self._code = table, slots, rules, codes
+		self._dropped = 0
+
+	def __len__(self):
+		return len(self._rules)
+
+	def __contains__(self, name):
+		return name in self._rules
+
+	@property
+	def names(self):
+		return list(self._rules)
+
+	@property
+	def size(self):
+		""" The number of distinct subexpressions across all the rules
+		"""
+		return len(self._table)
+
+	def tree(self, name):
+		""" Returns the shared tree of the rule called name
+		"""
+		return self._rules[name]
+
+	def variables(self, names=None):
+		""" Returns the variables used by the rules, or just those in names,
+			each once
+		"""
+		if names is None:
+			names = self._rules
+		variables = []
+		seen = set()
+		for name in names:
+			for variable in analyze_code(self._code[name]).variables:
+				if variable not in seen:
+					seen.add(variable)
+					variables.append(variable)
+		return variables
+
+	def evaluate(self, environment={}, fail_silently=None, names=None):
+		""" Returns a dict mapping each rule name, or just those in names, to
+			its value
+		"""
+		if fail_silently is None:
+			fail_silently = self.fail_silently
+		# the memo slots are only the same within one graph
+		codes = self._code
+		if names is None:
+			names = codes
+		environment = as_environment(environment)
+		memo = {}
+		results = {}
+		for name in names:
+			code = codes[name]
+			if code is None:
+				results[name] = None
+			else:
+				results[name] = run(code, environment, fail_silently, memo)
+		return results
+
+
+def _conjuncts(node):
+	""" Returns the operands of a chain of ands, left to right
+	"""
+	conjuncts = []
+	pending = [node]
+	while pending:
+		node = pending.pop()
+		if isinstance(node, BinOp) and node.op == "and":
+			pending.append(node.right)
+			pending.append(node.left)
+		else:
+			conjuncts.append(node)
+	return conjuncts
+
+def _guard(node):
+	""" Returns (name, values, function) if node only holds when the variable
+		name equals one of values, otherwise None. function is the name of
+		the environment function the test relies on, if any.
+	"""
+	if isinstance(node, BinOp) and node.op == "eq":
+		name, value = node.left, node.right
+		if isinstance(name, Constant):
+			name, value = value, name
+		if isinstance(name, Name) and isinstance(value, Constant):
+			return name.name, (value.value,), None
+	elif isinstance(node, Call) and node.name == "in" and len(node.args) == 2:
+		name, values = node.args
+		if not isinstance(name, Name):
+			return None
+		if isinstance(values, Constant) and isinstance(values.value, frozenset):
+			return name.name, tuple(values.value), "in"
+		if isinstance(values, List) and \
+				all(isinstance(value, Constant) for value in values.items):
+			return name.name, tuple(value.value for value in values.items), "in"
+	return None
+
+class RuleIndex(object):
+	""" Picks out the rules that could be true for an environment before 
+		evaluating anything.
+
+		Rules whose top level conjunction includes a test like 
+		``country eq 'US'``, ``tier == 3`` or ``in(category, ['a', 'b'])`` 
+		are indexed on it. For an environment, a hash lookup on the variable 
+		finds the rules whose test can pass; only those and the rules without 
+		such a test are evaluated. Every other rule is reported as False.
+	"""
+	def __init__(self, rules={}, fail_silently=True):
+		self._rule_set = RuleSet(fail_silently=fail_silently)
+		self._unguarded = set()
+		self._guarded = {} # rule name -> (variable, function)
+		self._by_function = {} # function -> set of rule names
+		self._index = {} # variable -> value -> set of rule names
+		for name, expr in rules.items():
+			self.add(name, expr)
+
+	def add(self, name, expr):
+		""" Adds or replaces the rule called name
+		"""
+		self._remove(name)
+		self._rule_set.add(name, expr)
+		tree = self._rule_set.tree(name)
+		guard = None
+		if tree is not None:
+			for conjunct in _conjuncts(tree):
+				guard = _guard(conjunct)
+				if guard is not None:
+					break
+		if guard is None:
+			self._unguarded.add(name)
+			return
+		variable, values, function = guard
+		self._guarded[name] = (variable, function)
+		if function is not None:
+			self._by_function.setdefault(function, set()).add(name)
+		by_value = self._index.setdefault(variable, {})
+		for value in values:
+			by_value.setdefault(value, set()).add(name)
+
+	def _remove(self, name):
+		self._unguarded.discard(name)
+		guard = self._guarded.pop(name, None)
+		if guard is not None:
+			variable, function = guard
+			for names in self._index[variable].values():
+				names.discard(name)
+			if function is not None:
+				self._by_function[function].discard(name)
+
+	def __len__(self):
+		return len(self._rule_set)
+
+	def candidates(self, environment):
+		""" Returns the names of the rules that could be true in environment
+		"""
+		candidates = set(self._unguarded)
+		for variable, by_value in self._index.items():
+			names = None
+			value = environment[variable] if variable in environment else MISSING
+			# a function is called for its value, which is left to evaluating
+			# the rule
+			if value is not MISSING and type(value) not in CALLED_BY_NAME:
+				try:
+					names = by_value.get(value, ())
+				except TypeError:
+					pass # unhashable, so the index can't rule anything out
+			if names is not None:
+				candidates.update(names)
+				continue
+			for names in by_value.values():
+				candidates.update(names)
+		# environments can replace the functions guards rely on
+		for function, names in self._by_function.items():
+			if function in environment:
+				candidates.update(names)
+		return candidates
+
+	def evaluate(self, environment={}, fail_silently=None):
+		""" Returns a dict mapping each rule name to its value, evaluating
+			only the candidate rules
+		"""
+		environment = as_environment(environment)
+		candidates = self.candidates(environment)
+		results = dict.fromkeys(self._rule_set.names, False)
+		results.update(self._rule_set.evaluate(environment, fail_silently, candidates))
+		return results
+
+class RuleRegistry(object):
+	""" Compiled rules kept under ids, such as the rules a server evaluates
+		for its clients. They are compiled into one RuleSet, so evaluating
+		several of them against an environment evaluates what they share
+		once. environment holds values and functions every evaluation can
+		use, which the environments evaluated against can override.
+
+		Registering takes a lock, but evaluating doesn't, so rules can be
+		registered while others are being evaluated: a rule only becomes
+		visible once it has been added to the RuleSet.
+
+		With max_rules, registering more than that many drops the rules
+		registered longest ago.
+	"""
+	def __init__(self, rules={}, environment={}, max_rules=None):
+		self.environment = environment
+		self.max_rules = max_rules
+		self._rule_set = RuleSet(fail_silently=False)
+		self._exprs = {} # id -> the expression registered under it, oldest first
+		self._lock = threading.Lock()
+		self.add(rules)
+
+	def add(self, rules):
+		""" Registers rules, a dict mapping ids to expressions or compiled
+			expressions, replacing any already under those ids. Registering
+			the same expression again does nothing.
+		"""
+		with self._lock:
+			for rule_id, expr in rules.items():
+				if not isinstance(expr, CompiledExpression):
+					expr = compile(expr, fail_silently=False)
+				if self._exprs.get(rule_id) == expr.expr:
+					continue
+				self._rule_set.add(rule_id, expr)
+				self._exprs.pop(rule_id, None)
+				self._exprs[rule_id] = expr.expr
+			while self.max_rules is not None and len(self._exprs) > self.max_rules:
+				rule_id = next(iter(self._exprs))
+				del self._exprs[rule_id]
+				self._rule_set.remove(rule_id)
+
+	def __len__(self):
+		return len(self._exprs)
+
+	def __contains__(self, rule_id):
+		return rule_id in self._exprs
+
+	def expressions(self):
+		""" Returns a dict mapping each id to its expression
+		"""
+		return dict(self._exprs)
+
+	def evaluate(self, rule_ids, environment={}, fail_silently=True):
+		""" Returns a dict mapping each of rule_ids to its value in
+			environment
+		"""
+		if self.environment:
+			merged = dict(self.environment)
+			merged.update(environment)
+			environment = merged
+		return self._rule_set.evaluate(environment, fail_silently, rule_ids)
+
+def _uses(tree):
+	""" Returns a dict mapping each variable and function name tree uses to
+		the nodes that depend on it
+	"""
+	uses = {}
+	def names(node, children):
+		found = set()
+		for child in children:
+			found.update(child)
+		if isinstance(node, (Name, Call)):
+			found.add(node.name)
+		for name in found:
+			uses.setdefault(name, []).append(node)
+		return found
+	transform(tree, names)
+	return uses
+
+def _same(old, new):
+	if isinstance(old, EvaluationError) and isinstance(new, EvaluationError):
+		return str(old) == str(new)
+	try:
+		return type(old) is type(new) and bool(old == new)
+	except Exception:
+		return False # such as arrays, which don't compare to a single bool
+
+class IncrementalEvaluator(object):
+	""" Keeps the values of rules up to date as the variables of one long
+		lived environment change.
+
+		The rules are compiled into a RuleSet and the value of every
+		subexpression evaluated is kept. Each variable and function name is
+		mapped to the subexpressions and rules that use it, so update only
+		forgets those and evaluates the rules using the name again, reusing
+		the value of everything else. As in a RuleSet, environment functions
+		are taken to give the same result for the same arguments.
+
+		With collect_errors, a rule that fails to evaluate gets an
+		EvaluationError as its value. Otherwise update raises, and the rules
+		it didn't get to are evaluated by the next one.
+	"""
+	def __init__(self, rules, environment={}, fail_silently=True,
+			collect_errors=False):
+		self.fail_silently = fail_silently
+		self.collect_errors = collect_errors
+		self._rule_set = RuleSet(rules, fail_silently)
+		self._environment = dict(environment)
+		self._memo = {}
+		self._slots = {} # name -> memo slots of the subexpressions using it
+		self._rules = {} # name -> the rules using it
+		self._order = dict((rule, index) for index, rule in
+			enumerate(self._rule_set.names))
+		self._results = {}
+		slots = self._rule_set._slots
+		for rule in self._rule_set.names:
+			tree = self._rule_set.tree(rule)
+			if tree is None:
+				continue
+			for name, nodes in _uses(tree).items():
+				self._rules.setdefault(name, set()).add(rule)
+				memoized = self._slots.setdefault(name, set())
+				for node in nodes:
+					slot = slots.get(id(node))
+					if slot is not None:
+						memoized.add(slot)
+		self._stale = set(self._order)
+		self._refresh()
+
+	@property
+	def results(self):
+		""" A dict mapping each rule to its current value
+		"""
+		return dict(self._results)
+
+	def __getitem__(self, rule):
+		return self._results[rule]
+
+	@property
+	def environment(self):
+		return dict(self._environment)
+
+	def update(self, name, value):
+		""" Sets the variable or function name to value. Returns a dict
+			mapping each rule whose value changed to its new value.
+		"""
+		return self.update_many({name : value})
+
+	def update_many(self, values):
+		""" Sets several variables at once, evaluating each rule they affect
+			only once
+		"""
+		for name, value in values.items():
+			self._environment[name] = value
+			self._forget(name)
+		return self._refresh()
+
+	def remove(self, name):
+		""" Removes name from the environment, returning the rules that
+			changed as update does
+		"""
+		del self._environment[name]
+		self._forget(name)
+		return self._refresh()
+
+	def _forget(self, name):
+		memo = self._memo
+		for slot in self._slots.get(name, ()):
+			memo.pop(slot, None)
+		self._stale.update(self._rules.get(name, ()))
+
+	def _evaluate(self, rule):
+		code = self._rule_set._code[rule]
+		if code is None:
+			return None
+		if not self.collect_errors:
+			return run(code, self._environment, self.fail_silently, self._memo)
+		try:
+			return run(code, self._environment, self.fail_silently, self._memo)
+		except ROW_ERRORS as e:
+			return EvaluationError("Rule %s failed to evaluate: %s" % (rule, e),
+				None, e)
+
+	def _refresh(self):
+		changed = {}
+		for rule in sorted(self._stale, key=self._order.__getitem__):
+			value = self._evaluate(rule)
+			self._stale.discard(rule)
+			old = self._results.get(rule, MISSING)
+			self._results[rule] = value
+			if old is MISSING or not _same(old, value):
+				changed[rule] = value
+		return changed
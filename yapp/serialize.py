@@ -0,0 +1,195 @@
+""" Saves compiled expressions in a versioned binary format and loads them
+	back without parsing.
+
+	A saved expression holds its text, its instructions and the values they
+	use. Everything is little endian:
+
+		magic             b"YAPC"
+		format version    uint16
+		flags             uint8, bit 0 set if the expression parsed
+		expr              uint32 length, utf-8
+		values            uint32 count, each a tagged value
+		opcodes           uint32 count, a byte each
+		operands          two int32 per opcode
+
+	Ints are saved as their two's complement bytes, however many digits
+	they have.
+"""
+import struct
+import sys
+from array import array
+
+from yapp.bytecode import Code, _INDEXED, CONST, NAME, BINOP, LIST, FUNC, CALL, \
+	JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, JUMP_IF_DECIDED
+from yapp.exceptions import SerializationError
+from yapp.optimizer import LiteralSet
+
+MAGIC = b"YAPC"
+FORMAT_VERSION = 2
+
+_header = struct.Struct("<4sHB")
+_length = struct.Struct("<I")
+_float = struct.Struct("<d")
+_complex = struct.Struct("<dd")
+_PARSED = 1
+
+# What a saved expression can hold. Memo slots are only used by RuleSet.
+_SAVED = (CONST, NAME, BINOP, LIST, FUNC, CALL, JUMP_IF_FALSE_OR_POP,
+	JUMP_IF_TRUE_OR_POP, JUMP_IF_DECIDED)
+_JUMPS = (FUNC, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, JUMP_IF_DECIDED)
+
+def _write_text(pieces, text):
+	data = text.encode("utf-8")
+	pieces.append(_length.pack(len(data)))
+	pieces.append(data)
+
+def _write_value(pieces, value):
+	# bool comes first since it's a kind of int
+	if isinstance(value, bool):
+		pieces.append(b"T" if value else b"F")
+	elif isinstance(value, int):
+		pieces.append(b"i")
+		data = value.to_bytes(value.bit_length() // 8 + 1, "little", signed=True)
+		pieces.append(_length.pack(len(data)))
+		pieces.append(data)
+	elif isinstance(value, float):
+		pieces.append(b"f")
+		pieces.append(_float.pack(value))
+	elif isinstance(value, complex):
+		pieces.append(b"c")
+		pieces.append(_complex.pack(value.real, value.imag))
+	elif isinstance(value, str):
+		pieces.append(b"s")
+		_write_text(pieces, value)
+	elif isinstance(value, frozenset):
+		if isinstance(value, LiteralSet):
+			pieces.append(b"L")
+			items = value.items # in the order they were written
+		else:
+			pieces.append(b"z")
+			items = value
+		pieces.append(_length.pack(len(items)))
+		for item in items:
+			_write_value(pieces, item)
+	else:
+		raise SerializationError("Can't save the constant %r" % (value,))
+
+def dumps(compiled):
+	""" Returns compiled as bytes
+	"""
+	pieces = [None]
+	_write_text(pieces, compiled.expr)
+	code = compiled.code
+	if code is None:
+		pieces[0] = _header.pack(MAGIC, FORMAT_VERSION, 0)
+		return b"".join(pieces)
+	pieces[0] = _header.pack(MAGIC, FORMAT_VERSION, _PARSED)
+
+	pieces.append(_length.pack(len(code.values)))
+	for value in code.values:
+		_write_value(pieces, value)
+	pieces.append(_length.pack(len(code.opcodes)))
+	pieces.append(code.opcodes.tobytes())
+	operands = code.operands
+	if sys.byteorder == "big":
+		operands = array("i", operands)
+		operands.byteswap()
+	pieces.append(operands.tobytes())
+	return b"".join(pieces)
+
+class _Reader(object):
+	__slots__ = ("data", "offset")
+
+	def __init__(self, data):
+		self.data = data
+		self.offset = 0
+
+	def unpack(self, format):
+		values = format.unpack_from(self.data, self.offset)
+		self.offset += format.size
+		return values
+
+	def read(self, size):
+		if self.offset + size > len(self.data):
+			raise SerializationError("The data is truncated")
+		data = self.data[self.offset:self.offset + size]
+		self.offset += size
+		return data
+
+	def text(self):
+		size, = self.unpack(_length)
+		return str(self.read(size), "utf-8")
+
+	def value(self):
+		tag = bytes(self.read(1))
+		if tag == b"T":
+			return True
+		elif tag == b"F":
+			return False
+		elif tag == b"i":
+			size, = self.unpack(_length)
+			return int.from_bytes(self.read(size), "little", signed=True)
+		elif tag == b"f":
+			return self.unpack(_float)[0]
+		elif tag == b"c":
+			return complex(*self.unpack(_complex))
+		elif tag == b"s":
+			return self.text()
+		elif tag in (b"L", b"z"):
+			size, = self.unpack(_length)
+			items = [self.value() for i in range(size)]
+			return LiteralSet(items) if tag == b"L" else frozenset(items)
+		raise SerializationError("Unknown value tag %r" % tag)
+
+def _check(opcodes, operands, count):
+	""" Raises SerializationError unless every instruction is one that is
+		saved, refers to one of the count values if it refers to one, and
+		only jumps forward within the code
+	"""
+	for index, opcode in enumerate(opcodes):
+		arg = operands[2 * index]
+		if opcode not in _SAVED:
+			raise SerializationError("The data is corrupt: unknown opcode %d" % opcode)
+		elif opcode in _INDEXED and not 0 <= arg < count:
+			raise SerializationError("The data is corrupt: a value is missing")
+		elif opcode in (LIST, CALL) and arg < 0:
+			raise SerializationError("The data is corrupt: a negative count")
+		if opcode in _JUMPS and not index < operands[2 * index + 1] <= len(opcodes):
+			raise SerializationError("The data is corrupt: a jump out of place")
+
+def loads(data, codegen=False):
+	""" Returns the CompiledExpression saved in data, which can be bytes or
+		a memoryview, such as a slice of a memory map
+	"""
+	from yapp import CompiledExpression, _build_compiled
+	reader = _Reader(memoryview(data))
+	try:
+		magic, version, flags = reader.unpack(_header)
+		if magic != MAGIC:
+			raise SerializationError("Not a saved yapp expression")
+		if version != FORMAT_VERSION:
+			raise SerializationError("Saved in format %s, this version of yapp "
+				"reads format %s" % (version, FORMAT_VERSION))
+		expr = reader.text()
+		if not flags & _PARSED:
+			return CompiledExpression(expr, None)
+		count, = reader.unpack(_length)
+		values = []
+		for i in range(count):
+			value = reader.value()
+			values.append(sys.intern(value) if isinstance(value, str) else value)
+		count, = reader.unpack(_length)
+		opcodes = array("B")
+		opcodes.frombytes(reader.read(count))
+		operands = array("i")
+		operands.frombytes(reader.read(8 * count))
+	except (struct.error, UnicodeDecodeError, ValueError) as e:
+		raise SerializationError("The data is corrupt: %s" % e)
+	if sys.byteorder == "big":
+		operands.byteswap()
+	_check(opcodes, operands, len(values))
+	code = Code(opcodes, operands, tuple(values))
+	compiled = CompiledExpression(expr, None, code=code)
+	if codegen:
+		compiled = _build_compiled(expr, compiled.tree, True)
+	return compiled
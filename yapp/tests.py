@@ -1,7 +1,46 @@
-from django.test import TestCase
+import ast
+import asyncio
+import functools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+from unittest import skipIf
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db.models import Model, QuerySet, CharField, IntegerField, FloatField, \
+    BooleanField
+from django.test import TestCase, override_settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from yapp import *
 from yapp.exceptions import *
+from yapp.grammar import ident, integer, decimal
+from yapp.parallel import ParallelEvaluator
+from yapp.rules import RuleSet, RuleIndex, RuleRegistry, IncrementalEvaluator
+from yapp import views
+from yapp.serialize import dumps, loads
+from yapp.diskcache import DiskCache
+from yapp.orm import translate, filter_queryset
+
+class Record(Model):
+    """ Rows for testing expressions translated into queries
+    """
+    name = CharField(max_length=20)
+    age = IntegerField()
+    score = FloatField()
+    active = BooleanField(default=True)
+
+    class Meta:
+        app_label = "yapp"
 
 class YappTest(TestCase):
     def test_yapp(self):
@@ -10,28 +49,26 @@ class YappTest(TestCase):
         # Test variables
         indents = ["x", "x1", "x_1"]
         for var in indents:
-        	self.assertIn(var, ident.parseString(var)[0])
+                self.assertIn(var, ident.parseString(var)[0])
 
         # Test numbers (ints and floats)
         nums = range(-10, 10)
         for num in nums:
-        	self.assertIn(str(num), integer.parseString(str(num))[0])
+                self.assertIn(str(num), integer.parseString(str(num))[0])
 
         nums = [1.012 * x for x in range(-10, 10)]
         for num in nums:
-        	self.assertIn(str(num), decimal.parseString(str(num))[0])
+                self.assertIn(str(num), decimal.parseString(str(num))[0])
 
         tests = ["'a'", "2", "-4", "2.13", "2.", "2 ^ 13", "2 * 4", "4 /2",
-	         "4 * 3", "5.34 * 3", "3.4 + 1", "2+3+4", "(2+3)", "2 + (3 * 4)", "2 * 3.0"]
+                 "4 * 3", "5.34 * 3", "3.4 + 1", "2+3+4", "(2+3)", "2 + (3 * 4)", "2 * 3.0"]
         for test in tests:
-	    	# these should give no errors
-    		stack[:] = []
-    		result = get_grammar().parseString(test)
-    		value = parse(test, fail_silently=True)
-    		if not re.search("[a-zA-Z]+", test):
-    			test = test.replace("^", "**")
-    			self.assertEquals(value, eval(test))
-    		#print("Stack after: %s = %s, result = %s" % (test, stack, result))
+                # these should give no errors
+                result = get_grammar().parseString(test)
+                value = parse(test, fail_silently=True)
+                if not re.search("[a-zA-Z]+", test):
+                        test = test.replace("^", "**")
+                        self.assertEquals(value, eval(test))
 
         # Start testing functions
         environment = {
@@ -141,3 +178,1291 @@ class YappTest(TestCase):
         self.assertFalse(parse("2 eq 3", environment))
         self.assertFalse(parse("abool eq falsebool", environment))
 
+    def test_compile(self):
+        environment = {
+            "minus" : lambda x,y: x-y,
+            "x" : 2,
+        }
+        compiled = compile("3 * x + minus(x, 1)")
+        self.assertEqual(compiled.expr, "3 * x + minus(x, 1)")
+        # the same compiled expression can be evaluated repeatedly
+        for i in range(3):
+            self.assertEqual(compiled.evaluate(environment), 7)
+        self.assertEqual(compiled.evaluate({"minus" : lambda x,y: x-y, "x" : 3}), 11)
+
+        with self.assertRaises(ParseError):
+            compile("2 / ", fail_silently=False)
+
+        compiled = compile("x * 2")
+        with self.assertRaises(VariableMissingException):
+            compiled.evaluate(fail_silently=False)
+
+    def test_grammar(self):
+        # the grammar is built once and shared
+        self.assertIs(get_grammar(), get_grammar())
+        tree = get_grammar().parseString("minus(x, 2) * 3 == [1, 'a']")[0]
+        self.assertEqual(tree, BinOp("*",
+            Call("minus", [Name("x"), Constant(2)]),
+            BinOp("eq", Constant(3), List([Constant(1), Constant("a")]))))
+        # identical subexpressions compare equal
+        self.assertEqual(compile("x + 1").tree, compile("(x + 1)").tree)
+        self.assertNotEqual(Constant(1), Constant(True))
+
+        self.assertFalse(parse("2 == 3"))
+        self.assertEqual(["foo", "x", "x"], get_variables("foo(x) * x + True"))
+        self.assertIsNone(compile("x * ").tree)
+
+        # deep nesting parses with the default parser, on pyparsing 3 too,
+        # which takes more stack per bracket than pyparsing 2
+        depth = 30
+        self.assertEqual(parse("(" * depth + "x" + " + 1)" * depth, {"x" : 1}), depth + 1)
+        self.assertEqual(parse("minus(" * depth + "x" + ", 1)" * depth,
+            {"x" : depth, "minus" : lambda x, y: x - y}), 0)
+
+    def test_operators(self):
+        calls = []
+        def f(x):
+            calls.append(x)
+            return x
+
+        environment = {"f" : f, "x" : 1, "eq" : lambda a, b: "replaced"}
+        for codegen in [False, True]:
+            # infix operators can't be replaced, only the functions
+            self.assertTrue(compile("x eq 1", codegen=codegen).evaluate(environment))
+            self.assertEqual(compile("eq(x, 1)", codegen=codegen).evaluate(environment),
+                "replaced")
+            # operands are evaluated from left to right
+            del calls[:]
+            compile("f(1) + f(2) * f(3) > f(4) - f(5)", codegen=codegen).evaluate(environment)
+            self.assertEqual(calls, [1, 2, 3, 4, 5])
+            with self.assertRaises(ZeroDivisionError):
+                compile("1 / (x - 1) + missing", codegen=codegen).evaluate(environment,
+                    fail_silently=False)
+
+    def test_power_limit(self):
+        for codegen in [False, True]:
+            compiled = compile("x ^ y", codegen=codegen)
+            self.assertEqual(compiled.evaluate({"x" : 2, "y" : 1000}), 2 ** 1000)
+            self.assertEqual(compiled.evaluate({"x" : 1, "y" : 10 ** 12}), 1)
+            self.assertEqual(compiled.evaluate({"x" : 2.0, "y" : -2}), 0.25)
+            with self.assertRaises(OverflowError):
+                compiled.evaluate({"x" : 9, "y" : 999999999})
+            # ^ groups from the left
+            self.assertEqual(compile("x ^ 2 ^ 3", codegen=codegen).evaluate({"x" : -2}), 64)
+        self.assertRaises(OverflowError, parse, "2 ^ (MAX + 1)", {"MAX" : MAX_POWER_BITS})
+
+    def test_expression_cache(self):
+        cache = ExpressionCache(compile, maxsize=2)
+        first = cache.get("x + 1")
+        self.assertIs(cache.get("x + 1"), first)
+        cache.get("x + 2")
+        cache.get("x + 1") # x + 2 is now the least recently used
+        cache.get("x + 3")
+        self.assertIn("x + 1", cache)
+        self.assertNotIn("x + 2", cache)
+        self.assertEqual(cache.stats(), CacheStats(hits=2, misses=3,
+            evictions=1, size=2, maxsize=2))
+
+        # syntax errors are cached but still raised when asked for
+        self.assertIsNone(cache.get("2 / ").tree)
+        with self.assertRaises(ParseError):
+            cache.get("2 / ", fail_silently=False)
+        # and only parsed once
+        compiled_exprs = []
+        def counting_compile(expr, fail_silently=True):
+            compiled_exprs.append(expr)
+            return compile(expr, fail_silently)
+        counting = ExpressionCache(counting_compile)
+        compiled, error = counting.entry("2 / ")
+        self.assertIsNone(compiled.tree)
+        self.assertIsInstance(error, ParseError)
+        self.assertEqual(counting.entry("x")[1], None)
+        self.assertEqual(compiled_exprs, ["2 / ", "x"])
+
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(cache.stats(), CacheStats(0, 0, 0, 0, 1))
+
+        disabled = ExpressionCache(compile, maxsize=0)
+        disabled.get("x")
+        self.assertEqual(len(disabled), 0)
+
+        # parse goes through the shared cache
+        expression_cache.clear()
+        parse("x * 2", {"x" : 1})
+        parse("x * 2", {"x" : 2})
+        self.assertEqual(expression_cache.stats().hits, 1)
+        self.assertEqual(expression_cache.stats().misses, 1)
+        # is_valid has its own cache of the expressions as written
+        analysis_cache.clear()
+        self.assertTrue(is_valid("x * 2", {"x" : 1}))
+        self.assertEqual(get_variables("x * 2"), ["x"])
+        self.assertEqual(analysis_cache.stats().hits, 1)
+        self.assertEqual(analysis_cache.stats().misses, 1)
+
+    def test_codegen(self):
+        environment = {
+            "minus" : lambda x,y: x-y,
+            "x" : 2,
+            "abool" : True,
+            "falsebool" : False,
+            "salutation" : "hello",
+            "notcallable" : 5,
+        }
+        exprs = ["x * 3 + x", "2 ^ 3 ^ 2", "x + 1 > 3", "x * 2 > 3",
+            "abool and falsebool or abool", "abool or falsebool and falsebool",
+            "-4 ^ 2", "2 - -3", "minus(x, -2) eq 4", "1 < 2 eq True",
+            "in('a', ['a', 'b'])", "not(abool)", "salutation == 'hello'",
+            "10 % 4 / 2", "minus(minus(10, 2), minus(x, 1))", "notcallable(1)",
+            "missing * 2", "missing(x)"]
+        for expr in exprs:
+            tree = compile(expr).tree
+            compiled = compile(expr, codegen=True)
+            self.assertIn("def evaluate", generate_source(tree))
+            self.assertEqual(compiled.evaluate(environment),
+                evaluate_node(tree, environment), expr)
+
+        with self.assertRaises(VariableMissingException):
+            compile("x * 2", codegen=True).evaluate(fail_silently=False)
+
+        # too deep for the Python compiler, falls back to walking the tree
+        deep = " + ".join(["x"] * 2000)
+        with self.assertRaises(CodegenError):
+            generate_function(compile(deep).tree)
+        self.assertIsNotNone(compile(deep, codegen=True).tree)
+
+    def test_called_by_name(self):
+        # a function that takes no arguments is called when used by name
+        environment = {"foo" : lambda : 2, "x" : 1, "g" : len, "twice" : lambda x: x * 2}
+        self.assertTrue(parse("foo > 1", {"foo" : lambda : 2}))
+        self.assertEqual(parse("foo * 3 + x", environment), 7)
+        self.assertEqual(compile("foo * 3 + x", codegen=True).evaluate(environment), 7)
+        self.assertEqual(asyncio.run(evaluate_async("foo * 3 + x", environment)), 7)
+        self.assertEqual(asyncio.run(evaluate_async("foo * twice(x)", environment)), 4)
+        # other callables, and functions that need arguments, are values
+        self.assertIs(parse("g", environment), len)
+        self.assertIs(parse("twice", environment), environment["twice"])
+        if numpy is not None:
+            result = evaluate_columns("foo * x", {"x" : numpy.array([1, 2])}, environment)
+            self.assertEqual(result.tolist(), [2, 4])
+
+    @skipIf(numpy is None, "NumPy is not installed")
+    def test_evaluate_columns(self):
+        columns = {
+            "price" : numpy.array([10.0, 500.0, 2000.0]),
+            "qty" : numpy.array([1, 3, 1]),
+            "region" : numpy.array(["US", "FR", "CA"]),
+        }
+        environment = {
+            "double" : lambda x: x * 2,
+            "allowed" : ["FR"],
+            "limit" : 1000,
+        }
+        def check(expr, expected):
+            result = evaluate_columns(expr, columns, environment)
+            self.assertEqual(result.tolist(), expected, expr)
+
+        check("price * qty > limit and in(region, ['US','CA'])", [False, False, True])
+        check("price * qty > limit or region eq 'US'", [True, True, True])
+        check("in(region, allowed)", [False, True, False])
+        check("not(qty > 1)", [True, False, True])
+        check("qty ^ 2 % 5", [1, 4, 1])
+        # functions without a NumPy equivalent are applied row by row
+        check("double(qty) + 1", [3, 7, 3])
+        # constant expressions are broadcast to every row
+        check("3", [3, 3, 3])
+        # values of different types are never equal, as they aren't row by row
+        check("qty eq 'US'", [False, False, False])
+        check("eq(region, qty)", [False, False, False])
+
+        # arithmetic matches evaluating each row
+        numbers = {"x" : numpy.array([1, 2, 0]), "y" : numpy.array([2, -1, 3])}
+        self.assertEqual(evaluate_columns("x ^ y", numbers).tolist(), [1, 0.5, 0])
+        self.assertEqual(evaluate_columns("x ^ 2", numbers).dtype.kind, "i")
+        for expr in ["x / x", "x % 0", "y / 0.0", "x ^ -1"]:
+            with self.assertRaises(ZeroDivisionError):
+                evaluate_columns(expr, numbers)
+            with self.assertRaises(ZeroDivisionError):
+                for x, y in zip([1, 2, 0], [2, -1, 3]):
+                    parse(expr, {"x" : x, "y" : y})
+        # rows and/or have already decided don't divide
+        rows = {"x" : [0, 2, 4], "y" : [5, 6, 1]}
+        for expr in ["x > 0 and y / x > 2", "x eq 0 or y / x > 2",
+                "and(x > 0, y / x > 2)", "x > 0 and (x < 3 or y / (x - 2) > 2)"]:
+            expected = [parse(expr, {"x" : x, "y" : y}) for x, y in zip(*rows.values())]
+            self.assertEqual(evaluate_columns(expr, rows).tolist(), expected, expr)
+        with self.assertRaises(ZeroDivisionError):
+            evaluate_columns("x > 2 and y / (x - 4) > 2", rows)
+        # nor do they look at values of other types
+        codes = {"c" : ["1", "US", "x"]}
+        for expr in ["in(c, ['US', 1])", "in(c, [1, 'US', 2.5])", "in(c, ['1', 'x'])"]:
+            expected = [parse(expr, {"c" : c}) for c in codes["c"]]
+            self.assertEqual(evaluate_columns(expr, codes).tolist(), expected, expr)
+        mixed = {"x" : [0, 5], "y" : ["a", 3]}
+        self.assertEqual(evaluate_columns("x > 0 and y + 1 > 2", mixed).tolist(), [False, True])
+        self.assertEqual(evaluate_columns("x eq 0 or y + 1 > 2", mixed).tolist(), [True, True])
+        self.assertEqual(evaluate_columns("and(x > 0, y + 1)", mixed).tolist(), [False, 4])
+        with self.assertRaises(VariableMissingException):
+            evaluate_columns("x > 0 and missing", mixed, fail_silently=False)
+        self.assertEqual(evaluate_columns("x > 9 and missing", mixed,
+            fail_silently=False).tolist(), [False, False])
+
+        with self.assertRaises(ValueError):
+            evaluate_columns("x", {"x" : numpy.array([1]), "y" : numpy.array([1, 2])})
+        with self.assertRaises(VariableMissingException):
+            evaluate_columns("missing > 1", columns, fail_silently=False)
+
+    def test_evaluate_many(self):
+        def environments():
+            for x in [1, 2, 0, 4]:
+                yield {"x" : x}
+
+        results = evaluate_many("8 / x", environments())
+        self.assertEqual(next(results), 8)
+        self.assertEqual(next(results), 4)
+        with self.assertRaises(ZeroDivisionError):
+            next(results)
+
+        results = list(evaluate_many("8 / x", environments(), collect_errors=True))
+        self.assertEqual(results[:2], [8, 4])
+        self.assertIsInstance(results[2], EvaluationError)
+        self.assertEqual(results[2].index, 2)
+        self.assertIsInstance(results[2].error, ZeroDivisionError)
+        self.assertEqual(results[3], 2)
+
+        results = list(evaluate_many("x * y", [{"x" : 1, "y" : 2}, {"x" : 1}],
+            fail_silently=False, collect_errors=True))
+        self.assertEqual(results[0], 2)
+        self.assertIsInstance(results[1].error, VariableMissingException)
+
+    def test_parallel_evaluator(self):
+        rules = {
+            "double" : "x * 2",
+            "big" : compile("x > 5", codegen=True),
+            "ratio" : "10 / x",
+        }
+        records = ({"x" : x} for x in range(10))
+        with ParallelEvaluator(rules, max_workers=2, chunksize=3,
+                collect_errors=True) as evaluator:
+            results = list(evaluator.map(records))
+            self.assertEqual([r["double"] for r in results], [x * 2 for x in range(10)])
+            self.assertEqual([r["big"] for r in results], [x > 5 for x in range(10)])
+            self.assertIsInstance(results[0]["ratio"], EvaluationError)
+            self.assertEqual(results[0]["ratio"].index, 0)
+            self.assertEqual(results[5]["ratio"], 2)
+
+            unordered = dict(evaluator.map_unordered({"x" : x} for x in range(10)))
+            self.assertEqual(sorted(unordered), list(range(10)))
+            self.assertEqual(unordered[7]["double"], 14)
+
+        with ParallelEvaluator({"sum" : "x + offset"}, environment={"offset" : 1},
+                max_workers=1) as evaluator:
+            self.assertEqual(list(evaluator.map([{"x" : 1}])), [{"sum" : 2}])
+
+        with self.assertRaises(ParseError):
+            ParallelEvaluator({"y" : "y * "}, fail_silently=False)
+        with ParallelEvaluator({"y" : "y"}, max_workers=1, fail_silently=False) as evaluator:
+            with self.assertRaises(VariableMissingException):
+                list(evaluator.map([{}]))
+
+    def test_rule_set(self):
+        calls = []
+        def minus(a, b):
+            calls.append((a, b))
+            return a - b
+
+        rules = RuleSet({
+            "positive" : "minus(a, b) > 0",
+            "big" : "minus(a, b) * rate > 100",
+            "open" : "status eq 'open' and minus(a, b) > 0",
+        })
+        rules.add("broken", "x * ")
+        environment = {"minus" : minus, "a" : 50, "b" : 20, "rate" : 4,
+            "status" : "open"}
+        self.assertEqual(rules.evaluate(environment), {
+            "positive" : True, "big" : True, "open" : True, "broken" : None})
+        # minus(a, b) is shared by all three rules but only called once
+        self.assertEqual(calls, [(50, 20)])
+        self.assertEqual(len(rules), 4)
+        self.assertIn("open", rules)
+
+        distinct = rules.size
+        rules.add("again", "minus(a, b) > 0")
+        self.assertEqual(rules.size, distinct)
+
+        with self.assertRaises(VariableMissingException):
+            rules.evaluate({}, fail_silently=False)
+
+        # what replaced and removed rules used is dropped
+        for i in range(100):
+            rules.add("open", "status eq 'open%d'" % i)
+        self.assertLess(rules.size, 3 * distinct)
+        rules.remove("again")
+        self.assertEqual(rules.evaluate(dict(environment, status="open99")), {
+            "positive" : True, "big" : True, "open" : True, "broken" : None})
+        self.assertEqual(sorted(rules.names), ["big", "broken", "open", "positive"])
+
+        registry = RuleRegistry({"a" : "x", "b" : "x + 1"}, max_rules=2)
+        registry.add({"a" : "x - 1", "c" : "x * 2"})
+        self.assertEqual(registry.expressions(), {"a" : "x - 1", "c" : "x * 2"})
+        self.assertEqual(registry.evaluate(["a", "c"], {"x" : 3}), {"a" : 2, "c" : 6})
+
+    def test_rule_index(self):
+        calls = []
+        def lookup(value):
+            calls.append(value)
+            return value
+
+        index = RuleIndex({
+            "us" : "country eq 'US' and lookup(amount) > 10",
+            "tier3" : "amount > 5 and tier == 3",
+            "ab" : "in(category, ['a', 'b']) and lookup(amount) > 1",
+            "unguarded" : "amount > 100",
+        })
+        environment = {"country" : "CA", "tier" : 3, "category" : "a",
+            "amount" : 20, "lookup" : lookup}
+        self.assertEqual(index.candidates(environment), set(["tier3", "ab", "unguarded"]))
+        self.assertEqual(index.evaluate(environment), {
+            "us" : False, "tier3" : True, "ab" : True, "unguarded" : False})
+        self.assertEqual(calls, [20]) # "us" was never evaluated
+
+        # missing or unhashable values can't be looked up
+        self.assertIn("us", index.candidates({"tier" : 1, "category" : "c"}))
+        self.assertIn("ab", index.candidates({"category" : ["a"]}))
+        # neither can overridden functions
+        self.assertIn("ab", index.candidates({"category" : "c", "in" : lambda x,y: True}))
+        # nor can functions called for their value
+        called = RuleIndex({"r" : "country eq 'US' and x > 1"})
+        environment = {"country" : lambda: "US", "x" : 5}
+        self.assertEqual(called.evaluate(environment), {"r" : True})
+
+        index.add("us", "amount > 1")
+        self.assertIn("us", index.candidates({"country" : "CA"}))
+        self.assertEqual(len(index), 4)
+
+    def test_short_circuit(self):
+        calls = []
+        def expensive(x):
+            calls.append(x)
+            return x
+
+        environment = {"expensive" : expensive, "yes" : True, "no" : False}
+        exprs = {
+            "no and expensive(1)" : False,
+            "yes or expensive(2)" : True,
+            "and(no, expensive(3))" : False,
+            "or(yes, expensive(4))" : True,
+            "no and expensive(5) or yes" : True,
+            "yes and expensive(0)" : 0,
+            "no or expensive(7)" : 7,
+            "or(no, expensive(8))" : 8,
+        }
+        for codegen in [False, True]:
+            del calls[:]
+            for expr, expected in exprs.items():
+                compiled = compile(expr, codegen=codegen)
+                self.assertEqual(compiled.evaluate(environment), expected, expr)
+            self.assertEqual(sorted(calls), [0, 7, 8])
+
+            # operands that aren't needed are never looked up either
+            self.assertFalse(compile("no and missing", codegen=codegen).evaluate(
+                environment, fail_silently=False))
+
+            # a replacement in the environment gets both arguments when it's
+            # called, but infix and is always the builtin
+            environment["and"] = lambda a, b: (a, b)
+            self.assertEqual(compile("and(no, expensive(9))", codegen=codegen).evaluate(
+                environment), (False, 9))
+            self.assertFalse(compile("no and expensive(10)", codegen=codegen).evaluate(
+                environment))
+            self.assertNotIn(10, calls)
+            del environment["and"]
+
+    def test_optimizer(self):
+        def check(expr, optimized):
+            self.assertEqual(compile(expr).dump(), optimized)
+
+        check("x * (60 * 60 * 24)", "x * 86400")
+        check("True and flag", "flag")
+        check("False and expensive(x)", "False")
+        check("1 > 2 or x", "x")
+        check("True or x", "True")
+        check("2 ^ 3 ^ 2 + x", "64 + x")
+        check("'a' eq 'a' and x", "x")
+        check("0.00001 * x", "0.00001 * x")
+        # errors are left to happen when evaluated
+        check("1 / 0 + x", "1 / 0 + x")
+        # and so are values that can't be written back
+        check("x + (-1) ^ 0.5", "x + -1 ^ 0.5")
+        for expr in ["x + (-1) ^ 0.5", "x + 10.0 ^ 308 * 10"]:
+            compiled = compile(expr)
+            self.assertEqual(compile(compiled.dump()).tree, compiled.tree)
+        self.assertEqual(compile("10.0 ^ 308 * 10").evaluate(), float("inf"))
+        inf = Constant(float("inf"))
+        self.assertEqual(optimize_tree(BinOp("-", inf, inf)), BinOp("-", inf, inf))
+        # constants too big to be worth folding are left to be worked out
+        check("10 ^ 30000000 > x", "10 ^ 30000000 > x")
+        check("'ab' * 200000000 eq x", "'ab' * 200000000 eq x")
+        check("'%0999999999d' % 1 eq x", "'%0999999999d' % 1 eq x")
+        compiled = compile("10 ^ 3000 * 10 ^ 3000 > x")
+        self.assertIsInstance(compiled.tree.left, BinOp)
+        self.assertEqual(compile(compiled.dump()).tree, compiled.tree)
+        self.assertTrue(parse("10 ^ 5000 > x", {"x" : 1}))
+        check("'ab' * 3 + x", "'ababab' + x")
+        # formatting keeps the grouping
+        check("x - (y - 1)", "x - (y - 1)")
+        check("(x eq y) eq z", "(x eq y) eq z")
+        check("(x + 1) * 2 > 3 and y", "(x + 1) * 2 > 3 and y")
+        # calls other than in() can be replaced, so aren't touched
+        check("not(True)", "not(True)")
+        self.assertEqual(compile("x * (60 * 60)", optimize=False).dump(), "x * (60 * 60)")
+
+        codes = ", ".join(["'A%d'" % i for i in range(400)])
+        compiled = compile("in(code, [%s])" % codes)
+        self.assertIsInstance(compiled.tree.args[1].value, LiteralSet)
+        for codegen in [False, True]:
+            compiled = compile("in(code, [%s])" % codes, codegen=codegen)
+            self.assertTrue(compiled.evaluate({"code" : "A399"}))
+            self.assertFalse(compiled.evaluate({"code" : "B1"}))
+            self.assertFalse(compiled.evaluate({"code" : ["A1"]}))
+            # an in() from the environment is given the list as written
+            replaced = {"in" : lambda a, b: b.index(a) == 1, "code" : "A1"}
+            self.assertTrue(compiled.evaluate(replaced))
+            self.assertEqual(compile("in(x, [2, 1, 2])", codegen=codegen).evaluate(
+                {"x" : 1, "in" : lambda a, b: b}), [2, 1, 2])
+        self.assertEqual(compile("in(x, [3, 1])").dump(), "in(x, [3, 1])")
+        self.assertTrue(parse("in(True, [1, 2])"))
+        self.assertEqual(compile("in(x, [[1], 2])").tree.args[1], List([List([Constant(1)]), Constant(2)]))
+
+        exprs = ["x * (60 * 60 * 24)", "True and x", "False or x", "2 ^ 3 ^ 2 + x",
+            "in(x, [1, 2, 3])", "x - (2 - 1)", "(1 + 2) * x", "x * (2.0 ^ 70)"]
+        for expr in exprs:
+            self.assertEqual(compile(expr).evaluate({"x" : 3}),
+                compile(expr, optimize=False).evaluate({"x" : 3}), expr)
+            # the optimized form parses back to the same tree
+            self.assertEqual(compile(compile(expr).dump()).tree, compile(expr).tree)
+
+    def test_large_expressions(self):
+        terms = 5000
+        expr = " or ".join(["x%d eq %d" % (i, i) for i in range(terms)])
+        compiled = compile(expr, fail_silently=False, parser="pratt")
+        self.assertTrue(compiled.evaluate({"x%d" % (terms - 1) : terms - 1}))
+        self.assertFalse(compiled.evaluate({}))
+        self.assertEqual(compiled.dump(), expr)
+        self.assertTrue(compile(" eq ".join(["x"] * terms), parser="pratt").evaluate({"x" : True}))
+        sums = compile(" + ".join(["x"] * terms) + " > 0 and y", parser="pratt")
+        self.assertEqual(sums.evaluate({"x" : 1, "y" : 7}), 7)
+
+        # built directly, since brackets and calls still nest in the parser
+        tree = Constant(0)
+        for i in range(terms):
+            tree = Call("minus", [tree, Name("x")])
+        self.assertEqual(evaluate_node(tree, {"minus" : lambda a, b: a - b, "x" : 2}), -2 * terms)
+        self.assertTrue(to_source(tree).startswith("minus(minus("))
+        rule_set = RuleSet()
+        rule_set.add("deep", CompiledExpression("deep", tree))
+        self.assertEqual(rule_set.evaluate({"minus" : lambda a, b: a - b, "x" : 1}), {"deep" : -terms})
+
+    def test_bytecode(self):
+        compiled = compile("a > 1 and b", optimize=False)
+        self.assertEqual([line.split()[1] for line in compiled.disassemble().splitlines()],
+            ["NAME", "CONST", "BINOP", "JUMP_IF_FALSE_OR_POP", "NAME"])
+        self.assertEqual(compiled.evaluate({"a" : 0, "b" : 5}), False)
+        self.assertEqual(compiled.evaluate({"a" : 2, "b" : 5}), 5)
+        self.assertIsNone(compile("a +", fail_silently=True).disassemble())
+        self.assertEqual(compiled.code.opcodes.typecode, "B")
+        self.assertEqual(compiled.code.operands.typecode, "i")
+        self.assertFalse(hasattr(compiled, "__dict__"))
+        # each value is kept once per expression, and names once overall
+        self.assertEqual(compile("x eq 5 and x eq 6").code.values, ("eq", "x", 5, 6))
+        first = compile("tenant eq 'T1' and amount > 1.5").code.values
+        second = compile("amount > 1.5 or tenant eq 'T1'").code.values
+        self.assertIs(first[first.index("tenant")], second[second.index("tenant")])
+        # 1, 1.0 and True stay distinct
+        self.assertEqual([parse(expr) for expr in ["1", "1.0", "True"]], [1, 1.0, True])
+        self.assertIs(type(parse("1.0")), float)
+        compile("in(x, [1, 2])")
+        self.assertEqual(compile("in(x, [True, 2.0])").analyze().constants, (True, 2.0))
+        self.assertNotEqual(Constant(frozenset([1, 2])), Constant(frozenset([True, 2.0])))
+        # the tree is rebuilt from the instructions
+        for expr in ["a and (b or c) and d", "f(x, [1, y], and(p, q)) eq 2", "not(a or b)"]:
+            self.assertEqual(compile(expr).tree, parse_tree(expr))
+
+        # functions that can't be called skip their arguments
+        self.assertEqual(parse("f(g(1))", {"f" : 3}), 3)
+        self.assertEqual(parse("f(1)"), "f")
+        self.assertRaises(VariableMissingException, parse, "f(1)", {}, False)
+        # and()/or() only skip the second argument when they are the builtins
+        calls = []
+        def g():
+            calls.append(1)
+            return True
+        self.assertFalse(parse("and(False, g())", {"g" : g}))
+        self.assertEqual(calls, [])
+        self.assertEqual(parse("and(False, g())", {"g" : g, "and" : lambda a, b: b}), True)
+        self.assertEqual(calls, [1])
+
+        memo = {}
+        tree = compile("f(x) + f(x)").tree
+        calls = []
+        def f(value):
+            calls.append(value)
+            return value * 2
+        self.assertEqual(evaluate_node(tree, {"f" : f, "x" : 3}, memo=memo), 12)
+        self.assertEqual(evaluate_node(tree.left, {"f" : f, "x" : 3}, memo=memo), 6)
+        self.assertEqual(calls, [3, 3])
+
+    def test_analyze(self):
+        analysis = analyze("in(country, ['US', 'CA']) and f(g(x, 2), [y, 'z']) > limit * 1.5 or f(x)")
+        self.assertTrue(analysis.valid)
+        self.assertIsNone(analysis.error)
+        self.assertEqual(analysis.variables, ("country", "x", "y", "limit"))
+        self.assertEqual(analysis.functions, (("in", 2), ("f", 2), ("g", 2), ("f", 1)))
+        self.assertEqual(analysis.constants, ("US", "CA", 2, "z", 1.5))
+        self.assertEqual(analysis.missing({"country" : "US", "x" : 1, "y" : 2}), ("limit", "f", "g"))
+        self.assertEqual(analysis.missing({"country" : "US", "x" : 1, "y" : 2, "limit" : 3,
+            "f" : max, "g" : min}), ())
+        # repeat calls come from the cache
+        self.assertIs(analyze("in(country, ['US', 'CA']) and f(g(x, 2), [y, 'z']) > limit * 1.5 or f(x)"), analysis)
+
+        self.assertEqual(analyze("1 eq 1.0 and True").constants, (1, 1.0, True))
+        # names in branches the optimizer drops are still reported
+        self.assertFalse(is_valid("False and typo(x)", {}))
+        self.assertEqual(analyze("False and typo(x)").missing(), ("x", "typo"))
+        self.assertEqual(get_variables("False and y"), ["y"])
+        self.assertEqual(analyze("True or missing_var").variables, ("missing_var",))
+        self.assertEqual(compile("True or missing_var").analyze().variables, ())
+        self.assertEqual(analyze("x eq 1 or x eq 1.0 or x eq True").constants, (1, 1.0, True))
+        self.assertEqual(analyze("x eq 'x'").variables, ("x",))
+        self.assertEqual(analyze("x eq 'x'").constants, ("x",))
+        # names dropped by the optimizer are never needed when evaluating
+        self.assertEqual(analyze("False and expensive(x)").functions, (("expensive", 1),))
+        self.assertEqual(compile("False and expensive(x)").analyze().functions, ())
+
+        analysis = analyze("x * ")
+        self.assertFalse(analysis.valid)
+        self.assertIsInstance(analysis.error, ParseError)
+        self.assertEqual(analysis.error.col, 3)
+        self.assertEqual(analysis.variables, ())
+
+        # functions are the names that resolve to something callable
+        self.assertEqual(get_variables("f(x) + g", {"f" : max, "g" : 1}), ["x", "g"])
+        self.assertEqual(get_variables("f(x) + g", {"f" : max}, exclude_functions=False), ["f", "x", "g"])
+
+    def test_lazy_environment(self):
+        calls = []
+        def resolver(name):
+            calls.append(name)
+            if name.startswith("db_"):
+                return len(name)
+            raise KeyError(name)
+
+        # only the names used are resolved, each once per evaluation
+        self.assertEqual(parse("db_a > 5 or db_a * 2 > 5 or db_unused", resolver), True)
+        self.assertEqual(calls, ["db_a"])
+        del calls[:]
+        self.assertEqual(parse("db_abc eq 5 or db_abc eq 7", resolver), False)
+        self.assertEqual(calls, ["db_abc"])
+        del calls[:]
+        # builtins aren't asked for unless the resolver can replace them
+        self.assertEqual(parse("and(db_ab, x)", resolver), "x")
+        self.assertEqual(calls, ["db_ab", "x"])
+        del calls[:]
+        environment = LazyEnvironment(resolver, resolve_builtins=True)
+        self.assertEqual(compile("and(db_ab, x)").evaluate(environment), "x")
+        self.assertEqual(calls, ["and", "db_ab", "x"])
+        self.assertRaises(VariableMissingException, parse, "missing", resolver, False)
+        # mappings work too, and builtins are still there
+        self.assertEqual(parse("not(in(a, [1, 2]))", LazyEnvironment({"a" : 3})), True)
+        self.assertEqual(compile("a + b", codegen=True).evaluate(LazyEnvironment({"a" : 1}, {"b" : 2})), 3)
+
+        # a batch of rules can be prefetched in one call
+        requests = []
+        def bulk(names):
+            requests.append(sorted(names))
+            return dict((name, 1) for name in names if name != "gone")
+        rules = ["x > 0 and y > 0", "in(z, [1]) or gone", "x + q(y)"]
+        self.assertEqual(required_variables(rules), ["x", "y", "z", "gone"])
+        environment = LazyEnvironment(resolver, {"q" : lambda v: v * 10}, bulk=bulk)
+        environment.prefetch(required_variables(rules))
+        self.assertEqual([compile(rule).evaluate(environment) for rule in rules], [True, True, 11])
+        self.assertEqual(requests, [["gone", "x", "y", "z"]])
+        self.assertEqual(environment.resolved, 4)
+        self.assertEqual(sorted(environment), ["q", "x", "y", "z"])
+        environment.prefetch(["x"])
+        self.assertEqual(len(requests), 1)
+        # nothing is left to resolve once the variables are prefetched
+        expr = "in(x, [1, 2]) and not(y eq 1) or eq(x, y)"
+        environment.prefetch(required_variables([expr]))
+        for codegen in [False, True]:
+            compile(expr, codegen=codegen).evaluate(environment)
+        self.assertEqual(environment.resolved, 4)
+
+        rule_set = RuleSet({"a" : rules[0], "b" : rules[1], "c" : rules[2]})
+        self.assertEqual(rule_set.variables(), ["x", "y", "z", "gone"])
+        self.assertEqual(rule_set.variables(["c"]), ["x", "y"])
+        values = {"x" : 1, "y" : 2, "z" : 3, "q" : lambda v: v * 10}
+        def record(name):
+            calls.append(name)
+            return values[name]
+        del calls[:]
+        # names shared between rules are resolved once for the whole set
+        self.assertEqual(rule_set.evaluate(record), {"a" : True, "b" : "gone", "c" : 21})
+        self.assertEqual(sorted(calls), ["gone", "q", "x", "y", "z"])
+
+    def test_evaluate_async(self):
+        events = []
+        def remote(name, value, delay=0.01):
+            async def lookup(*args):
+                events.append("start %s" % name)
+                await asyncio.sleep(delay)
+                events.append("end %s" % name)
+                return value(*args) if callable(value) else value
+            return lookup
+        environment = {
+            "credit_score" : remote("credit_score", 700),
+            "fraud_flag" : remote("fraud_flag", False),
+            "limit" : remote("limit", lambda v: v * 2),
+            "user" : 1,
+        }
+        run = lambda expr, environment=environment, fail_silently=True: \
+            asyncio.run(evaluate_async(expr, environment, fail_silently))
+
+        self.assertEqual(run("credit_score(user) + limit(3)"), 706)
+        # independent calls wait together
+        self.assertEqual(events, ["start credit_score", "start limit", "end credit_score", "end limit"])
+        del events[:]
+        self.assertEqual(run("credit_score(user) > 600 and not(fraud_flag(user))"), True)
+        # and only evaluates its right side once the left one is known
+        self.assertEqual(events, ["start credit_score", "end credit_score", "start fraud_flag", "end fraud_flag"])
+        del events[:]
+        self.assertEqual(run("credit_score(user) < 600 and fraud_flag(user)"), False)
+        self.assertEqual(run("or(True, fraud_flag(user))"), True)
+        self.assertEqual(events, ["start credit_score", "end credit_score"])
+
+        self.assertEqual(run("limit(limit(2)) - 1 + user * 2"), 9)
+        self.assertEqual(run("[limit(1), user, limit(2)]"), [2, 1, 4])
+        self.assertEqual(run("minus(credit_score(user), 100)", dict(environment, minus=lambda a, b: a - b)), 600)
+        self.assertEqual(run(" + ".join(["limit(%d)" % i for i in range(300)])), 2 * sum(range(300)))
+        self.assertEqual(run("x + 1", {"x" : 1}), 2)
+        self.assertEqual(run("missing(1)"), "missing")
+        self.assertIsNone(run("x +"))
+        self.assertEqual(asyncio.run(compile("limit(x)").evaluate_async(dict(environment, x=4))), 8)
+        # the tree is only rebuilt and analysed the first time
+        compiled = compile("limit(x) + x * 2")
+        for x in [1, 2]:
+            self.assertEqual(asyncio.run(compiled.evaluate_async(dict(environment, x=x))), 4 * x)
+        self.assertIs(compiled.tree, compiled.tree)
+        compiled = compile("x * 2")
+        self.assertEqual(asyncio.run(compiled.evaluate_async({"x" : 3})), 6)
+        self.assertIsNot(compiled.tree, compiled.tree)
+
+        # the first failing operand in order is the one reported
+        async def fail(message):
+            await asyncio.sleep(0.01)
+            raise ValueError(message)
+        failing = dict(environment, fail=fail)
+        with self.assertRaisesRegex(ValueError, "first"):
+            run("fail('first') + fail('second')", failing)
+        self.assertRaises(VariableMissingException, run, "limit(1) + missing", environment, False)
+        # so is an operator failing before a later operand
+        called = []
+        async def f():
+            await asyncio.sleep(0.01)
+            return 1
+        async def g(value):
+            called.append(value)
+            return value
+        ordering = {"f" : f, "g" : g}
+        with self.assertRaises(ZeroDivisionError):
+            run("f() / 0 + g('a' + 1)", ordering)
+        with self.assertRaises(ZeroDivisionError):
+            parse("f / 0 + g('a' + 1)", {"f" : lambda : 1, "g" : len})
+        with self.assertRaises(TypeError):
+            run("f() + 'a' + fail('late')", dict(ordering, fail=fail))
+        self.assertEqual(called, [])
+        self.assertRaises(ParseError, run, "x +", environment, False)
+
+    def test_functions(self):
+        def f(a, b=1, *rest):
+            pass
+        class Callable(object):
+            def method(self, a):
+                pass
+            def __call__(self, a, b):
+                pass
+        self.assertEqual(arity(f), (1, None))
+        self.assertEqual(arity(len), (1, 1))
+        self.assertEqual(arity(functools.partial(f, 1)), (0, None))
+        self.assertEqual(arity(Callable().method), (1, 1))
+        self.assertEqual(arity(Callable()), (2, 2))
+        self.assertEqual(arity(function_map["eq"]), (2, 2))
+        self.assertIsNone(arity(lambda *, key: key))
+        analysis = analyze("f(1, 2, 3) + g(x) + eq(1) + len(a, b) + max(a, b) + h(1)")
+        self.assertEqual(analysis.arity_errors({"f" : f, "g" : Callable().method, "len" : len,
+            "max" : max}), (("eq", 1), ("len", 2)))
+
+        calls = []
+        @pure
+        def lookup(code):
+            calls.append(code)
+            return code.upper()
+        @pure(maxsize=2)
+        def small(value):
+            calls.append(value)
+            return value
+        environment = {"lookup" : lookup, "small" : small}
+        self.assertEqual(arity(lookup), (1, 1))
+        self.assertEqual(parse("lookup('a') + lookup('b') + lookup('a')", environment), "ABA")
+        self.assertEqual(parse("lookup('a')", environment), "A")
+        self.assertEqual(calls, ["a", "b"])
+        self.assertEqual(lookup.stats(), CacheStats(2, 2, 0, 2, 1024))
+        # 1 and True are kept apart, and unhashable arguments go straight through
+        del calls[:]
+        self.assertEqual([small(1), small(True), small([1]), small([1]), small(1)], [1, True, [1], [1], 1])
+        self.assertEqual(calls, [1, True, [1], [1]])
+        small(2)
+        self.assertEqual(small.stats().evictions, 1)
+        lookup.cache_clear()
+        self.assertEqual(lookup.stats().size, 0)
+        self.assertTrue(lookup)
+
+        @pure
+        async def remote(code):
+            calls.append(code)
+            await asyncio.sleep(0)
+            return code * 2
+        del calls[:]
+        self.assertEqual(asyncio.run(evaluate_async("remote(2) + remote(3) + remote(2)", {"remote" : remote})), 14)
+        self.assertEqual(asyncio.run(evaluate_async("remote(2)", {"remote" : remote})), 4)
+        # the concurrent calls to remote(2) share one call
+        self.assertEqual(sorted(calls), [2, 3])
+        async def flaky(value):
+            calls.append(value)
+            raise ValueError(value)
+        flaky = pure(flaky)
+        for i in range(2):
+            self.assertRaises(ValueError, asyncio.run, evaluate_async("flaky(1)", {"flaky" : flaky}, False))
+        self.assertEqual(calls[-2:], [1, 1])
+
+    def test_threads(self):
+        exprs = ["x + y * %d > %d and in(code, ['a', 'b'])" % (i, i * 3) for i in range(20)]
+        exprs += ["minus(x, %d) * y + len(code)" % i for i in range(20)]
+        exprs += ["or(x eq %d, y eq %d) or f(x)" % (i, i) for i in range(20)]
+        environments = [{"x" : i % 7, "y" : i % 5, "code" : "abc"[i % 3], "len" : len,
+            "minus" : lambda a, b: a - b, "f" : lambda v: v > 3} for i in range(50)]
+        expected = dict(((expr, index), compile(expr, parser="pratt").evaluate(environment))
+            for expr in exprs for index, environment in enumerate(environments))
+        shared = dict((expr, compile(expr)) for expr in exprs)
+        generated = dict((expr, compile(expr, codegen=True)) for expr in exprs)
+        rule_set = RuleSet(dict(enumerate(exprs)))
+
+        def check(task):
+            expr_index, index = task % len(exprs), task % len(environments)
+            expr, environment = exprs[expr_index], environments[index]
+            want = expected[(expr, index)]
+            results = [
+                parse(expr, environment),
+                shared[expr].evaluate(environment),
+                generated[expr].evaluate(environment),
+                compile(expr, parser=["pyparsing", "pratt", "pratt", "pratt"][task % 4]).evaluate(environment),
+                rule_set.evaluate(LazyEnvironment(environment))[expr_index],
+            ]
+            return [result == want for result in results] + \
+                [analyze(expr).variables == analyze(exprs[expr_index]).variables]
+
+        # a small cache keeps threads compiling, storing and evicting
+        maxsize = expression_cache.maxsize
+        interval = sys.getswitchinterval()
+        expression_cache.resize(32)
+        sys.setswitchinterval(1e-5)
+        try:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                outcomes = list(executor.map(check, range(2000)))
+        finally:
+            sys.setswitchinterval(interval)
+            expression_cache.resize(maxsize)
+        self.assertEqual(len(outcomes), 2000)
+        self.assertTrue(all(all(outcome) for outcome in outcomes))
+
+    def test_serialize(self):
+        environment = {"x" : "a", "y" : 2, "f" : lambda a, b: a + b}
+        exprs = ["in(x, ['a', 1, 2.5, True])", "y ^ 100 > 1 and f(y, 3) eq 5",
+            "or(x eq 'caf\u00e9', [y, 1.0])", "y + 1", "x"]
+        for expr in exprs:
+            compiled = compile(expr)
+            data = dumps(compiled)
+            self.assertIsInstance(data, bytes)
+            loaded = loads(data)
+            self.assertEqual(loaded.expr, expr)
+            self.assertEqual(loaded.tree, compiled.tree)
+            self.assertEqual(loaded.evaluate(environment), compiled.evaluate(environment))
+            self.assertEqual(loads(data, codegen=True).evaluate(environment),
+                compiled.evaluate(environment))
+        self.assertIsInstance(loads(dumps(compile(exprs[0]))).tree.args[1].value, LiteralSet)
+        # ints are saved whatever their size
+        for value in [0, -128, 255, 10 ** 5000, -10 ** 5000]:
+            tree = BinOp(">", Name("x"), Constant(value))
+            self.assertEqual(loads(dumps(CompiledExpression("x", tree))).tree, tree)
+        self.assertIsNone(loads(dumps(compile("x +"))).tree)
+
+        data = dumps(compile("y + 1"))
+        self.assertRaises(SerializationError, loads, b"nope" + data[4:])
+        self.assertRaises(SerializationError, loads, data[:4] + b"\xff\xff" + data[6:])
+        self.assertRaises(SerializationError, loads, data[:-3])
+        # the opcodes come just before two int32 operands for each of them
+        data = bytearray(dumps(compile("f(y, 1) and y")))
+        start = len(data) - 9 * 6
+        self.assertEqual(loads(bytes(data)).evaluate(environment), 2)
+        for offset, byte in [(0, 99), (6 + 4, 0), (6 + 8 * 4 + 4, 2), (3, 9)]:
+            corrupt = bytearray(data)
+            corrupt[start + offset] = byte
+            self.assertRaises(SerializationError, loads, bytes(corrupt))
+
+    def test_incremental(self):
+        calls = []
+        def slow(x):
+            calls.append(x)
+            return x * 10
+        rules = {"big" : "slow(a) > 50", "both" : "slow(a) > 50 and b > 1",
+            "sum" : "slow(a) + b + c", "guarded" : "b > 0 and 10 / b > 2",
+            "constant" : "1 + 2", "bad" : "1 +"}
+        evaluator = IncrementalEvaluator(rules, {"a" : 6, "b" : 2, "c" : 0, "slow" : slow})
+        self.assertEqual(evaluator.results, {"big" : True, "both" : True, "sum" : 62,
+            "guarded" : True, "constant" : 3, "bad" : None})
+        self.assertEqual(calls, [6])
+        self.assertEqual(evaluator.update("c", 1), {"sum" : 63})
+        self.assertEqual(evaluator.update("b", 3), {"sum" : 64})
+        self.assertEqual(evaluator.update("b", 0), {"both" : False, "sum" : 61,
+            "guarded" : False})
+        self.assertEqual(calls, [6])
+        self.assertEqual(evaluator.update("a", 1), {"big" : False, "sum" : 11})
+        self.assertEqual(calls, [6, 1])
+        self.assertEqual(evaluator.update_many({"a" : 2, "b" : 5}), {"sum" : 26})
+        self.assertEqual(calls, [6, 1, 2])
+        self.assertEqual(evaluator["guarded"], False)
+        self.assertEqual(evaluator.update("slow", lambda x: x), {"sum" : 8})
+
+        evaluator = IncrementalEvaluator({"ratio" : "a / b", "a" : "a"}, {"a" : 1, "b" : 2},
+            collect_errors=True)
+        changed = evaluator.update("b", 0)
+        self.assertEqual(list(changed), ["ratio"])
+        self.assertIsInstance(changed["ratio"], EvaluationError)
+        self.assertEqual(evaluator.update("b", 0), {})
+        self.assertEqual(evaluator.update("b", 4), {"ratio" : 0.25})
+        changed = evaluator.remove("a")
+        self.assertEqual(changed["a"], "a")
+        self.assertIsInstance(changed["ratio"], EvaluationError)
+        evaluator.collect_errors = False
+        with self.assertRaises(TypeError):
+            evaluator.update("b", 2)
+        self.assertEqual(evaluator.update("a", 3), {"ratio" : 1.5, "a" : 3})
+
+        # against evaluating everything from scratch
+        rng = random.Random(4)
+        rules = dict(("r%d" % i, expr) for i, expr in enumerate(["x + y > z", "f(x) * 2",
+            "f(x) > y or f(z) > y", "in(x, [1, 2, 3]) and y < f(z)", "[x, f(y)]",
+            "x eq y", "not(z > 2) and (f(x) + f(y) > 4)", "y - z"]))
+        environment = {"x" : 1, "y" : 2, "z" : 3, "f" : lambda v: v * 3 - 4}
+        evaluator = IncrementalEvaluator(rules, environment)
+        rule_set = RuleSet(rules)
+        for i in range(300):
+            name = rng.choice("xyz")
+            environment[name] = rng.randint(-3, 4)
+            previous = evaluator.results
+            changed = evaluator.update(name, environment[name])
+            expected = rule_set.evaluate(environment)
+            self.assertEqual(evaluator.results, expected)
+            # 0 becoming False is a change too
+            self.assertEqual(changed, dict((rule, value) for rule, value in expected.items()
+                if value != previous[rule] or type(value) is not type(previous[rule])))
+
+    def test_specialize(self):
+        tenant = {"tier" : 3, "fx_rate" : 2.0, "limit" : 100}
+        expr = "tier == 3 and amount * fx_rate > limit"
+        self.assertEqual(specialize(expr, tenant).dump(), "amount * 2.0 > 100")
+        self.assertEqual(specialize(expr, dict(tenant, tier=2)).dump(), "False")
+        self.assertEqual(specialize(expr, {"limit" : 5}).dump(),
+            "tier eq 3 and amount * fx_rate > 5")
+
+        rates = {"usd" : 1.0, "eur" : 1.1}
+        rate = pure(lambda currency: rates[currency])
+        environment = {"region" : "eu", "codes" : ["a", "b"], "currency" : "eur", "rate" : rate,
+            "log" : lambda value: value, "settings" : {"a" : 1}, "name" : "O'Neil",
+            "note" : "two\nlines", "crlf" : "a\r\nb", "path" : "a\\"}
+        for expr, specialized in [
+                ("rate(currency) * amount", "1.1 * amount"),
+                ("not(in(region, ['eu', 'us'])) or x", "x"),
+                ("in(code, codes) and log(region)", "in(code, ['a', 'b']) and log('eu')"),
+                ("eq(region, 'eu') and rate('gbp') > x", "rate('gbp') > x"),
+                ("settings", "settings"),
+                ("name", "name"),
+                ("note + crlf", "note + crlf"),
+                ("path + x", "path + x"),
+                ("rate", "rate"),
+                ("1 / zero", "1 / zero")]:
+            self.assertEqual(specialize(expr, environment).dump(), specialized)
+        # as are values too big to be worth writing out
+        big = {"big" : 10 ** 5000, "ten" : 10, "long" : "a" * 20000,
+            "power" : pure(lambda n: 10 ** n)}
+        for expr, specialized in [
+                ("10 ^ 5000 > x", "10 ^ 5000 > x"),
+                ("ten ^ 5000 > x", "10 ^ 5000 > x"),
+                ("big > x", "big > x"),
+                ("long eq x", "long eq x"),
+                ("power(5000) > x", "power(5000) > x"),
+                ("power(3) > x", "1000 > x")]:
+            self.assertEqual(specialize(expr, big).dump(), specialized)
+            self.assertEqual(specialize(expr, big).evaluate(dict(big, x=1)),
+                parse(expr, dict(big, x=1)))
+        # a builtin the environment replaces is left to be called
+        self.assertEqual(specialize("not(tier == 3)", {"tier" : 3, "not" : bool}).dump(),
+            "not(True)")
+        self.assertEqual(specialize("not(tier == 3)", {"tier" : 3}).dump(), "False")
+
+        rng = random.Random(5)
+        exprs = ["tier == 3 and amount * fx_rate > limit", "amount + tier * 2 - limit",
+            "in(tier, [1, 2, 3]) or amount > limit", "not(amount > limit) and fx_rate",
+            "[tier, amount] == [3, amount]", "amount / fx_rate >= limit or tier"]
+        for i in range(200):
+            partial = {"tier" : rng.randint(1, 4), "fx_rate" : rng.choice([0.5, 1, 2.5]),
+                "limit" : rng.randint(0, 50)}
+            event = {"amount" : rng.randint(-10, 60)}
+            for expr in exprs:
+                specialized = specialize(expr, partial)
+                self.assertEqual(specialized.evaluate(event),
+                    parse(expr, dict(partial, **event)), expr)
+                self.assertEqual(compile(specialized.expr).tree, specialized.tree)
+        rules = dict(("r%d" % i, expr) for i, expr in enumerate(exprs))
+        specialized = specialize_rules(rules, {"tier" : 2, "fx_rate" : 2, "limit" : 10})
+        self.assertEqual(sorted(specialized), ["r1", "r2", "r3", "r4", "r5"])
+        self.assertEqual(specialized["r2"].dump(), "True")
+        specialized = specialize_rules(rules, {"tier" : 0, "fx_rate" : 0, "limit" : 10})
+        self.assertEqual(sorted(specialized), ["r1", "r2", "r3", "r4", "r5"])
+        self.assertEqual(specialized["r3"].dump(), "not(amount > 10) and 0")
+
+    def test_instrumentation(self):
+        events = []
+        environment = {"f" : lambda value: value * 2, "g" : len, "x" : 2}
+        compiled = compile("f(x) + f(3) > g('ab') or g('')")
+        with instrumented(events.append):
+            self.assertEqual(compiled.evaluate(environment), 5)
+            compile("f(x) * 2", codegen=True).evaluate(environment)
+            with self.assertRaises(ParseError):
+                compile("f(", fail_silently=False)
+            self.assertEqual(RuleSet({"a" : "f(1) + f(1)"}).evaluate(environment), {"a" : 4})
+        compiled.evaluate(environment)
+        self.assertEqual([(event.phase, event.expr) for event in events], [
+            ("evaluate", "f(x) + f(3) > g('ab') or g('')"),
+            ("parse", "f(x) * 2"), ("optimize", "f(x) * 2"), ("codegen", "f(x) * 2"),
+            ("assemble", "f(x) * 2"), ("evaluate", "f(x) * 2"),
+            ("parse", "f("), ("parse", "f(1) + f(1)"), ("optimize", "f(1) + f(1)"),
+            ("assemble", "f(1) + f(1)")])
+        self.assertEqual(events[0].calls, {"f" : 2, "g" : 1})
+        self.assertEqual(events[5].calls, {"f" : 1})
+        self.assertTrue(all(event.seconds >= 0 for event in events))
+        self.assertIsNone(instrumentation.hook)
+        # lazy environments are counted too
+        events = []
+        instrument(events.append)
+        try:
+            self.assertEqual(compiled.evaluate(LazyEnvironment(environment)), 5)
+            # functions used as values aren't wrapped
+            self.assertIs(parse("g", environment), len)
+            self.assertEqual(compile("[g, g('abc')]", codegen=True).evaluate(environment),
+                [len, 3])
+        finally:
+            instrument(None)
+        self.assertEqual(events[0].calls, {"f" : 2, "g" : 1})
+        self.assertEqual(events[-1].calls, {"g" : 1})
+
+    def test_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        exprs = ["x eq %d and y > 'k%d'" % (i, i) for i in range(50)]
+
+        cache = DiskCache(directory)
+        self.assertEqual(len(cache), 0)
+        for expr in exprs:
+            cache.compile(expr)
+        self.assertEqual(cache.misses, 50)
+        self.assertRaises(ParseError, cache.compile, "x +", False)
+        cache.flush()
+        self.assertEqual(len(cache), 50)
+        self.assertEqual(os.listdir(directory), [os.path.basename(cache.path)])
+        self.assertIn("yapp-0.1-", cache.path)
+
+        # a new process starting up finds them without parsing
+        with DiskCache(directory) as warm:
+            self.assertIsNone(warm.get("x eq 1000"))
+            for i, expr in enumerate(exprs):
+                self.assertEqual(warm.compile(expr).evaluate({"x" : i, "y" : "z"}), True)
+            self.assertEqual((warm.hits, warm.misses), (50, 0))
+            warm.compile("x eq 1000")
+            warm.flush()
+            self.assertEqual(len(warm), 51)
+            expression_cache = ExpressionCache(warm.compile)
+            self.assertEqual(expression_cache.get("x eq 1000").evaluate({"x" : 1000}), True)
+
+        # an expression that can't be saved doesn't keep the rest from being
+        broken = CompiledExpression("broken", BinOp("eq", Name("x"), Constant(None)))
+        with DiskCache(directory) as partial:
+            partial._pending[b"k" * 16] = broken
+            partial.compile("x eq 4000")
+            partial.flush()
+            self.assertEqual(len(partial), 52)
+            partial.compile("x eq 5000")
+            partial.flush()
+            self.assertEqual(len(partial), 53)
+
+        # expressions compiled without optimizing are kept apart
+        self.assertIsNone(DiskCache(directory, optimize=False).get(exprs[0]))
+        # workers flushing to the same directory keep each other's entries
+        first, second = DiskCache(directory), DiskCache(directory)
+        first.compile("x eq 2000")
+        second.compile("x eq 3000")
+        first.flush()
+        second.flush()
+        with DiskCache(directory) as merged:
+            self.assertEqual(len(merged), 55)
+            self.assertIsNotNone(merged.get("x eq 2000"))
+        # an entry that fails its checksum is compiled again
+        with open(cache.path, "rb") as pack:
+            data = bytearray(pack.read())
+        saved = dumps(compile(exprs[0]))
+        data[data.index(saved) + len(saved) - 1] ^= 0xff
+        with open(cache.path, "wb") as pack:
+            pack.write(bytes(data))
+        with DiskCache(directory) as damaged:
+            self.assertIsNone(damaged.get(exprs[0]))
+            self.assertEqual(damaged.compile(exprs[0]).evaluate({"x" : 0, "y" : "z"}), True)
+            self.assertIsNotNone(damaged.get(exprs[1]))
+            damaged.flush()
+            self.assertEqual(len(damaged), 55)
+        # so is a pack of another version
+        data[4] += 1
+        with open(cache.path, "wb") as pack:
+            pack.write(bytes(data))
+        self.assertEqual(len(DiskCache(directory)), 0)
+        # an unreadable pack is ignored
+        with open(cache.path, "wb") as pack:
+            pack.write(b"junk")
+        self.assertEqual(len(DiskCache(directory)), 0)
+
+
+class ParserParityTest(TestCase):
+    """ Runs the same expressions through the pyparsing grammar and the pratt
+        parser, which must agree on the tree or on where the error is
+    """
+    operators = ["+", "-", "*", "/", "%", "^", ">", ">=", "<", "<=", "eq",
+        "==", "and", "or"]
+    fragments = ["x", "y1", "foo", "eq", "==", "and", "or", "True", "False",
+        "Trueish", "in", "not", "+", "-", "*", "/", "%", "^", ">", ">=", "<",
+        "<=", "(", ")", "[", "]", ",", "1", "-2", "+3", "4.", "5.5", "'a'",
+        "'b c'", "''", "'", "equal", "orange", "\n", "\t", " "]
+
+    def parse_both(self, expr):
+        results = []
+        for parser in sorted(PARSERS):
+            try:
+                results.append(parse_tree(expr, parser))
+            except ParseError as e:
+                results.append((e.lineno, e.col, e.line))
+        return results
+
+    def assertParity(self, expr):
+        pyparsing_result, pratt_result = self.parse_both(expr)
+        self.assertEqual(pyparsing_result, pratt_result, repr(expr))
+
+    def generate(self, rng, depth=0):
+        choice = rng.random()
+        if depth > 4 or choice < 0.3:
+            return rng.choice(["x", "y1", "1", "-2", "2.5", "'s'", "True",
+                "False", "[1, 'a']", "foo()"])
+        elif choice < 0.6:
+            return "%s%s%s%s%s" % (self.generate(rng, depth + 1),
+                rng.choice([" ", ""]), rng.choice(self.operators),
+                rng.choice([" ", ""]), self.generate(rng, depth + 1))
+        elif choice < 0.75:
+            return "(%s)" % self.generate(rng, depth + 1)
+        elif choice < 0.9:
+            return "%s(%s)" % (rng.choice(["foo", "minus", "in", "not"]),
+                ", ".join(self.generate(rng, depth + 1) for i in range(rng.randint(0, 3))))
+        return "[%s]" % ", ".join(rng.choice(["1", "'a'", "x", "(1+2)", "-4"])
+            for i in range(rng.randint(0, 3)))
+
+    def test_test_expressions(self):
+        # every string in this file, expressions or not
+        with open(__file__.replace(".pyc", ".py")) as f:
+            module = ast.parse(f.read())
+        strings = set(node.value for node in ast.walk(module)
+            if isinstance(node, ast.Constant) and isinstance(node.value, str))
+        for expr in strings:
+            self.assertParity(expr)
+
+    def test_generated_expressions(self):
+        rng = random.Random(1)
+        for i in range(2000):
+            expr = self.generate(rng)
+            if rng.random() < 0.3:
+                # break it somewhere
+                at = rng.randint(0, len(expr))
+                expr = expr[:at] + rng.choice(self.fragments) + expr[at:]
+            self.assertParity(expr)
+
+    def test_random_fragments(self):
+        rng = random.Random(2)
+        for i in range(2000):
+            self.assertParity("".join(rng.choice(self.fragments) + rng.choice(["", " "])
+                for j in range(rng.randint(1, 8))))
+
+    def test_default_parser(self):
+        try:
+            set_default_parser("pratt")
+            self.assertEqual(compile("minus(x, 1) * 2").tree,
+                compile("minus(x, 1) * 2", parser="pyparsing").tree)
+            with self.assertRaises(ParseError):
+                compile("2 / ", fail_silently=False)
+        finally:
+            set_default_parser("pyparsing")
+        with self.assertRaises(ValueError):
+            set_default_parser("yacc")
+
+
+class OrmTest(TestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        for i in range(200):
+            Record.objects.create(name=rng.choice(["ann", "bob", "cy", "Dee"]),
+                age=rng.randint(18, 70), score=rng.randint(0, 400) / 4.0,
+                active=rng.random() < 0.7)
+        self.environment = {
+            "limit" : 40,
+            "names" : ["ann", "cy"],
+            "off" : False,
+            "lucky" : lambda age: age % 3 == 0,
+            "threshold" : pure(lambda x: x * 3),
+        }
+
+    def python_filter(self, expr):
+        matched = []
+        for record in Record.objects.order_by("pk"):
+            environment = dict(self.environment, name=record.name, age=record.age,
+                score=record.score, active=record.active)
+            if parse(expr, environment):
+                matched.append(record.pk)
+        return matched
+
+    def assertFilters(self, expr, complete=True):
+        translation = translate(expr, Record, self.environment)
+        self.assertEqual(translation.complete, complete, translation.skipped)
+        pks = sorted(record.pk for record in translation.filter())
+        self.assertEqual(pks, self.python_filter(expr), expr)
+        return translation
+
+    def test_translate(self):
+        for expr in ["age > 30", "30 < age", "age eq 44", "44 == age", "name >= 'bob'",
+                "(age + 5) >= limit", "age * 2 > score", "age / 4 > 10.5",
+                "(score - age ^ 2 / 100) < 20", "name eq 'bob' or active",
+                "not(in(age, [20, 30, 40, 50, 60]))", "in(name, names) and age < 50",
+                "age > threshold(10)", "off and lucky(age)", "not(active) or 60 <= age",
+                "in(age, [])", "limit > 3 and (name == 'cy' or score > 2 * age)"]:
+            self.assertFilters(expr)
+        translation = translate("(age + 5) >= limit", Record, self.environment)
+        self.assertEqual(list(translation.annotations), ["yapp_0"])
+        self.assertIsInstance(filter_queryset(Record.objects.all(), "age > 30"),
+            QuerySet)
+        expected = self.python_filter("active and lucky(age)")
+        with self.assertNumQueries(1):
+            self.assertEqual([record.pk for record in filter_queryset(Record.objects.order_by("pk"),
+                "active and lucky(age)", self.environment)], expected)
+
+    def test_residual(self):
+        translation = self.assertFilters("(age % 7) eq 3 and active and age > 25", False)
+        self.assertEqual(translation.residual.dump(), "(age % 7) eq 3")
+        self.assertEqual(translation.skipped, (("age % 7", "% isn't translated"),))
+        self.assertEqual(str(translation.q), str(translate("active and age > 25", Record).q))
+        translation = self.assertFilters("lucky(age) or age > 60", False)
+        self.assertEqual(translation.skipped, (("lucky(age)", "calls lucky()"),))
+        self.assertEqual(translation.residual.expr, "lucky(age) or age > 60")
+        for expr, reason in [("(name + 'x') eq 'bobx'", "+ isn't translated for a text and a text"),
+                ("in(age, [1, 'a'])", "compares a int with a text"),
+                ("score and age > 30", "uses the truth of a float"),
+                ("(age > 3) + 1 > 1", "uses a condition as a value")]:
+            translation = self.assertFilters(expr, False)
+            self.assertEqual(translation.skipped[0][1], reason)
+        translation = translate("name > 3", Record)
+        self.assertEqual(translation.skipped, (("name > 3", "compares a text with a int"),))
+        translation = translate("nickname eq 'x'", Record)
+        self.assertEqual(translation.skipped, (("nickname",
+            "nickname isn't a field or a value in the environment"),))
+        with self.assertRaises(ParseError):
+            translate("age >", Record)
+
+
+@override_settings(ROOT_URLCONF="yapp.urls")
+class ViewTest(TestCase):
+    def setUp(self):
+        views.registry = RuleRegistry(environment={"double" : lambda x: x * 2,
+            "pick" : lambda key: {"a" : 1}[key]})
+
+    def post(self, path, body):
+        return self.client.post(path, json.dumps(body), content_type="application/json")
+
+    def lines(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in
+            b"".join(response.streaming_content).decode("utf-8").splitlines()]
+
+    def test_rules(self):
+        response = self.post("/rules/", {"rules" : {"adult" : "age >= 18",
+            "senior" : "age >= 65 and adult"}})
+        self.assertEqual(response.json(), {"registered" : ["adult", "senior"]})
+        response = self.post("/rules/", {"rules" : {"adult" : "age >= 21", "bad" : "age >",
+            "odd" : 3}})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.json()["errors"]), ["bad", "odd"])
+        self.assertEqual(self.client.get("/rules/").json(), {"rules" : {"adult" : "age >= 18",
+            "senior" : "age >= 65 and adult"}})
+        self.assertEqual(self.post("/rules/", {"rules" : []}).status_code, 400)
+        self.assertEqual(self.client.post("/rules/", "{", content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.delete("/rules/").status_code, 405)
+        # registering it again changes nothing
+        self.post("/rules/", {"rules" : {"adult" : "age >= 18"}})
+        self.assertEqual(len(views.registry), 2)
+
+    def test_evaluate(self):
+        self.post("/rules/", {"rules" : {"big" : "double(x) > 10", "named" : "in(name, ['a', 'b'])",
+            "sum" : "x + y", "items" : "[x, 1]"}})
+        response = self.post("/evaluate/", {"rules" : ["big", "sum"], "environments" : [
+            {"x" : 6, "y" : 1}, {"x" : 1, "y" : "a"}, {"x" : 2, "y" : 3.5}]})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(self.lines(response), [
+            {"index" : 0, "results" : {"big" : True, "sum" : 7}},
+            {"index" : 1, "error" : "unsupported operand type(s) for +: 'int' and 'str'"},
+            {"index" : 2, "results" : {"big" : False, "sum" : 5.5}}])
+        lines = self.lines(self.post("/evaluate/", {"environments" : [{"x" : 1, "y" : 2,
+            "name" : "b", "double" : 20}]}))
+        self.assertEqual(lines, [{"index" : 0, "results" : {"big" : True,
+            "items" : [1, 1], "named" : True, "sum" : 3}}])
+        lines = self.lines(self.post("/evaluate/", {"rules" : ["sum"], "fail_silently" : False,
+            "environments" : [{"x" : 1}, {"x" : 1, "y" : 1}]}))
+        self.assertEqual(lines[0], {"index" : 0, "error" : "Variable y is not in the environment"})
+        self.assertEqual(lines[1], {"index" : 1, "results" : {"sum" : 2}})
+        # any error from an environment function only fails its own line
+        self.post("/rules/", {"rules" : {"picked" : "pick(name)"}})
+        lines = self.lines(self.post("/evaluate/", {"rules" : ["picked"],
+            "environments" : [{"name" : "a"}, {"name" : "b"}, {"name" : "a"}]}))
+        self.assertEqual(lines, [{"index" : 0, "results" : {"picked" : 1}},
+            {"index" : 1, "error" : "'b'"}, {"index" : 2, "results" : {"picked" : 1}}])
+        response = self.post("/evaluate/", {"rules" : ["big", "nope"], "environments" : []})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["rules"], ["nope"])
+        self.assertEqual(self.post("/evaluate/", {"environments" : [1]}).status_code, 400)
+        self.assertEqual(self.post("/evaluate/", {"rules" : "big", "environments" : []}).status_code, 400)
+        self.assertEqual(self.client.get("/evaluate/").status_code, 405)
+        # a rule too costly to work out fails its line rather than the worker
+        self.post("/rules/", {"rules" : {"huge" : "9 ^ 999999999"}})
+        lines = self.lines(self.post("/evaluate/", {"rules" : ["huge"], "environments" : [{}]}))
+        self.assertIn("error", lines[0])
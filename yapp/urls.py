@@ -1,17 +1,18 @@
-from django.conf.urls import patterns, include, url
+from django.urls import re_path as url
+
+from yapp import views
 
 # Uncomment the next two lines to enable the admin:
 # from django.contrib import admin
 # admin.autodiscover()
 
-urlpatterns = patterns('',
-    # Examples:
-    # url(r'^$', 'yapp.views.home', name='home'),
-    # url(r'^yapp/', include('yapp.foo.urls')),
+urlpatterns = [
+    url(r'^rules/$', views.rules, name='rules'),
+    url(r'^evaluate/$', views.evaluate, name='evaluate'),
 
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
     # Uncomment the next line to enable the admin:
     # url(r'^admin/', include(admin.site.urls)),
-)
+]
@@ -0,0 +1,210 @@
+""" Evaluates parsed expressions over columns of NumPy arrays.
+
+	Operators become NumPy ufuncs so a whole batch of rows is handled by a few
+	C loops. ``and``/``or``/``not`` are elementwise logical operations and
+	always produce booleans. Functions without a NumPy equivalent are called
+	once per row.
+
+	The right operand of and/or is only evaluated over the rows the left
+	one leaves undecided, so it can't fail in a row that evaluating each
+	row on its own would never reach.
+
+	Arithmetic follows evaluating each row on its own where NumPy would
+	differ: ``/`` and ``%`` by zero and zero to a negative power raise
+	ZeroDivisionError rather than giving inf or nan, and integers raised to
+	negative powers give floats. The remaining differences are NumPy's own:
+	integers wrap around rather than growing past 64 bits, and fractional
+	powers of negative numbers are nan rather than complex.
+"""
+from yapp.evaluator import lookup_function, resolve, variable, call, function_map, \
+	MISSING, SHORT_CIRCUIT
+from yapp.nodes import Constant, Name, List, Call, BinOp
+
+# NumPy is slow to import, so it's only imported once columns are evaluated
+np = None
+ufunc_map = {}
+
+def _import_numpy():
+	global np
+	if np is None:
+		try:
+			import numpy
+		except ImportError:
+			raise ImportError("NumPy is required to evaluate columns")
+		ufunc_map.update({
+			"+" : numpy.add,
+			"-" : numpy.subtract,
+			"*" : numpy.multiply,
+			"/" : numpy.true_divide,
+			"%" : numpy.mod,
+			"^" : numpy.power,
+			">" : numpy.greater,
+			"<" : numpy.less,
+			">=" : numpy.greater_equal,
+			"<=" : numpy.less_equal,
+			"eq" : _equal,
+			"and" : numpy.logical_and,
+			"or" : numpy.logical_or,
+		})
+		np = numpy
+
+def _equal(left, right):
+	""" Compares two columns, or a column and a value, row by row. Strings
+		have no NumPy equal loop before 1.25, and values of different types
+		have none at all, so those are compared as Python objects, which
+		gives False where the types differ just as evaluating each row does.
+	"""
+	try:
+		return np.equal(left, right)
+	except TypeError:
+		return np.equal(np.asarray(left, dtype=object), np.asarray(right, dtype=object))
+
+def _is_array(value):
+	return isinstance(value, np.ndarray)
+
+def _rowwise(func, args):
+	""" Calls func once per row of the array arguments
+	"""
+	arrays = [i for i, arg in enumerate(args) if _is_array(arg)]
+	if not arrays:
+		return call(func, args)
+	broadcast = np.broadcast_arrays(*[args[i] for i in arrays])
+	rows = []
+	for values in zip(*broadcast):
+		row = list(args)
+		for i, value in zip(arrays, values):
+			row[i] = value
+		rows.append(call(func, row))
+	return np.array(rows)
+
+def _isin(value, container):
+	""" Tests each row of value for being in container, a list or set
+	"""
+	items = list(container)
+	types = set(type(item) for item in items)
+	if len(types) < 2 or types <= set([bool, int, float]):
+		return np.isin(value, items)
+	# NumPy would turn ['US', 1] into strings, so '1' would be in it
+	try:
+		return np.isin(value, np.array(items, dtype=object))
+	except TypeError:
+		return _rowwise(lambda x: x in container, [value])
+
+def _numeric(value):
+	return np.asarray(value).dtype.kind in "biuf"
+
+def _binop(op, left, right):
+	""" Applies op to two columns, or a column and a value, raising where
+		applying it row by row would
+	"""
+	if op in ("/", "%") and _numeric(right) and np.any(np.equal(right, 0)):
+		raise ZeroDivisionError("division by zero")
+	elif op == "^" and _numeric(left) and _numeric(right):
+		if np.any(np.logical_and(np.equal(left, 0), np.less(right, 0))):
+			raise ZeroDivisionError("0 cannot be raised to a negative power")
+		elif np.asarray(right).dtype.kind in "biu" and np.any(np.less(right, 0)):
+			left = np.asarray(left, dtype=float)
+	return ufunc_map[op](left, right)
+
+def _decide(op, left, right, environment, columns, fail_silently):
+	""" Evaluates right, the operand and/or only needs in the rows left
+		doesn't decide, over just those rows, as evaluating each row would.
+		Returns it as a value for every row; the rows left decides get None.
+	"""
+	undecided = np.asarray(left, dtype=bool)
+	if op == "or":
+		undecided = np.logical_not(undecided)
+	if not undecided.any():
+		return None # decided in every row
+	elif undecided.ndim == 0 or undecided.all():
+		return _evaluate(right, environment, fail_silently, columns)
+	rows = dict(environment)
+	for name in columns:
+		rows[name] = environment[name][undecided]
+	value = _evaluate(right, rows, fail_silently, columns)
+	full = np.full(len(undecided), None)
+	full[undecided] = value
+	return full
+
+def _builtin(name, environment):
+	""" Returns True if name refers to the yapp builtin rather than something
+		the environment overrides
+	"""
+	return lookup_function(name, environment) is function_map.get(name, MISSING)
+
+def _evaluate(node, environment, fail_silently, columns):
+	""" Evaluates node over the rows in environment, where the names in
+		columns are arrays with a value per row
+	"""
+	if isinstance(node, Constant):
+		return node.value
+	elif isinstance(node, Name):
+		return variable(resolve(node.name, environment, fail_silently))
+	elif isinstance(node, BinOp):
+		op1 = _evaluate(node.left, environment, fail_silently, columns)
+		if node.op in SHORT_CIRCUIT:
+			op2 = _decide(node.op, op1, node.right, environment, columns, fail_silently)
+			if op2 is None:
+				return np.asarray(op1, dtype=bool)
+			# None in a decided row doesn't change the result
+			op2 = np.asarray(op2, dtype=bool)
+		else:
+			op2 = _evaluate(node.right, environment, fail_silently, columns)
+		return _binop(node.op, op1, op2)
+	elif isinstance(node, Call):
+		func = lookup_function(node.name, environment)
+		if func is MISSING:
+			return resolve(node.name, environment, fail_silently)
+		if not callable(func):
+			return func
+		if node.name in SHORT_CIRCUIT and _builtin(node.name, environment) and \
+				len(node.args) == 2:
+			first = _evaluate(node.args[0], environment, fail_silently, columns)
+			second = _decide(node.name, first, node.args[1], environment, columns,
+				fail_silently)
+			return _rowwise(func, [first, second])
+		args = [_evaluate(arg, environment, fail_silently, columns) for arg in node.args]
+		if node.name == "in" and _builtin("in", environment) and len(args) == 2:
+			value, container = args
+			if isinstance(container, list) and any(_is_array(item) for item in container):
+				return _rowwise(lambda x, *items: x in items, [value] + container)
+			if not _is_array(container) and not isinstance(container, str):
+				return _isin(value, container)
+		if node.name == "not" and _builtin("not", environment):
+			return np.logical_not(*args)
+		if node.name == "eq" and _builtin("eq", environment):
+			return _equal(*args)
+		return _rowwise(func, args)
+	elif isinstance(node, List):
+		return [_evaluate(item, environment, fail_silently, columns) for item in node.items]
+	raise TypeError("Unknown node %r" % (node,))
+
+def _column(values):
+	""" Returns values as an array. Numbers and other values mixed together
+		are kept as they are, where NumPy would turn ['a', 3] into strings.
+	"""
+	if _is_array(values):
+		return values
+	types = set(type(value) for value in values)
+	if len(types) > 1 and not types <= set([bool, int, float]):
+		return np.array(values, dtype=object)
+	return np.asarray(values)
+
+def evaluate_tree_columns(tree, columns, environment={}, fail_silently=True):
+	""" Evaluates tree once over every row in columns, a dict of equally long
+		arrays. Names not in columns are looked up in environment. Returns an
+		array with one result per row.
+	"""
+	_import_numpy()
+	arrays = {}
+	for name, column in columns.items():
+		arrays[name] = _column(column)
+	lengths = set(len(column) for column in arrays.values())
+	if len(lengths) > 1:
+		raise ValueError("Columns must all have the same length")
+	full_environment = dict(environment)
+	full_environment.update(arrays)
+	result = _evaluate(tree, full_environment, fail_silently, tuple(arrays))
+	if lengths and not _is_array(result):
+		result = np.full(lengths.pop(), result)
+	return np.asarray(result)
@@ -0,0 +1,121 @@
+""" A JSON API for evaluating rules registered on the server, so services
+	that aren't written in Python can share one set of compiled rules.
+
+	POST rules/ with ``{"rules": {"id": "expression", ...}}`` registers
+	rules, replacing any already under those ids. If any of them doesn't
+	parse, none are registered and the response lists the errors by id.
+	GET rules/ returns the registered rules the same way.
+
+	POST evaluate/ with ``{"rules": ["id", ...], "environments": [{...},
+	...]}`` evaluates every rule against every environment. rules can be
+	left out to evaluate all of them, and ``"fail_silently": false`` makes
+	missing variables errors. The response is streamed as one line of JSON
+	per environment, in order, as it's evaluated:
+	``{"index": 0, "results": {"id": value, ...}}``, or
+	``{"index": 0, "error": "..."}`` if that environment failed.
+
+	Rules are kept in memory by each process, so a client that is told a
+	rule is unknown, for instance by a worker that has restarted, can
+	register it again and retry. The YAPP_MAX_RULES setting limits how many
+	are kept, dropping the rules registered longest ago.
+
+	Neither view checks who is calling, so they belong behind whatever
+	authenticates the services using them. Any caller can still register
+	a rule like ``9 ^ 999999999``; evaluating it raises OverflowError, and
+	its line reports the error, since ^ refuses to make an int of more
+	than yapp.evaluator.MAX_POWER_BITS bits.
+"""
+import json
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from yapp import compile
+from yapp.exceptions import ParseError
+from yapp.rules import RuleRegistry
+
+# The rules every request evaluates. Set its environment to give them
+# functions and values of the server's own.
+registry = RuleRegistry(max_rules=getattr(settings, "YAPP_MAX_RULES", None))
+
+def _json(value, status=200):
+	return HttpResponse(json.dumps(value), content_type="application/json",
+		status=status)
+
+def _error(message, status=400, **details):
+	details["error"] = message
+	return _json(details, status)
+
+def _jsonable(value):
+	# what in() compares against once a literal list has been optimized
+	if isinstance(value, (set, frozenset)):
+		return sorted(value, key=repr)
+	raise TypeError("%r can't be sent as JSON" % (value,))
+
+def _body(request):
+	""" Returns the JSON object in the request body, or None
+	"""
+	try:
+		body = json.loads(request.body.decode("utf-8"))
+	except ValueError:
+		return None
+	return body if isinstance(body, dict) else None
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def rules(request):
+	if request.method == "GET":
+		return _json({"rules" : registry.expressions()})
+	body = _body(request)
+	if body is None or not isinstance(body.get("rules"), dict):
+		return _error("Expected a JSON object with a rules object")
+	compiled = {}
+	errors = {}
+	for rule_id, expr in body["rules"].items():
+		if not isinstance(expr, str):
+			errors[rule_id] = "Expected an expression"
+			continue
+		try:
+			compiled[rule_id] = compile(expr, fail_silently=False)
+		except ParseError as e:
+			errors[rule_id] = "%s" % e
+	if errors:
+		return _error("Some rules didn't parse", errors=errors)
+	registry.add(compiled)
+	return _json({"registered" : sorted(compiled)})
+
+def _results(rule_ids, environments, fail_silently):
+	for index, environment in enumerate(environments):
+		try:
+			results = registry.evaluate(rule_ids, environment, fail_silently)
+			line = json.dumps({"index" : index, "results" : results},
+				default=_jsonable, allow_nan=False)
+		except Exception as e:
+			# the response has started, so the error goes on its own line
+			line = json.dumps({"index" : index, "error" : "%s" % e})
+		yield line + "\n"
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def evaluate(request):
+	body = _body(request)
+	if body is None:
+		return _error("Expected a JSON object")
+	environments = body.get("environments")
+	if not isinstance(environments, list) or \
+			not all(isinstance(environment, dict) for environment in environments):
+		return _error("Expected environments to be a list of objects")
+	rule_ids = body.get("rules")
+	if rule_ids is None:
+		rule_ids = sorted(registry.expressions())
+	elif not isinstance(rule_ids, list):
+		return _error("Expected rules to be a list of ids")
+	unknown = [rule_id for rule_id in rule_ids
+		if not isinstance(rule_id, str) or rule_id not in registry]
+	if unknown:
+		return _error("Unknown rules", status=404, rules=unknown)
+	fail_silently = body.get("fail_silently", True) is not False
+	return StreamingHttpResponse(_results(rule_ids, environments, fail_silently),
+		content_type="application/x-ndjson")